@@ -0,0 +1,112 @@
+# analytics.py
+# Tab usage analytics for the dashboard and the chat prompt. A user's hourly
+# usage rollup is loaded into NumPy column arrays once and every statistic
+# (per-domain totals, top sites, hour-of-day and weekday profiles) is
+# computed with array operations instead of Python loops over rows.
+# Results are cached per user and invalidated by the user's tab data version.
+import time
+
+import numpy as np
+
+from context_cache import context_cache
+from database import DAY, HOUR, get_tab_usage_hourly
+
+DEFAULT_WINDOW_DAYS = 7
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+def load_tab_usage(username, since=None, until=None):
+    """
+    Load the user's hourly usage into columns:
+    {'hour_start': int64[n], 'domain_code': int32[n], 'seconds': float64[n],
+     'domains': array of the distinct domains that domain_code indexes}.
+    """
+    rows = get_tab_usage_hourly(username, since, until)
+    if not rows:
+        return {'hour_start': np.zeros(0, np.int64), 'domain_code': np.zeros(0, np.int32),
+                'seconds': np.zeros(0, np.float64), 'domains': np.array([], dtype=object)}
+    hour_start, domains, seconds = zip(*rows)
+    domains, codes = np.unique(np.array(domains, dtype=object), return_inverse=True)
+    return {
+        'hour_start': np.array(hour_start, dtype=np.int64),
+        'domain_code': codes.astype(np.int32),
+        'seconds': np.array(seconds, dtype=np.float64),
+        'domains': domains,
+    }
+
+
+def domain_totals(usage):
+    """
+    Return [(domain, seconds)], most used first.
+    """
+    totals = np.bincount(usage['domain_code'], weights=usage['seconds'],
+                         minlength=len(usage['domains']))
+    order = np.argsort(-totals, kind='stable')
+    return [(str(usage['domains'][i]), float(totals[i])) for i in order if totals[i] > 0]
+
+
+def top_domains(usage, n=5):
+    """
+    Return the `n` most used domains as [(domain, seconds)].
+    Uses a partial sort, so only the top entries are ordered.
+    """
+    totals = np.bincount(usage['domain_code'], weights=usage['seconds'],
+                         minlength=len(usage['domains']))
+    if len(totals) > n:
+        candidates = np.argpartition(-totals, n)[:n]
+    else:
+        candidates = np.arange(len(totals))
+    order = candidates[np.argsort(-totals[candidates], kind='stable')]
+    return [(str(usage['domains'][i]), float(totals[i])) for i in order if totals[i] > 0]
+
+
+def _local_offset():
+    # Current UTC offset of the server's timezone, in seconds.
+    return time.localtime().tm_gmtoff
+
+
+def hour_of_day(usage, utc_offset=None):
+    """
+    Return 24 totals: seconds spent in each local hour of the day.
+    """
+    offset = _local_offset() if utc_offset is None else utc_offset
+    hours = (usage['hour_start'] + offset) // HOUR % 24
+    return np.bincount(hours, weights=usage['seconds'], minlength=24)
+
+
+def day_of_week(usage, utc_offset=None):
+    """
+    Return 7 totals, Monday first: seconds spent on each local weekday.
+    """
+    offset = _local_offset() if utc_offset is None else utc_offset
+    # 1970-01-01 was a Thursday (index 3).
+    days = ((usage['hour_start'] + offset) // DAY + 3) % 7
+    return np.bincount(days, weights=usage['seconds'], minlength=7)
+
+
+def compute_tab_stats(username, days=DEFAULT_WINDOW_DAYS, top_n=10):
+    """
+    Summarise the user's last `days` days of browsing:
+    {'days', 'total_seconds', 'top_domains', 'hour_of_day', 'day_of_week', 'peak_hour'}.
+    """
+    usage = load_tab_usage(username, since=time.time() - days * DAY)
+    hours = hour_of_day(usage)
+    total = float(usage['seconds'].sum())
+    return {
+        'days': days,
+        'total_seconds': total,
+        'top_domains': top_domains(usage, top_n),
+        'hour_of_day': hours.tolist(),
+        'day_of_week': day_of_week(usage).tolist(),
+        'peak_hour': int(hours.argmax()) if total else None,
+    }
+
+
+def get_tab_stats(username, days=DEFAULT_WINDOW_DAYS, top_n=10):
+    """
+    Cached compute_tab_stats. Rebuilt when the user's tab data changes,
+    and at each day boundary since the window trails the current time.
+    """
+    name = f"tab_stats:{days}:{top_n}:{int(time.time()) // DAY}"
+    return context_cache.get(name, username.strip(),
+                             lambda user: compute_tab_stats(user, days, top_n), kind='tabs')
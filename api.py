@@ -1,36 +1,238 @@
-from flask import Flask, request, jsonify
+import functools
+import json
+import logging
+import os
+import queue
+import time
+import zlib
+
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS  # Import CORS
-from database import update_tabs_table, create_tabs_table
+from context_cache import context_cache
+from database import ensure_schema
+from ingest import get_ingest_queue
+from jobs import start_background_jobs
+from log_utils import configure_logging, elapsed_ms, log_event
+from metrics import observe_request, registry
+from notifications import (
+    EVENTS_HEARTBEAT, collect_events_stats, format_comment, format_event, get_backlog, hub,
+    parse_last_event_id, stream_preamble
+)
+from pregen import collect_pregen_stats, get_generated_messages
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Make sure the tabs table exists.
-create_tabs_table()
+# Largest request body accepted from the extension, in bytes, after inflating gzip bodies.
+MAX_BODY_BYTES = int(os.environ.get('GOOD_HABITS_MAX_BODY_BYTES', str(4 * 1024 * 1024)))
+
+# Make sure the database schema is up to date.
+ensure_schema()
+
+def timed(endpoint):
+    """
+    Record each request's latency and status under `endpoint` in the metrics.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            response = view(*args, **kwargs)
+            status = response[1] if isinstance(response, tuple) else 200
+            observe_request(endpoint, status, time.perf_counter() - started)
+            log_event(logger, logging.INFO, endpoint, status=status, ms=elapsed_ms(started))
+            return response
+        return wrapper
+    return decorator
 
 @app.route('/store_tabs', methods=['POST'])
+@timed('store_tabs')
 def store_tabs():
-    # Debug: Check if the request is reaching the endpoint
-    print("Received a POST request at /store_tabs")
+    # Debug output is only produced when GOOD_HABITS_LOG_LEVEL=DEBUG.
+    logger.debug("Received a POST request at /store_tabs")
     
     # Attempt to get the JSON data from the request
     try:
-        tab_data = request.get_json()
-        print("Received tab data:", tab_data)  # Debug: Print the received data
+        tab_data = _read_json_body()
+        logger.debug("Received tab data: %s", tab_data)
     except Exception as e:
-        print("Error parsing JSON:", e)  # Debug: Print any error during parsing
+        logger.debug("Error parsing JSON: %s", e)
         return jsonify({'status': 'failed', 'message': 'Error parsing tab data'}), 400
 
+    # Delta protocol: {"client_id", "seq", "full", "tabs", "closed"}, see ingest.py.
+    if isinstance(tab_data, dict):
+        error = _check_report(tab_data)
+        if error:
+            return jsonify({'status': 'failed', 'message': error}), 400
+        result = get_ingest_queue().submit_report(tab_data)
+        if result == 'resync':
+            return jsonify({'status': 'resync', 'message': 'Send a full snapshot'}), 409
+        if result == 'busy':
+            return jsonify({'status': 'failed', 'message': 'Server busy, try again'}), 503
+        return jsonify({'status': 'success', 'seq': tab_data['seq']})
+
     # Check if data was received
     if tab_data:
-        # Debug: Print confirmation of received data
-        print("Tab data received, calling update_tabs_table")
-        update_tabs_table(tab_data)  # Assuming this is working as expected
+        if not isinstance(tab_data, list):
+            return jsonify({'status': 'failed', 'message': 'Tab data must be a list of tabs'}), 400
+        # Refuse malformed tabs here: once queued they would fail in the writer.
+        error = next(filter(None, map(_check_tab, tab_data)), None)
+        if error:
+            return jsonify({'status': 'failed', 'message': error}), 400
+        # Hand the data to the background writer and return right away.
+        if not get_ingest_queue().submit(tab_data):
+            return jsonify({'status': 'failed', 'message': 'Server busy, try again'}), 503
         return jsonify({'status': 'success'})
     else:
-        # Debug: Print if no data was received
-        print("No tab data received in request body")
+        logger.debug("No tab data received in request body")
         return jsonify({'status': 'failed', 'message': 'No tab data received'}), 400
 
+def _read_json_body():
+    """
+    Parse the request body as JSON, inflating it first when the extension
+    sent it with Content-Encoding: gzip.
+    """
+    data = request.get_data(cache=False)
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = inflater.decompress(data, MAX_BODY_BYTES)
+        if inflater.unconsumed_tail:
+            raise ValueError("Inflated body is too large")
+    return json.loads(data) if data else None
+
+def _is_tab_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _check_tab(tab, require_id=False):
+    """
+    Return an error message for a tab that can't be stored, or None.
+    """
+    if not isinstance(tab, dict):
+        return 'Every tab must be an object'
+    if tab.get('username') is not None and not isinstance(tab['username'], str):
+        return 'username must be a string'
+    tab_id = tab.get('tab_id')
+    if (require_id or tab_id is not None) and not _is_tab_id(tab_id):
+        return 'tab_id must be an integer'
+    for field in ('title', 'url'):
+        if not isinstance(tab.get(field), str):
+            return f'{field} must be a string'
+    if not _is_number(tab.get('duration')):
+        return 'duration must be a number'
+    return None
+
+def _check_report(report):
+    """
+    Return an error message for a malformed delta report, or None.
+    """
+    client_id, seq = report.get('client_id'), report.get('seq')
+    if not isinstance(client_id, str) or not 0 < len(client_id) <= 128:
+        return 'client_id must be a non-empty string'
+    if not _is_tab_id(seq) or seq < 1:
+        return 'seq must be a positive integer'
+    for field, check in (('tabs', _check_upsert), ('closed', _check_closed)):
+        items = report.get(field) or []
+        if not isinstance(items, list):
+            return f'{field} must be a list'
+        error = next(filter(None, map(check, items)), None)
+        if error:
+            return f'{field}: {error}'
+    return None
+
+def _check_upsert(tab):
+    return _check_tab(tab, require_id=True)
+
+def _check_closed(tab):
+    if not isinstance(tab, dict):
+        return 'Every tab must be an object'
+    if tab.get('username') is not None and not isinstance(tab['username'], str):
+        return 'username must be a string'
+    if not _is_tab_id(tab.get('tab_id')):
+        return 'tab_id must be an integer'
+    if tab.get('duration') is not None and not _is_number(tab['duration']):
+        return 'duration must be a number'
+    return None
+
+@app.route('/messages', methods=['GET'])
+@timed('messages')
+def messages():
+    # Pre-generated AI messages for the extension; see pregen.py.
+    username = (request.args.get('username') or '').strip()
+    if not username:
+        return jsonify({'status': 'failed', 'message': 'username is required'}), 400
+    stored = get_generated_messages(username)
+    return jsonify({'status': 'success', 'messages': [
+        {'kind': kind, 'content': content, 'created_at': created_at}
+        for kind, (content, _, created_at) in sorted(stored.items())
+    ]})
+
+@app.route('/events', methods=['GET'])
+def events():
+    """
+    Server-sent events with the user's notifications (see notifications.py).
+    This version holds a thread per connection and suits the development
+    server; serve.py answers /events itself without tying up threads.
+    """
+    username = (request.args.get('username') or '').strip()
+    if not username:
+        return jsonify({'status': 'failed', 'message': 'username is required'}), 400
+    last_event_id = parse_last_event_id(
+        request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+
+    def generate():
+        rows = queue.Queue()
+        unsubscribe = hub.subscribe(username, rows.put)
+        try:
+            yield stream_preamble()
+            sent = last_event_id or 0
+            for row in get_backlog(username, last_event_id):
+                yield format_event(row)
+                sent = row[0]
+            while True:
+                try:
+                    row = rows.get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty:
+                    yield format_comment('ping')
+                    continue
+                if row[0] > sent:
+                    yield format_event(row)
+                    sent = row[0]
+        finally:
+            unsubscribe()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus scrape endpoint; with serve.py --workers N, counts cover all workers.
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+def _collect_runtime_stats():
+    queue = get_ingest_queue()
+    stats = [
+        ('good_habits_ingest_queue_depth', 'gauge', "Users waiting to be written.", queue.depth()),
+    ]
+    for name, value in queue.stats.items():
+        stats.append((f'good_habits_ingest_{name}_total', 'counter',
+                      f"Tab ingest queue: {name}.", value))
+    stats.append(('good_habits_context_cache_hits_total', 'counter',
+                  "Prompt context cache hits.", context_cache.hits))
+    stats.append(('good_habits_context_cache_misses_total', 'counter',
+                  "Prompt context cache misses.", context_cache.misses))
+    return stats
+
+registry.register_collector(_collect_runtime_stats)
+registry.register_collector(collect_pregen_stats)
+registry.register_collector(collect_events_stats)
+
 if __name__ == '__main__':
+    # Development server. Use serve.py for the multi-worker production mode.
+    configure_logging()
+    start_background_jobs()
     app.run(port=5000)
@@ -1,94 +1,47 @@
+import pandas as pd
 import streamlit as st
-import openai
 from hashlib import sha256
-import json
-import time
+from analytics import get_tab_stats
 from profile_page import profile_page
 from database import (
-    create_user_table, create_tabs_table, 
-    get_user, store_user, update_user_stats, get_tabs, print_all_content, get_tabs
+    ensure_schema, get_data_version,
+    get_user, store_user, update_user_stats
 )
 from habit_functions import (
-    add_habit, get_user_habits,
+    add_habit, mark_habits_done,
     get_streak_increment_message, update_habit_streak,
     get_reset_message, reset_habit_streak, get_streak_display
 )
+from chat_functions import TAB_ANALYSIS_QUERY, chat_with_gpt, get_tab_stat_context
+from pregen import store_generated_message
+from ui_cache import (
+    get_cached_due_habits, get_cached_generated_messages, get_cached_habits, get_cached_progress_series,
+    get_cached_rank, get_cached_tabs, get_cached_top, get_cached_user_boards, invalidate_user_cache
+)
 
-# === Helper to load the API key ===
-def load_api_key(filename="config.json"):
-    with open(filename, "r") as file:
-        data = json.load(file)
-        if not data:
-            raise ValueError("API key not found in JSON file.")
-        print("API key loaded successfully.")
-        return data.get("OPENAI_API_KEY", "").strip()
-
-# Make sure the necessary tables exist.
-create_user_table()
-create_tabs_table()
-
-# === Context Functions ===
-def get_habit_context(username):
-    habits = get_user_habits(username)
-    if not habits:
-        return "You haven't started tracking any habits yet."
-    
-    context = []
-    for habit in habits:
-        name = habit[2]
-        frequency = habit[3]
-        streak = habit[6]
-        last_tracked = habit[5]
-        
-        status = f"You're maintaining a {streak}-day streak for {name} ({frequency})."
-        if streak == 0 and last_tracked:
-            status = f"You recently reset your streak for {name} ({frequency}). Time for a fresh start!"
-        elif streak == 0:
-            status = f"You've set up {name} ({frequency}) as a new habit to build."
-            
-        context.append(status)
-    
-    return "\n".join(context)
-
-def get_tab_stat_context(username):
-    tabs = get_tabs(username)
-    if not tabs:
-        return "No tab data available."
-    lines = []
-    for tab in tabs:
-        title, url, duration, timestamp = tab
-        lines.append(f"{title}: open for {duration:.2f} seconds")
-    return "\n".join(lines)
+# Make sure the database schema is up to date. After the first run in a
+# process this is an in-memory check.
+ensure_schema()
 
-def chat_with_gpt(query, username):
-    habit_context = get_habit_context(username)
-    
-    system_prompt = f"""You are a supportive AI assistant who helps users build better habits and plan their days. 
-Here's the user's current habit status:
-{habit_context}
+# === Streamlit UI Code ===
 
-Keep this context in mind when responding. If relevant to their question, provide specific advice about:
-- How to maintain their current streaks
-- How to rebuild after broken streaks
-- How to plan their day around their habits
-- How to stay motivated
+ANALYSIS_BOX_STYLE = "padding: 1rem; background-color: #2c3e50; border-radius: 0.5rem; color: #ecf0f1;"
+CHAT_BOX_STYLE = ("height: 300px; overflow-y: auto; padding: 1rem; "
+                  "background-color: #2c3e50; border-radius: 0.5rem; color: #ecf0f1;")
 
-Be encouraging but realistic. Acknowledge their progress and setbacks naturally in conversation."""
-    
-    client = openai.OpenAI(api_key=load_api_key())
-    
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        store=True,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": query}
-        ]
-    )
-    
-    return completion.choices[0].message.content
+def response_box(text, style):
+    return f'''<div style="{style}">{text}</div>'''
 
-# === Streamlit UI Code ===
+def stream_response(placeholder, chunks, style):
+    """
+    Render text chunks into `placeholder` as they arrive and return the full text.
+    """
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        placeholder.markdown(response_box(text + " ▌", style), unsafe_allow_html=True)
+    placeholder.markdown(response_box(text, style), unsafe_allow_html=True)
+    return text
 
 st.title("Good Habits")
 
@@ -124,13 +77,28 @@ def login_page():
 # Main page after login
 # Main page after login
 def main_page():
-    print_all_content()
     st.markdown(f'<div id="user-info" style="display:none;">{st.session_state["username"]}</div>', unsafe_allow_html=True)
     st.markdown(f"<h2 class='main-header'>Welcome {st.session_state['username']}!</h2>", unsafe_allow_html=True)
+    # Generated in the background by pregen.py, so these never wait on OpenAI.
+    messages = get_cached_generated_messages(st.session_state["username"])
+    if 'encouragement' in messages:
+        st.info("💡 " + messages['encouragement'][0])
     
     st.subheader("Tab Statistics")
+    stats = get_tab_stats(st.session_state["username"])
+    if stats['total_seconds']:
+        st.caption(f"{stats['total_seconds'] / 3600:.1f} hours of browsing over the last {stats['days']} days")
+        chart_cols = st.columns([1, 1])
+        with chart_cols[0]:
+            st.markdown("**Top sites (minutes)**")
+            st.bar_chart(pd.DataFrame(
+                {'minutes': [seconds / 60 for _, seconds in stats['top_domains']]},
+                index=[domain for domain, _ in stats['top_domains']]), horizontal=True)
+        with chart_cols[1]:
+            st.markdown("**By hour of day (minutes)**")
+            st.bar_chart(pd.DataFrame({'minutes': [seconds / 60 for seconds in stats['hour_of_day']]}))
     # Retrieve only the tabs for the logged-in user.
-    tabs = get_tabs(st.session_state["username"].strip())
+    tabs = get_cached_tabs(st.session_state["username"])
     if tabs:
         for tab in tabs:
             title, url, duration, timestamp = tab
@@ -138,42 +106,58 @@ def main_page():
     else:
         st.info("No tab data available. The feature for obtaining real time tab information is not fully functional. We will assume the following configuration: one youtube tab playing music video, one google search tab on deepseek, and one gmail tab. Also note that the following generated message is originally intended to be a pop up notification that gets your attention depending on your browser activeness.")
     
-    if st.button("Get ChatGPT Analysis of Tab Stats"):
-        # tab_context = get_tab_stat_context(st.session_state["username"])
-        tab_context = "(159, John, 'My Heart Will Go On', 'https://www.google.com/url?sa=t&source=web&rct=j&opi=89978449&url=https://www.youtube.com/watch%3Fv%3DWNIPqafd4As&ved=2ahUKEwi818nP_LaLAxUomokEHWnuEhoQtwJ6BAg4EAI&usg=AOvVaw1phPR1Cyly8Vk9K4HkevSo', 1372.746, 1739114954)(160, John, 'Gmail: Private and secure email at no cost', 'https://workspace.google.com/intl/en-US/gmail/', 1366.068, 1739114954)(161, John, 'deep seek - Google Search', 'https://www.google.com/search?client=firefox-b-1-d&q=deep+seek', 1257.444, 1739114954"
-        query = f"Based on my current tab usage stats:\n{tab_context}\nPlease provide some insights or suggestions in one or two sentences that encourages me to keep up with my goal."
-        response = chat_with_gpt(query, st.session_state["username"])
-        st.session_state['chat_response'] = response  # Store the response in session state
+    analyze = st.button("Get ChatGPT Analysis of Tab Stats")
+    if analyze or 'chat_response' in st.session_state:
+        st.subheader("ChatGPT Analysis of Tab Stats")
+    analysis_box = st.empty()
+    # Only needed, and only read, when the button was pressed.
+    tabs_version = get_data_version(st.session_state["username"], 'tabs') if analyze else None
+    pregenerated = messages.get('tab_analysis')
+    if analyze and stats['total_seconds'] and pregenerated and pregenerated[1] == tabs_version:
+        # Already generated for the current tab data.
+        st.session_state['chat_response'] = pregenerated[0]
+        analysis_box.markdown(response_box(pregenerated[0], ANALYSIS_BOX_STYLE), unsafe_allow_html=True)
+        st.success("ChatGPT Analysis has been sent as a notification.")
+    elif analyze:
+        if stats['total_seconds']:
+            tab_context = get_tab_stat_context(st.session_state["username"])
+        else:
+            # Demo data until the extension has reported some browsing.
+            tab_context = ("Time spent per site (demo data):\n"
+                           "youtube.com: 22.9 minutes (music video 'My Heart Will Go On')\n"
+                           "workspace.google.com: 22.8 minutes (Gmail)\n"
+                           "google.com: 21.0 minutes (search for 'deep seek')")
+        query = TAB_ANALYSIS_QUERY.format(tab_context=tab_context)
+        # Show the answer as it is generated and keep it in session state.
+        st.session_state['chat_response'] = stream_response(
+            analysis_box, chat_with_gpt(query, st.session_state["username"], stream=True), ANALYSIS_BOX_STYLE)
+        if stats['total_seconds']:
+            # Saved like a pre-generated one, so the extension can show it too.
+            store_generated_message(st.session_state["username"], 'tab_analysis',
+                                    st.session_state['chat_response'], tabs_version)
+            invalidate_user_cache(st.session_state["username"])
         
         st.success("ChatGPT Analysis has been sent as a notification.")
-    
-    # Display the ChatGPT response (if available)
-    if 'chat_response' in st.session_state:
-        st.subheader("ChatGPT Analysis of Tab Stats")
-        st.markdown(f"""
-            <div style="padding: 1rem; background-color: #2c3e50; border-radius: 0.5rem; color: #ecf0f1;">
-                {st.session_state['chat_response']}
-            </div>
-        """, unsafe_allow_html=True)
+    elif 'chat_response' in st.session_state:
+        # Display the ChatGPT response (if available)
+        analysis_box.markdown(response_box(st.session_state['chat_response'], ANALYSIS_BOX_STYLE),
+                              unsafe_allow_html=True)
     
     st.subheader("💬 Chat with AI")
     chat_cols = st.columns([1, 1])
     with chat_cols[0]:
         query = st.text_area("Ask me anything about your habits or planning:", height=200)
-        if st.button("Send 📤", key="send_chat"):
-            if query:
-                response = chat_with_gpt(query, st.session_state['username'])
-                st.session_state['current_response'] = response
-            else:
-                st.error("Please enter a question.")
+        send = st.button("Send 📤", key="send_chat")
+        if send and not query:
+            st.error("Please enter a question.")
     with chat_cols[1]:
-        if 'current_response' in st.session_state:
-            st.markdown(f"""
-                <div style="height: 300px; overflow-y: auto; padding: 1rem; 
-                    background-color: #2c3e50; border-radius: 0.5rem; color: #ecf0f1;">
-                    {st.session_state['current_response']}
-                </div>
-            """, unsafe_allow_html=True)
+        chat_box = st.empty()
+        if send and query:
+            st.session_state['current_response'] = stream_response(
+                chat_box, chat_with_gpt(query, st.session_state['username'], stream=True), CHAT_BOX_STYLE)
+        elif 'current_response' in st.session_state:
+            chat_box.markdown(response_box(st.session_state['current_response'], CHAT_BOX_STYLE),
+                              unsafe_allow_html=True)
     
     st.subheader("📊 Habit Tracker")
     with st.form("new_habit", clear_on_submit=True):
@@ -186,8 +170,18 @@ def main_page():
             submit = st.form_submit_button("Add Habit")
         if submit and habit_name:
             add_habit(st.session_state['username'], habit_name, frequency)
+            invalidate_user_cache(st.session_state['username'])
             st.success(f"Added new habit: {habit_name}")
-    habits = get_user_habits(st.session_state['username'])
+    habits = get_cached_habits(st.session_state['username'])
+    due_habits = get_cached_due_habits(st.session_state['username'])
+    if due_habits:
+        st.caption("Due today: " + ", ".join(habit[2] for habit in due_habits))
+    if habits and st.button("✅ Mark all done", key="track_all"):
+        messages = mark_habits_done([habit[0] for habit in habits])
+        invalidate_user_cache(st.session_state['username'])
+        for habit_id, message in messages.items():
+            st.session_state.setdefault('streak_messages', {})[f"habit_{habit_id}"] = (message, "info")
+        st.rerun()
     if habits:
         for habit in habits:
             habit_key = f"habit_{habit[0]}"
@@ -230,6 +224,7 @@ def main_page():
                 """, unsafe_allow_html=True)
             if button1:
                 success_message = update_habit_streak(habit[0])
+                invalidate_user_cache(st.session_state['username'])
                 if habit[6] % 5 == 4:
                     st.balloons()
                     st.session_state.setdefault('streak_messages', {})[habit_key] = (success_message, "success")
@@ -237,10 +232,37 @@ def main_page():
                     st.session_state.setdefault('streak_messages', {})[habit_key] = (success_message, "info")
             if button2:
                 reset_message = reset_habit_streak(habit[0])
+                invalidate_user_cache(st.session_state['username'])
                 st.session_state.setdefault('streak_messages', {})[habit_key] = (reset_message, "warning")
     else:
         st.info("No habits tracked yet. Add your first habit above! 🎯")
 
+    st.subheader("📈 Progress")
+    ranges = {"Last 30 days": 30, "Last 90 days": 90, "Last year": 365}
+    days = ranges[st.radio("Range", list(ranges), horizontal=True, key="progress_range")]
+    series = get_cached_progress_series(st.session_state['username'], days)
+    index = pd.to_datetime(series['day'], unit='s')
+    if series['streaks']:
+        st.line_chart(pd.DataFrame(series['streaks'], index=index))
+    else:
+        st.caption("Streak history appears here once your habits have been tracked for a day.")
+    if any(series['tab_seconds']):
+        st.caption("Browsing time (minutes per day)")
+        st.area_chart(pd.Series(series['tab_seconds'], index=index) / 60)
+
+    st.subheader("🏆 Leaderboard")
+    boards = ["All habits"] + get_cached_user_boards(st.session_state['username'])
+    board = st.selectbox("Board", boards, key="leaderboard_board")
+    habit_name = None if board == "All habits" else board
+    top = get_cached_top(st.session_state['username'], 10, habit_name)
+    if top:
+        st.table(pd.DataFrame(top, columns=["Rank", "User", "Streak"]).set_index("Rank"))
+        rank = get_cached_rank(st.session_state['username'], habit_name)
+        if rank:
+            st.caption(f"You're #{rank[0]} of {rank[1]} with a streak of {rank[2]}.")
+    else:
+        st.caption("No streaks yet.")
+
 if 'username' not in st.session_state:
     page = st.selectbox("Select Page", ["Login", "Register"])
     if page == "Login":
@@ -0,0 +1,82 @@
+# benchmarks/bench_db.py
+# Micro-benchmarks for the database helpers, run against a synthetic
+# database. Prints a JSON report with throughput and p50/p99 latency.
+#
+#   python -m benchmarks.bench_db --users 200 --habits 8 --tabs 30 --ops 500
+import argparse
+import os
+import random
+import tempfile
+
+import database
+import habit_functions
+from benchmarks.common import environment, time_calls, write_report
+from benchmarks.generate_data import advance_payload, generate_dataset, make_tab_payload, username_for
+
+
+def run_benchmarks(users, habits, tabs, ops, seed=7):
+    rng = random.Random(seed)
+    results = []
+    usernames = [username_for(rng.randrange(users)) for _ in range(ops)]
+
+    # Ingestion: a fresh snapshot per call, then the same tabs a minute later.
+    # The generated data already holds tab ids 1..tabs, so start after them
+    # to measure tabs the database hasn't seen.
+    payloads = {name: make_tab_payload(name, tabs, rng, first_tab_id=tabs + 1) for name in set(usernames)}
+    results.append(time_calls('update_tabs_table.first_report', database.update_tabs_table,
+                              [(payload,) for payload in payloads.values()], tabs=tabs))
+    later = [(advance_payload(payloads[name], rng),) for name in usernames]
+    results.append(time_calls('update_tabs_table.advanced_report', database.update_tabs_table,
+                              later, tabs=tabs))
+    results.append(time_calls('update_tabs_table.unchanged_report', database.update_tabs_table,
+                              later, tabs=tabs))
+
+    results.append(time_calls('get_tabs', database.get_tabs, [(name,) for name in usernames]))
+    results.append(time_calls('get_tab_usage', database.get_tab_usage, [(name,) for name in usernames]))
+    results.append(time_calls('get_user', database.get_user, [(name,) for name in usernames]))
+    results.append(time_calls('get_user_habits', habit_functions.get_user_habits,
+                              [(name,) for name in usernames]))
+    results.append(time_calls('get_due_habits', habit_functions.get_due_habits,
+                              [(name,) for name in usernames]))
+
+    conn = database.get_connection()
+    habit_ids = [row[0] for row in conn.execute('SELECT id FROM habits')]
+    results.append(time_calls('update_habit_streak', habit_functions.update_habit_streak,
+                              [(rng.choice(habit_ids),) for _ in range(ops)]))
+    results.append(time_calls('reset_habit_streak', habit_functions.reset_habit_streak,
+                              [(rng.choice(habit_ids),) for _ in range(ops)]))
+    user_habits = {}
+    for habit_id, username in conn.execute('SELECT id, username FROM habits'):
+        user_habits.setdefault(username, []).append(habit_id)
+    results.append(time_calls('mark_habits_done', habit_functions.mark_habits_done,
+                              [(user_habits[name],) for name in usernames if name in user_habits],
+                              habits=habits))
+    results.append(time_calls('expire_overdue_streaks', habit_functions.expire_overdue_streaks,
+                              [()] * max(1, ops // 50)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the database helpers.")
+    parser.add_argument('--db', help="database file to use (default: a new temporary file)")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--habits', type=int, default=8, help="habits per user")
+    parser.add_argument('--tabs', type=int, default=30, help="tabs per user")
+    parser.add_argument('--ops', type=int, default=500, help="calls per benchmark")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='good-habits-bench-'), 'bench.db')
+    dataset = generate_dataset(db_path, args.users, args.habits, args.tabs, args.seed)
+    report = {
+        'suite': 'database',
+        'environment': environment(),
+        'dataset': dataset,
+        'results': run_benchmarks(args.users, args.habits, args.tabs, args.ops, args.seed),
+    }
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# benchmarks/common.py
+# Timing helpers shared by the benchmark scripts.
+import json
+import math
+import platform
+import sqlite3
+import sys
+import time
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(name, latencies, elapsed, **extra):
+    """
+    Turn per-operation latencies (seconds) into a result record.
+    """
+    latencies = sorted(latencies)
+    ops = len(latencies)
+    result = {
+        'name': name,
+        'ops': ops,
+        'seconds': round(elapsed, 6),
+        'throughput_per_s': round(ops / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 4) if ops else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4) if ops else None,
+        'max_ms': round(latencies[-1] * 1000, 4) if ops else None,
+    }
+    result.update(extra)
+    return result
+
+
+def time_calls(name, func, args_list, **extra):
+    """
+    Call func(*args) for each entry of args_list and summarize the latencies.
+    """
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t0)
+    return summarize(name, latencies, time.perf_counter() - started, **extra)
+
+
+def environment():
+    return {
+        'python': sys.version.split()[0],
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+    }
+
+
+def write_report(report, path=None):
+    """
+    Print the report as JSON, or write it to `path`.
+    """
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,144 @@
+# benchmarks/generate_data.py
+# Synthetic data for benchmarks: N users with M habits and K tabs each.
+# Tab urls mimic what the extension really sees, including long Google
+# redirect links.
+#
+#   python -m benchmarks.generate_data --db /tmp/bench.db --users 1000 --habits 10 --tabs 30
+import argparse
+import json
+import random
+import string
+import time
+from hashlib import sha256
+from urllib.parse import quote
+
+import database
+
+SITES = [
+    ('YouTube', 'https://www.youtube.com/watch?v={id}'),
+    ('Gmail', 'https://mail.google.com/mail/u/0/#inbox/{id}'),
+    ('GitHub', 'https://github.com/{word}/{word2}/pull/{num}'),
+    ('Stack Overflow', 'https://stackoverflow.com/questions/{num}/{word}-{word2}'),
+    ('Wikipedia', 'https://en.wikipedia.org/wiki/{Word}_{Word2}'),
+    ('Reddit', 'https://www.reddit.com/r/{word}/comments/{id}/{word2}/'),
+    ('Google Docs', 'https://docs.google.com/document/d/{long_id}/edit'),
+    ('News', 'https://www.nytimes.com/2025/02/09/{word}/{word2}-{word}.html'),
+]
+WORDS = ['habit', 'focus', 'python', 'music', 'running', 'sleep', 'budget', 'recipe',
+         'travel', 'reading', 'study', 'garden', 'chess', 'yoga', 'coffee', 'design']
+HABIT_NAMES = ['Exercise', 'Read', 'Meditate', 'Drink water', 'Journal', 'Walk',
+               'Practice guitar', 'No sugar', 'Stretch', 'Learn Spanish', 'Sleep by 11', 'Code']
+FREQUENCIES = ['Daily', 'Daily', 'Daily', 'Weekly', 'Monthly']
+
+
+def _token(rng, length):
+    return ''.join(rng.choice(string.ascii_letters + string.digits + '-_') for _ in range(length))
+
+
+def make_url(rng):
+    """
+    Return (title, url). About a third are wrapped in a Google redirect url.
+    """
+    site, pattern = rng.choice(SITES)
+    word, word2 = rng.choice(WORDS), rng.choice(WORDS)
+    url = pattern.format(id=_token(rng, 11), long_id=_token(rng, 44), num=rng.randint(10 ** 5, 10 ** 8),
+                         word=word, word2=word2, Word=word.title(), Word2=word2.title())
+    title = f"{word.title()} {word2} - {site}"
+    if rng.random() < 0.35:
+        url = ('https://www.google.com/url?sa=t&source=web&rct=j&opi=89978449&url='
+               + quote(url, safe='') + f"&ved={_token(rng, 40)}&usg={_token(rng, 28)}")
+    return title, url
+
+
+def make_tab_payload(username, count, rng, first_tab_id=1, min_duration=5.0, max_duration=7200.0):
+    """
+    A /store_tabs payload with `count` tabs for one user.
+    """
+    tabs = []
+    for i in range(count):
+        title, url = make_url(rng)
+        tabs.append({'tab_id': first_tab_id + i, 'username': username, 'title': title, 'url': url,
+                     'duration': round(rng.uniform(min_duration, max_duration), 3)})
+    return tabs
+
+
+def advance_payload(tabs, rng, seconds=60.0, change_rate=0.1):
+    """
+    The same tabs a little later: durations grow and some tabs navigate elsewhere.
+    """
+    newer = []
+    for tab in tabs:
+        tab = dict(tab, duration=round(tab['duration'] + seconds, 3))
+        if rng.random() < change_rate:
+            tab['title'], tab['url'] = make_url(rng)
+        newer.append(tab)
+    return newer
+
+
+def username_for(i):
+    return f"user{i:06d}"
+
+
+def generate_dataset(db_path, users=100, habits=5, tabs=20, seed=42):
+    """
+    Fill `db_path` with synthetic users, habits (with check-in history) and
+    tab reports. Returns a summary dict.
+    """
+    rng = random.Random(seed)
+    database.configure_database(db_path)
+    database.ensure_schema()
+    password = sha256(b'password').hexdigest()
+    started = time.perf_counter()
+    with database.transaction() as conn:
+        conn.executemany(
+            '''INSERT OR IGNORE INTO users (username, password, login_count, display_name, bio)
+               VALUES (?, ?, 0, ?, ?)''',
+            [(username_for(i), password, username_for(i), "No bio yet.") for i in range(users)]
+        )
+        habit_rows = []
+        for i in range(users):
+            for name in rng.sample(HABIT_NAMES, min(habits, len(HABIT_NAMES))) + \
+                    [f"Habit {n}" for n in range(len(HABIT_NAMES), habits)]:
+                streak = rng.randint(0, 60)
+                days_ago = rng.randint(0, 3)
+                habit_rows.append((username_for(i), name, rng.choice(FREQUENCIES),
+                                   f"-{streak + days_ago + 1} days", f"-{days_ago} days", streak))
+        conn.executemany(
+            '''INSERT INTO habits (username, habit_name, target_frequency, created_date,
+                                   last_tracked, streak)
+               VALUES (?, ?, ?, DATE('now', ?), DATE('now', ?), ?)''',
+            habit_rows
+        )
+        conn.execute('''UPDATE habits SET next_due = CASE target_frequency
+                            WHEN 'Weekly' THEN DATE(last_tracked, '+7 days')
+                            WHEN 'Monthly' THEN DATE(last_tracked, '+1 month')
+                            ELSE DATE(last_tracked, '+1 day') END
+                        WHERE next_due IS NULL''')
+        conn.execute('''INSERT INTO habit_checkins (habit_id, username, kind, amount, checked_at)
+                        SELECT id, username, 'done', streak, last_tracked FROM habits
+                        WHERE streak > 0 AND id NOT IN (SELECT habit_id FROM habit_checkins)''')
+    for i in range(users):
+        database.update_tabs_table(make_tab_payload(username_for(i), tabs, rng))
+    return {
+        'db': db_path,
+        'users': users,
+        'habits_per_user': habits,
+        'tabs_per_user': tabs,
+        'seed': seed,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Good Habits database.")
+    parser.add_argument('--db', required=True, help="database file to create or extend")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--habits', type=int, default=5, help="habits per user")
+    parser.add_argument('--tabs', type=int, default=20, help="tabs per user")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    print(json.dumps(generate_dataset(args.db, args.users, args.habits, args.tabs, args.seed)))
+
+
+if __name__ == '__main__':
+    main()
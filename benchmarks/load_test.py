@@ -0,0 +1,142 @@
+# benchmarks/load_test.py
+# End-to-end load test: many simulated browser extensions POST tab reports
+# to the API while a local stub stands in for OpenAI. Starts serve.py on a
+# temporary database unless --url points at a running server.
+#
+#   python -m benchmarks.load_test --clients 50 --requests 40 --workers 2
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.common import environment, summarize, write_report
+from benchmarks.generate_data import advance_payload, make_tab_payload, username_for
+from stub_openai import start_stub_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for_server(host, port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=1)
+            conn.request('OPTIONS', '/store_tabs')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on {host}:{port} did not come up")
+
+
+def start_server(port, workers, threads, db_path, openai_base_url):
+    env = dict(os.environ, GOOD_HABITS_DB=db_path, OPENAI_BASE_URL=openai_base_url,
+               OPENAI_API_KEY='stub')
+    return subprocess.Popen(
+        [sys.executable, 'serve.py', '--port', str(port), '--workers', str(workers),
+         '--threads', str(threads)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def run_client(index, host, port, requests, tabs, interval, results, seed):
+    """
+    One simulated extension: an initial report, then the same tabs a bit later, repeatedly.
+    """
+    rng = random.Random(seed + index)
+    payload = make_tab_payload(username_for(index), tabs, rng)
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    latencies, statuses = [], {}
+    for _ in range(requests):
+        body = json.dumps(payload).encode()
+        t0 = time.perf_counter()
+        try:
+            conn.request('POST', '/store_tabs', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            status = 'error'
+        latencies.append(time.perf_counter() - t0)
+        statuses[status] = statuses.get(status, 0) + 1
+        payload = advance_payload(payload, rng, seconds=interval or 1.0)
+        if interval:
+            time.sleep(interval)
+    conn.close()
+    results[index] = (latencies, statuses)
+
+
+def run_load(host, port, clients, requests, tabs, interval, seed):
+    results = {}
+    threads = [threading.Thread(target=run_client,
+                                args=(i, host, port, requests, tabs, interval, results, seed))
+               for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies, statuses = [], {}
+    for client_latencies, client_statuses in results.values():
+        latencies.extend(client_latencies)
+        for status, count in client_statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    return summarize('POST /store_tabs', latencies, elapsed, clients=clients, tabs=tabs,
+                     statuses=statuses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the /store_tabs endpoint.")
+    parser.add_argument('--url', help="existing server, e.g. http://127.0.0.1:5000 (default: start one)")
+    parser.add_argument('--port', type=int, default=5099, help="port for the server this script starts")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes for the started server")
+    parser.add_argument('--threads', type=int, default=8, help="threads per worker for the started server")
+    parser.add_argument('--clients', type=int, default=50, help="simulated extensions")
+    parser.add_argument('--requests', type=int, default=40, help="reports per extension")
+    parser.add_argument('--tabs', type=int, default=20, help="open tabs per extension")
+    parser.add_argument('--interval', type=float, default=0.0, help="seconds between reports per extension")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    stub = start_stub_server()
+    server = None
+    if args.url:
+        parts = urlsplit(args.url)
+        host, port = parts.hostname, parts.port or 80
+    else:
+        host, port = '127.0.0.1', args.port
+        db_path = os.path.join(tempfile.mkdtemp(prefix='good-habits-load-'), 'load.db')
+        server = start_server(port, args.workers, args.threads, db_path,
+                              f"http://127.0.0.1:{stub.server_port}/v1")
+    try:
+        wait_for_server(host, port)
+        result = run_load(host, port, args.clients, args.requests, args.tabs, args.interval, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+        stub.shutdown()
+    report = {
+        'suite': 'load',
+        'environment': environment(),
+        'server': {'url': args.url or f"http://{host}:{port}", 'workers': args.workers,
+                   'threads': args.threads},
+        'results': [result],
+    }
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import openai
+
+from analytics import get_tab_stats
+from context_cache import context_cache
+from database import get_connection, get_data_version, transaction
+from habit_functions import get_user_habits
+from metrics import count_llm_cache, instrument_db, observe_first_token, observe_llm
+from prompt_builder import (
+    HABIT_CONTEXT_TOKENS, QUERY_TOKENS, TAB_CONTEXT_TOKENS, collapse_urls, fit_lines, truncate_to_budget
+)
+
+# --- Settings ---
+
+MODEL = "gpt-4o-mini"
+# Cached answers older than this many seconds are ignored.
+LLM_CACHE_TTL = int(os.environ.get('GOOD_HABITS_LLM_CACHE_TTL', str(24 * 3600)))
+# Least recently used answers are evicted beyond this many entries.
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('GOOD_HABITS_LLM_CACHE_MAX_ENTRIES', '1000'))
+# Set GOOD_HABITS_LLM_CACHE=0 to always call the API.
+LLM_CACHE_ENABLED = os.environ.get('GOOD_HABITS_LLM_CACHE', '1') != '0'
+# A hit only refreshes last_used when it is older than this, to keep reads cheap.
+_LAST_USED_RESOLUTION = 60
+
+# --- OpenAI Client ---
+
+def load_api_key(filename="config.json"):
+    with open(filename, "r") as file:
+        data = json.load(file)
+        if not data:
+            raise ValueError("API key not found in JSON file.")
+        print("API key loaded successfully.")
+        return data.get("OPENAI_API_KEY", "").strip()
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Return the process-wide OpenAI client, creating it on first use.
+    The client keeps its HTTP connection pool between calls.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # OPENAI_API_KEY and OPENAI_BASE_URL in the environment take
+                # precedence, e.g. to point at stub_openai.py.
+                api_key = os.environ.get('OPENAI_API_KEY') or load_api_key()
+                _client = openai.OpenAI(api_key=api_key)
+    return _client
+
+# --- Response Cache ---
+
+def get_cache_key(model, system_prompt, query):
+    payload = json.dumps([model, system_prompt, query], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@instrument_db
+def get_cached_response(key):
+    """
+    Return the cached response for `key`, or None if missing or expired.
+    """
+    now = int(time.time())
+    conn = get_connection()
+    row = conn.execute('SELECT response, created_at, last_used FROM llm_cache WHERE key = ?',
+                       (key,)).fetchone()
+    if row is None or row[1] < now - LLM_CACHE_TTL:
+        return None
+    if row[2] < now - _LAST_USED_RESOLUTION:
+        conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+    return row[0]
+
+@instrument_db
+def store_cached_response(key, model, response):
+    """
+    Save a response and evict expired and least recently used entries.
+    """
+    now = int(time.time())
+    with transaction() as conn:
+        conn.execute(
+            '''INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, last_used)
+               VALUES (?, ?, ?, ?, ?)''',
+            (key, model, response, now, now)
+        )
+        conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - LLM_CACHE_TTL,))
+        conn.execute(
+            '''DELETE FROM llm_cache WHERE key IN (
+                   SELECT key FROM llm_cache ORDER BY last_used ASC
+                   LIMIT MAX((SELECT COUNT(*) FROM llm_cache) - ?, 0))''',
+            (LLM_CACHE_MAX_ENTRIES,)
+        )
+
+# --- Context Functions ---
+
+def get_habit_context(username):
+    """
+    Describe the user's habits for the system prompt.
+    Rebuilt only when the user's habits have changed.
+    """
+    # It mentions what is due today, so it also expires at each day boundary.
+    name = f"habit_context:{int(time.time()) // 86400}"
+    return context_cache.get(name, username, _build_habit_context, kind='habits')
+
+def get_tab_stat_context(username):
+    """
+    Describe the user's recent browsing for the system prompt.
+    Rebuilt only when the user's tab data has changed.
+    """
+    # The summary covers a trailing week, so it also expires at each day boundary.
+    name = f"tab_context:{int(time.time()) // 86400}"
+    return context_cache.get(name, username, _build_tab_stat_context, kind='tabs')
+
+def get_context_version(username):
+    """
+    Version of everything the prompt context is built from; changes whenever it would.
+    """
+    return get_data_version(username)
+
+def _habit_relevance(habit, today):
+    # Streaks that break unless done today first, then other running streaks
+    # (longest first), then habits due today, then the rest.
+    due = habit[7] is not None and habit[7] <= today
+    return (not (due and habit[6] > 0), -habit[6], not due, habit[2])
+
+def _build_habit_context(username):
+    habits = get_user_habits(username)
+    if not habits:
+        return "You haven't started tracking any habits yet."
+    
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    context = []
+    for habit in sorted(habits, key=lambda habit: _habit_relevance(habit, today)):
+        name = truncate_to_budget(collapse_urls(habit[2]), 20)
+        frequency = habit[3]
+        streak = habit[6]
+        last_tracked = habit[5]
+        
+        status = f"You're maintaining a {streak}-day streak for {name} ({frequency})."
+        if streak == 0 and last_tracked:
+            status = f"You recently reset your streak for {name} ({frequency}). Time for a fresh start!"
+        elif streak == 0:
+            status = f"You've set up {name} ({frequency}) as a new habit to build."
+        if habit[7] is not None and habit[7] <= today:
+            status += " It's due today."
+            
+        context.append(status)
+    
+    active = sum(1 for habit in habits if habit[6] > 0)
+    return fit_lines(context, HABIT_CONTEXT_TOKENS, lambda dropped: (
+        f"...and {len(dropped)} more habits; {active} of all {len(habits)} have an active streak."))
+
+def _build_tab_stat_context(username):
+    stats = get_tab_stats(username, top_n=25)
+    if not stats['total_seconds']:
+        return "No tab data available."
+    lines = [f"Most browsing happens around {stats['peak_hour']:02d}:00."]
+    for domain, seconds in stats['top_domains']:
+        lines.append(f"{domain}: {seconds / 60:.1f} minutes")
+    return fit_lines(lines, TAB_CONTEXT_TOKENS, lambda dropped: f"...and {len(dropped)} other sites.",
+                     header=f"Time spent per site over the last {stats['days']} days:")
+
+# --- Chat ---
+
+# Questions asked on the user's behalf by the dashboard and pregen.py.
+TAB_ANALYSIS_QUERY = ("Based on my current tab usage stats:\n{tab_context}\nPlease provide some insights "
+                      "or suggestions in one or two sentences that encourages me to keep up with my goal.")
+ENCOURAGEMENT_QUERY = ("In one or two sentences, encourage me for today. If one of my habits is due "
+                       "today, mention it.")
+
+def build_system_prompt(username):
+    habit_context = get_habit_context(username)
+    
+    return f"""You are a supportive AI assistant who helps users build better habits and plan their days. 
+Here's the user's current habit status:
+{habit_context}
+
+Keep this context in mind when responding. If relevant to their question, provide specific advice about:
+- How to maintain their current streaks
+- How to rebuild after broken streaks
+- How to plan their day around their habits
+- How to stay motivated
+
+Be encouraging but realistic. Acknowledge their progress and setbacks naturally in conversation."""
+
+def chat_with_gpt(query, username, use_cache=True, stream=False):
+    """
+    Ask the model `query` with the user's habits as context. The query is
+    cut to the query token budget but otherwise sent as the user wrote it.
+    Identical prompts are answered from the llm_cache table unless
+    use_cache is False or caching is disabled.
+    With stream=True, returns a generator of text chunks instead of a string.
+    """
+    if stream:
+        return chat_with_gpt_stream(query, username, use_cache)
+
+    query = truncate_to_budget(query, QUERY_TOKENS)
+    system_prompt = build_system_prompt(username)
+    use_cache = use_cache and LLM_CACHE_ENABLED
+    if use_cache:
+        key = get_cache_key(MODEL, system_prompt, query)
+        cached = get_cached_response(key)
+        count_llm_cache(cached is not None)
+        if cached is not None:
+            return cached
+
+    started = time.perf_counter()
+    completion = get_client().chat.completions.create(
+        model=MODEL,
+        store=True,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query}
+        ]
+    )
+    observe_llm('complete', time.perf_counter() - started, completion.usage)
+
+    response = completion.choices[0].message.content
+    if use_cache and response:
+        store_cached_response(key, MODEL, response)
+    return response
+
+def chat_with_gpt_stream(query, username, use_cache=True):
+    """
+    Like chat_with_gpt, but yields the answer piece by piece as the model
+    produces it. A cached answer is yielded in one piece. The full answer
+    is cached once the stream has finished.
+    """
+    query = truncate_to_budget(query, QUERY_TOKENS)
+    system_prompt = build_system_prompt(username)
+    use_cache = use_cache and LLM_CACHE_ENABLED
+    if use_cache:
+        key = get_cache_key(MODEL, system_prompt, query)
+        cached = get_cached_response(key)
+        count_llm_cache(cached is not None)
+        if cached is not None:
+            yield cached
+            return
+
+    started = time.perf_counter()
+    stream = get_client().chat.completions.create(
+        model=MODEL,
+        store=True,
+        stream=True,
+        stream_options={"include_usage": True},
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query}
+        ]
+    )
+    parts = []
+    usage = None
+    for chunk in stream:
+        # The usage totals arrive in a final chunk with no choices.
+        if getattr(chunk, 'usage', None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            if not parts:
+                observe_first_token(time.perf_counter() - started)
+            parts.append(text)
+            yield text
+    observe_llm('stream', time.perf_counter() - started, usage)
+
+    response = "".join(parts)
+    if use_cache and response:
+        store_cached_response(key, MODEL, response)
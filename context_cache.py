@@ -0,0 +1,56 @@
+# context_cache.py
+# Per-user memo of values derived from a user's data, such as the habit and
+# tab summaries that go into chat prompts. Entries are tagged with the
+# user's data version (see database.get_data_version), so a write in any
+# process invalidates them without this process being told.
+import threading
+from collections import OrderedDict
+
+from database import get_data_version
+
+CONTEXT_CACHE_MAX_ENTRIES = 10000
+
+
+class ContextCache:
+    def __init__(self, max_entries=CONTEXT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, username, build, kind=None):
+        """
+        Return build(username), reusing the cached value while the user's
+        `kind` data (or all data, if kind is None) is unchanged.
+        """
+        version = get_data_version(username, kind)
+        key = (name, username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Tag with the version read before building, so a write that lands
+        # while building makes the entry stale rather than wrongly fresh.
+        value = build(username)
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, username, name=None):
+        """
+        Drop this process's entries for the user, e.g. right after it wrote.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == username]:
+                if name is None or key[0] == name:
+                    del self._entries[key]
+
+
+context_cache = ContextCache()
@@ -1,155 +1,859 @@
 # database.py
+import json
+import logging
+import os
+import socket
 import sqlite3
+import threading
 import time
+import weakref
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
 
-def create_connection():
-    conn = sqlite3.connect('user_data.db')
+from migrations import migrate
+from metrics import instrument_db, set_changes_source
+
+logger = logging.getLogger(__name__)
+
+# --- Connection Management ---
+# Every thread keeps one long-lived connection per database file instead of
+# opening and closing a new one for each statement. Connections run in
+# autocommit mode; multi-statement work goes through transaction().
+# Both use the main database unless given a shard (see Sharding below).
+# A thread's connections are closed when the thread exits, so the threads
+# Streamlit starts for each rerun and Flask for each request don't leave
+# open files behind. A thread keeps at most GOOD_HABITS_MAX_THREAD_CONNECTIONS
+# of them; with many shard files, the least recently used is closed when
+# another is needed. Each open connection holds about three file descriptors
+# (the database, its -wal and its -shm file).
+
+DB_PATH = os.environ.get('GOOD_HABITS_DB', 'user_data.db')
+BUSY_TIMEOUT_MS = int(os.environ.get('GOOD_HABITS_BUSY_TIMEOUT_MS', '5000'))
+MAX_THREAD_CONNECTIONS = int(os.environ.get('GOOD_HABITS_MAX_THREAD_CONNECTIONS', '32'))
+
+_local = threading.local()
+# Weak references only: a thread's state disappears with the thread.
+_thread_states = weakref.WeakSet()
+_thread_states_lock = threading.Lock()
+# Bumped by close_all_connections() so other threads drop their stale handles.
+_generation = 0
+
+
+def configure_database(path):
+    """
+    Point the connection layer at a different database file.
+    Connections already opened for the previous path are closed.
+    """
+    global DB_PATH
+    close_all_connections()
+    DB_PATH = path
+
+
+def _open_connection(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, check_same_thread=False)
+    # Lets retention.py return freed pages to the OS. Applies to new files
+    # right away and to existing ones after their next VACUUM.
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets the Streamlit readers and the Flask writer work side by side.
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-8000')
+    conn.execute('PRAGMA mmap_size=67108864')
     return conn
 
-def create_user_table():
-    conn = create_connection()
-    conn.execute('''CREATE TABLE IF NOT EXISTS users
-                    (username TEXT PRIMARY KEY, 
-                     password TEXT,
-                     display_name TEXT,
-                     bio TEXT,
-                     login_count INTEGER)''')
-    conn.execute('''CREATE TABLE IF NOT EXISTS habits
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     username TEXT,
-                     habit_name TEXT,
-                     target_frequency TEXT,
-                     created_date DATE,
-                     last_tracked DATE,
-                     streak INTEGER,
-                     FOREIGN KEY (username) REFERENCES users(username))''')
-    conn.commit()
-    conn.close()
-
-def create_tabs_table():
-    conn = create_connection()
-    conn.execute('''CREATE TABLE IF NOT EXISTS tabs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT,
-                        title TEXT,
-                        url TEXT,
-                        duration REAL,
-                        timestamp INTEGER,
-                        FOREIGN KEY (username) REFERENCES users(username)
-                    )''')
-    conn.commit()
-    conn.close()
 
-def update_tabs_table(tab_list):
-    if not tab_list:
-         return
-    conn = create_connection()
-    cursor = conn.cursor()
-    # Get the username from the first item and strip any extra spaces.
-    username = tab_list[0].get('username')
-    print(f"hey user: {username}")
-    if username:
-         username = username.strip()
-         cursor.execute("DELETE FROM tabs WHERE username = ?", (username,))
-    for tab in tab_list:
-         # Also strip username before inserting.
-         u = tab.get('username')
-         if u:
-             u = u.strip()
-         cursor.execute(
-             "INSERT INTO tabs (username, title, url, duration, timestamp) VALUES (?, ?, ?, ?, ?)",
-             (u, tab['title'], tab['url'], tab['duration'], int(time.time()))
-         )
-    conn.commit()
-    conn.close()
-
-def upgrade_database():
-    conn = create_connection()
+def _close_connections(connections):
+    for conn in list(connections.values()):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    connections.clear()
+
+
+class _ThreadState:
+    # One thread's connections by database path, its transaction depths and
+    # the work waiting for those transactions to commit.
+    # The finalizer holds only the connections dict, not the state, so it
+    # runs when threading.local drops the state as the thread exits.
+    def __init__(self):
+        # Least recently used first.
+        self.connections = OrderedDict()
+        # Rows changed by connections closed to make room, for _total_changes().
+        self.closed_changes = 0
+        self.tx_depths = {}
+        # path -> [(depth, callback)] to run once the outermost transaction commits
+        self.after_commit = {}
+        self.generation = _generation
+        weakref.finalize(self, _close_connections, self.connections)
+        with _thread_states_lock:
+            _thread_states.add(self)
+
+
+def _thread_state():
+    state = getattr(_local, 'state', None)
+    if state is None or state.generation != _generation:
+        state = _local.state = _ThreadState()
+    return state
+
+
+def get_connection(shard=0):
+    """
+    Return this thread's connection to the configured database, or to one
+    of its shards, opening it on first use.
+    """
+    state = _thread_state()
+    connections = state.connections
+    path = shard_path(shard)
+    conn = connections.get(path)
+    if conn is not None:
+        connections.move_to_end(path)
+        return conn
+    _make_room(state)
+    conn = connections[path] = _open_connection(path)
+    if shard:
+        _ensure_shard_schema(conn, path, shard)
+    return conn
+
+
+def _make_room(state):
+    # Close least recently used shard connections down to the limit. The main
+    # database and any connection in a transaction stay open.
+    connections = state.connections
+    idle = [path for path, conn in connections.items()
+            if path != DB_PATH and not state.tx_depths.get(path) and not conn.in_transaction]
+    for path in idle[:max(0, len(connections) + 1 - MAX_THREAD_CONNECTIONS)]:
+        conn = connections.pop(path)
+        state.closed_changes += conn.total_changes
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def _total_changes():
+    state = _thread_state()
+    return state.closed_changes + sum(conn.total_changes for conn in state.connections.values())
+
+# Lets metrics.instrument_db count the rows each helper changed.
+set_changes_source(_total_changes)
+
+# Kept for callers that still use the old name; returns the shared connection.
+create_connection = get_connection
+
+
+def close_connection():
+    """
+    Close the calling thread's connections.
+    """
+    state = getattr(_local, 'state', None)
+    if state is not None:
+        _close_connections(state.connections)
+
+
+def close_all_connections():
+    """
+    Close every connection opened by any thread, e.g. at shutdown or in tests.
+    """
+    global _generation
+    with _thread_states_lock:
+        states = list(_thread_states)
+        _generation += 1
+    for state in states:
+        _close_connections(state.connections)
+
+
+@contextmanager
+def transaction(immediate=True, shard=0):
+    """
+    Run several statements as one transaction on the thread's connection
+    to the main database, or to `shard`.
+
+        with transaction() as conn:
+            conn.execute(...)
+            conn.execute(...)
+
+    Commits on success and rolls back on error. Nested calls on the same
+    database run inside the outermost transaction as a savepoint, so a
+    caller that catches an error from one keeps the rest of its work.
+    BEGIN IMMEDIATE takes the write lock up front so writers queue on
+    busy_timeout instead of failing halfway through.
+    """
+    conn = get_connection(shard)
+    state = _thread_state()
+    depths = state.tx_depths
+    path = shard_path(shard)
+    depth = depths.get(path, 0)
+    if depth:
+        savepoint = f'nested_{depth}'
+        conn.execute(f'SAVEPOINT {savepoint}')
+        depths[path] = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            # Some errors (SQLITE_FULL, ...) have already rolled back everything.
+            if conn.in_transaction:
+                conn.execute(f'ROLLBACK TO {savepoint}')
+                conn.execute(f'RELEASE {savepoint}')
+            pending = state.after_commit.get(path, [])
+            pending[:] = [item for item in pending if item[0] <= depth]
+            raise
+        else:
+            conn.execute(f'RELEASE {savepoint}')
+        finally:
+            depths[path] = depth
+        return
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    depths[path] = 1
     try:
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA table_info(users)')
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'display_name' not in columns:
-            conn.execute('ALTER TABLE users ADD COLUMN display_name TEXT')
-            conn.execute('UPDATE users SET display_name = username')
-        if 'bio' not in columns:
-            conn.execute('ALTER TABLE users ADD COLUMN bio TEXT')
-            conn.execute('UPDATE users SET bio = ?', ("No bio yet.",))
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
         conn.commit()
-    except sqlite3.OperationalError:
-        pass
+        _run_after_commit(state.after_commit.pop(path, []))
     finally:
-        conn.close()
+        depths.pop(path, None)
+        state.after_commit.pop(path, None)
+
+def after_commit(conn, callback):
+    """
+    Call `callback()` once the transaction open on `conn` in this thread
+    commits, or right away if there is none. It is dropped if the
+    transaction, or the savepoint it was registered in, rolls back.
+    """
+    state = _thread_state()
+    path = next((path for path, open_conn in state.connections.items() if open_conn is conn), None)
+    depth = state.tx_depths.get(path, 0)
+    if not depth:
+        callback()
+        return
+    state.after_commit.setdefault(path, []).append((depth, callback))
+
+def _run_after_commit(pending):
+    # The transaction is already committed, so a failure here can't undo it.
+    for _, callback in pending:
+        try:
+            callback()
+        except Exception:
+            logger.exception("After-commit callback %r failed", callback)
+
+# --- Schema ---
+
+_migrated_paths = set()
+_migrate_lock = threading.Lock()
+
+@instrument_db
+def ensure_schema():
+    """
+    Bring the configured database up to the latest schema version.
+    Only the first call per database file in a process touches the disk.
+    """
+    if DB_PATH in _migrated_paths:
+        return
+    with _migrate_lock:
+        if DB_PATH not in _migrated_paths:
+            migrate(get_connection())
+            _migrated_paths.add(DB_PATH)
+
+def _ensure_shard_schema(conn, path, shard):
+    # Shards get the same schema as the main database. Their habit ids start
+    # at shard << SHARD_ID_BITS, so an id tells which shard holds the habit.
+    if path in _migrated_paths:
+        return
+    with _migrate_lock:
+        if path not in _migrated_paths:
+            migrate(conn)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('''INSERT INTO sqlite_sequence (name, seq)
+                                SELECT 'habits', ? WHERE NOT EXISTS
+                                    (SELECT 1 FROM sqlite_sequence WHERE name = 'habits')''',
+                             (shard << SHARD_ID_BITS,))
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            _migrated_paths.add(path)
+
+# Old entry points; the tables are now created by the migrations.
+create_user_table = ensure_schema
+create_tabs_table = ensure_schema
+upgrade_database = ensure_schema
+
+# --- Sharding ---
+# After `python shards.py split`, each user's habits, tabs and derived data
+# live in a shard file next to the main database (user_data.shard1.db, ...),
+# so writes for users on different shards don't queue on one write lock.
+# The main database stays the catalog: accounts, the shard settings and
+# user -> shard assignments, notifications, extension sync state and the
+# LLM cache. Modes:
+#   'off'       everything in the main database (the default)
+#   'hash'      a fixed number of shards, picked by a hash of the username
+#   'per-user'  one file per user, numbered in the order users first appear
+# Shard 0 is the main database. Helpers that take a username route through
+# user_shard(), helpers that take a habit id through id_shard(), and jobs
+# that span all users loop over all_shards().
+
+SHARD_ID_BITS = 32
+SHARD_MODES = ('off', 'hash', 'per-user')
+# Jobs that span all users open every shard file in turn, so 'per-user' suits
+# a modest number of users; past this many files, use 'hash' instead.
+PER_USER_MAX_FILES = int(os.environ.get('GOOD_HABITS_PER_USER_MAX_FILES', '1000'))
+# Per-user assignments cached in this process.
+MAX_CACHED_ASSIGNMENTS = 100000
+
+_shard_settings = {}
+_user_shards = {}
+
+
+def shard_path(shard, path=None):
+    path = path or DB_PATH
+    if not shard:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext or '.db'}"
+
+
+def get_shard_settings():
+    """
+    Return the catalog's (mode, shard count), read once per process.
+    """
+    settings = _shard_settings.get(DB_PATH)
+    if settings is None:
+        ensure_schema()
+        row = get_connection().execute('SELECT mode, shards FROM shard_settings').fetchone()
+        settings = _shard_settings[DB_PATH] = tuple(row) if row else ('off', 0)
+    return settings
+
+
+def user_shard(username):
+    """
+    Return the shard holding the user's data, assigning one to a new user.
+    """
+    mode, count = get_shard_settings()
+    if mode == 'off' or username is None:
+        return 0
+    username = username.strip()
+    if mode == 'hash':
+        return zlib.crc32(username.encode()) % count + 1
+    key = (DB_PATH, username)
+    shard = _user_shards.get(key)
+    if shard is None:
+        with transaction() as conn:
+            row = conn.execute('SELECT shard FROM user_shards WHERE username = ?', (username,)).fetchone()
+            if row is None:
+                row = conn.execute(
+                    '''INSERT INTO user_shards (username, shard)
+                       SELECT ?, coalesce(MAX(shard), 0) + 1 FROM user_shards
+                       RETURNING shard''',
+                    (username,)
+                ).fetchone()
+                if row[0] > PER_USER_MAX_FILES:
+                    logger.warning("%d per-user shard files exceed GOOD_HABITS_PER_USER_MAX_FILES=%d;"
+                                   " consider hash sharding", row[0], PER_USER_MAX_FILES)
+        if len(_user_shards) >= MAX_CACHED_ASSIGNMENTS:
+            _user_shards.clear()
+        shard = _user_shards[key] = row[0]
+    return shard
+
 
+def id_shard(row_id):
+    return int(row_id) >> SHARD_ID_BITS
+
+
+def all_shards():
+    """
+    Return every shard that may hold user data.
+    """
+    mode, count = get_shard_settings()
+    if mode == 'off':
+        return [0]
+    if mode == 'hash':
+        return list(range(1, count + 1))
+    return [row[0] for row in get_connection().execute('SELECT shard FROM user_shards ORDER BY shard')]
+
+
+def user_connection(username):
+    return get_connection(user_shard(username))
+
+
+def user_transaction(username):
+    return transaction(shard=user_shard(username))
+
+
+def group_users_by_shard(usernames):
+    """
+    Return {shard: [username, ...]} for the given usernames.
+    """
+    shards = {}
+    for username in usernames:
+        shards.setdefault(user_shard(username), []).append(username)
+    return shards
+
+# --- Data Versions ---
+# Every write to a user's habits or tabs bumps a counter for that user, so
+# caches in any process can tell whether what they hold is still current.
+
+DATA_KINDS = ('habits', 'tabs')
+
+def bump_data_version(conn, username, kind):
+    """
+    Record that the user's `kind` data ('habits' or 'tabs') changed.
+    Call inside the transaction that made the change.
+    """
+    if kind not in DATA_KINDS:
+        raise ValueError(f"Unknown data kind: {kind}")
+    conn.execute(
+        f'''INSERT INTO data_versions (username, {kind}_version) VALUES (?, 1)
+            ON CONFLICT (username) DO UPDATE SET {kind}_version = {kind}_version + 1''',
+        (username,)
+    )
+
+@instrument_db
+def get_data_version(username, kind=None):
+    """
+    Return a number that grows whenever the user's data changes.
+    With `kind`, only changes to that kind of data count.
+    """
+    conn = user_connection(username)
+    row = conn.execute('SELECT habits_version, tabs_version FROM data_versions WHERE username = ?',
+                       (username,)).fetchone()
+    if row is None:
+        return 0
+    if kind is None:
+        return row[0] + row[1]
+    return row[DATA_KINDS.index(kind)]
+
+# --- Notifications ---
+# Messages for the extension (generated messages, streak milestones), pushed
+# to connected clients by notifications.py. They live in the main database,
+# so their ids give one order across shards. Without shards a row is written
+# in the same transaction as the change it announces; with shards it is
+# written right after the shard transaction commits, so a change that rolls
+# back announces nothing (and a crash in between loses the notification).
+
+def add_notification(conn, username, kind, message, **fields):
+    """
+    Queue a notification for the user. Call inside the transaction that
+    made the change it describes.
+    """
+    payload = json.dumps(dict(fields, kind=kind, message=message), ensure_ascii=False)
+    row = (username, kind, payload, int(time.time()))
+    if get_shard_settings()[0] != 'off':
+        after_commit(conn, lambda: _insert_notification(get_connection(), row))
+    else:
+        _insert_notification(conn, row)
+
+def _insert_notification(conn, row):
+    conn.execute('INSERT INTO notifications (username, kind, payload, created_at) VALUES (?, ?, ?, ?)', row)
+
+@instrument_db
+def get_notifications(username, after_id=0, limit=100):
+    """
+    Return the user's notifications with an id above `after_id`, oldest
+    first, as [(id, kind, payload_json, created_at)].
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        '''SELECT id, kind, payload, created_at FROM notifications
+           WHERE username = ? AND id > ? ORDER BY id LIMIT ?''',
+        (username.strip(), after_id, limit)
+    )
+    return cursor.fetchall()
+
+@instrument_db
+def get_all_notifications_since(after_id, limit=1000):
+    """
+    Return everyone's notifications with an id above `after_id`, oldest
+    first, as [(id, username, kind, payload_json, created_at)].
+    """
+    conn = get_connection()
+    cursor = conn.execute(
+        '''SELECT id, username, kind, payload, created_at FROM notifications
+           WHERE id > ? ORDER BY id LIMIT ?''',
+        (after_id, limit)
+    )
+    return cursor.fetchall()
+
+@instrument_db
+def get_last_notification_id():
+    row = get_connection().execute('SELECT MAX(id) FROM notifications').fetchone()
+    return row[0] or 0
+
+# A row is rewritten when its title or url changes, or when the reported
+# duration has moved by at least this many seconds. Bursts of extension
+# events therefore leave unchanged rows alone.
+TAB_DURATION_RESOLUTION = float(os.environ.get('GOOD_HABITS_TAB_DURATION_RESOLUTION', '30'))
+
+HOUR = 3600
+DAY = 86400
+
+def unwrap_redirect(url):
+    """
+    Return the destination of a Google redirect link
+    (https://www.google.com/url?...&url=https://...), or `url` unchanged.
+    """
+    parts = urlsplit(url or '')
+    if parts.path == '/url' and 'google' in (parts.hostname or '').split('.'):
+        params = parse_qs(parts.query)
+        for name in ('url', 'q'):
+            target = params.get(name, [''])[0]
+            if target.startswith(('http://', 'https://')):
+                return target
+    return url
+
+def get_domain(url):
+    """
+    Return the host part of a url without a leading "www.", e.g. "youtube.com".
+    Google redirect links count as the site they point to.
+    """
+    host = urlsplit(unwrap_redirect(url or '')).hostname or ''
+    if host.startswith('www.'):
+        host = host[4:]
+    return host or 'unknown'
+
+def _split_into_buckets(start, end, size):
+    """
+    Cut the interval [start, end) on multiples of size.
+    Returns a list of (bucket_start, seconds) pairs.
+    """
+    pieces = []
+    while start < end:
+        bucket = int(start // size * size)
+        stop = min(end, bucket + size)
+        pieces.append((bucket, stop - start))
+        start = stop
+    return pieces
+
+def _add_tab_usage(conn, username, usage, now):
+    """
+    Fold (domain, seconds) pairs that ended at `now` into the hourly and daily rollups.
+    """
+    for table, column, size in (('tab_usage_hourly', 'hour_start', HOUR),
+                                ('tab_usage_daily', 'day_start', DAY)):
+        totals = {}
+        for domain, seconds in usage:
+            for bucket, part in _split_into_buckets(now - seconds, now, size):
+                totals[(bucket, domain)] = totals.get((bucket, domain), 0) + part
+        conn.executemany(
+            f'''INSERT INTO {table} (username, {column}, domain, seconds) VALUES (?, ?, ?, ?)
+                ON CONFLICT (username, {column}, domain) DO UPDATE SET
+                    seconds = seconds + excluded.seconds''',
+            [(username, bucket, domain, seconds) for (bucket, domain), seconds in totals.items()]
+        )
+
+def _sync_user_tabs(conn, username, tabs, now, closed=None):
+    """
+    Bring one user's stored tabs in line with the tabs reported by the extension.
+    Changes are appended to tab_events and the time added since the last
+    sync is folded into the usage rollups.
+
+    By default `tabs` is the user's full set of open tabs. With `closed`, it is
+    a delta: `tabs` holds only opened or changed tabs, `closed` maps the ids of
+    closed tabs to their final duration (or None), and other rows are left alone.
+    """
+    delta = closed is not None
+    if not delta and any(tab.get('tab_id') is None for tab in tabs):
+        # Older extension builds don't send tab ids, so replace the snapshot.
+        # Without a stable identity there is no history to record.
+        conn.execute("DELETE FROM tabs WHERE username = ?", (username,))
+        conn.executemany(
+            "INSERT INTO tabs (username, title, url, duration, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(username, tab['title'], tab['url'], tab['duration'], now) for tab in tabs]
+        )
+        bump_data_version(conn, username, 'tabs')
+        return
+    reported = {int(tab['tab_id']): tab for tab in tabs}
+    if delta:
+        # Only the rows named in the delta are read.
+        stored = {row[0]: row for row in conn.execute(
+            '''SELECT tab_id, title, url, duration FROM tabs
+               WHERE username = ? AND tab_id IN (SELECT value FROM json_each(?))''',
+            (username, json.dumps(list(reported) + list(closed))))}
+    else:
+        stored = {row[0]: row for row in conn.execute(
+            'SELECT tab_id, title, url, duration FROM tabs WHERE username = ?', (username,))}
+
+    changed, events, usage = [], [], []
+    for tab_id, tab in reported.items():
+        title, url, duration = tab['title'], tab['url'], tab['duration'] or 0
+        old = stored.get(tab_id)
+        if old is None:
+            event, added = 'opened', duration
+        elif old[1] != title or old[2] != url:
+            event, added = 'updated', duration - (old[3] or 0)
+        elif abs(duration - (old[3] or 0)) >= TAB_DURATION_RESOLUTION:
+            event, added = None, duration - (old[3] or 0)
+        else:
+            continue
+        changed.append((username, tab_id, title, url, duration, now))
+        if event:
+            events.append((username, tab_id, event, title, url, get_domain(url), duration, now))
+        if added > 0:
+            usage.append((get_domain(url), added))
+    if delta:
+        closed_ids = [tab_id for tab_id in closed if tab_id in stored and tab_id not in reported]
+    else:
+        closed_ids = [tab_id for tab_id in stored if tab_id is None or tab_id not in reported]
+    for tab_id in closed_ids:
+        if tab_id is not None:
+            _, title, url, duration = stored[tab_id]
+            final = closed.get(tab_id) if delta else None
+            if final is not None and final > (duration or 0):
+                usage.append((get_domain(url), final - (duration or 0)))
+                duration = final
+            events.append((username, tab_id, 'closed', title, url, get_domain(url), duration, now))
+
+    conn.executemany(
+        '''INSERT INTO tabs (username, tab_id, title, url, duration, timestamp)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (username, tab_id) DO UPDATE SET
+               title = excluded.title,
+               url = excluded.url,
+               duration = excluded.duration,
+               timestamp = excluded.timestamp''',
+        changed
+    )
+    if closed_ids:
+        conn.executemany('DELETE FROM tabs WHERE username = ? AND tab_id IS ?',
+                         [(username, tab_id) for tab_id in closed_ids])
+    conn.executemany(
+        '''INSERT INTO tab_events
+           (username, tab_id, event, title, url, domain, duration, timestamp)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        events
+    )
+    _add_tab_usage(conn, username, usage, now)
+    if changed or closed_ids:
+        bump_data_version(conn, username, 'tabs')
+
+def group_tabs_by_user(tab_list):
+    """
+    Split an extension payload into {username: [tab, ...]}.
+    Tabs without a username can't be attributed and are left out.
+    """
+    tabs_by_user = {}
+    for tab in tab_list or []:
+        username = (tab.get('username') or '').strip()
+        if username:
+            tabs_by_user.setdefault(username, []).append(tab)
+    return tabs_by_user
+
+@instrument_db
+def update_tabs_table(tab_list):
+    """
+    Store the tab list sent by the extension.
+    Tabs are grouped by username so each user's rows are synced on their own;
+    tabs without a username can't be attributed and are skipped.
+    Everything on one shard is written in one transaction.
+    """
+    tabs_by_user = group_tabs_by_user(tab_list)
+    now = int(time.time())
+    for shard, usernames in group_users_by_shard(tabs_by_user).items():
+        with transaction(shard=shard) as conn:
+            for username in usernames:
+                _sync_user_tabs(conn, username, tabs_by_user[username], now)
+
+@instrument_db
+def sync_user_tabs(username, tabs, closed=None):
+    """
+    Store one user's tabs: a full snapshot, or a delta when `closed` is
+    given (see _sync_user_tabs).
+    """
+    with user_transaction(username) as conn:
+        _sync_user_tabs(conn, username, tabs, int(time.time()), closed)
+
+# --- Extension Sync Sequence ---
+# Extensions that use the delta protocol number their reports per client.
+# A report's number is claimed here when it is accepted, atomically, so any
+# worker process can accept the client's next report; a delta that does not
+# follow the last number is refused and the client sends a full snapshot.
+
+@instrument_db
+def claim_sync_seq(client_id, seq, full=False):
+    """
+    Accept report `seq` from `client_id`. A delta is accepted only if it
+    directly follows the last accepted report; a full snapshot always is.
+    Returns False when the client must resync.
+    """
+    now = int(time.time())
+    conn = get_connection()
+    if full:
+        conn.execute(
+            '''INSERT INTO sync_clients (client_id, last_seq, full_seq, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (client_id) DO UPDATE SET
+                   last_seq = MAX(last_seq, excluded.last_seq),
+                   full_seq = MAX(full_seq, excluded.full_seq),
+                   updated_at = excluded.updated_at''',
+            (client_id, seq, seq, now)
+        )
+        return True
+    cursor = conn.execute(
+        'UPDATE sync_clients SET last_seq = ?, updated_at = ? WHERE client_id = ? AND last_seq = ?',
+        (seq, now, client_id, seq - 1)
+    )
+    return cursor.rowcount == 1
+
+@instrument_db
+def get_full_seqs(client_ids):
+    """
+    Return {client_id: sequence number of its latest full snapshot}.
+    """
+    rows = get_connection().execute(
+        '''SELECT client_id, full_seq FROM sync_clients
+           WHERE client_id IN (SELECT value FROM json_each(?))''',
+        (json.dumps(list(client_ids)),)
+    )
+    return dict(rows.fetchall())
+
+@instrument_db
+def reset_sync_seqs(seqs):
+    """
+    Make the clients in {client_id: seq} resync because report `seq` was
+    lost, unless a later full snapshot has already replaced it.
+    """
+    with transaction() as conn:
+        conn.executemany(
+            'UPDATE sync_clients SET last_seq = -1 WHERE client_id = ? AND full_seq <= ?',
+            list(seqs.items())
+        )
+
+# --- Leases ---
+# With several worker processes, work that must happen once (a periodic job
+# run, generating one user's messages) is claimed here first. A lease is
+# held by one thread of one process until it is released or expires.
+
+def _lease_owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+@instrument_db
+def acquire_lease(name, seconds, shard=0):
+    """
+    Claim `name` for `seconds` unless another holder's lease is still live.
+    Returns True if this thread now holds it.
+    """
+    now = time.time()
+    cursor = get_connection(shard).execute(
+        '''INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+           ON CONFLICT (name) DO UPDATE SET
+               owner = excluded.owner,
+               expires_at = excluded.expires_at
+           WHERE leases.expires_at <= ?''',
+        (name, _lease_owner(), now + seconds, now)
+    )
+    return cursor.rowcount == 1
+
+@instrument_db
+def release_lease(name, shard=0):
+    """
+    Give up a lease this thread holds, so others can take it straight away.
+    """
+    get_connection(shard).execute('DELETE FROM leases WHERE name = ? AND owner = ?',
+                                  (name, _lease_owner()))
+
+@instrument_db
 def store_user(username, password):
-    conn = create_connection()
+    conn = get_connection()
     conn.execute('''INSERT INTO users 
                     (username, password, login_count, display_name, bio) 
                     VALUES (?, ?, ?, ?, ?)''', 
                  (username, password, 0, username, "No bio yet."))
-    conn.commit()
-    conn.close()
 
+@instrument_db
 def get_user(username):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username=?', (username,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    conn = get_connection()
+    cursor = conn.execute('SELECT * FROM users WHERE username=?', (username,))
+    return cursor.fetchone()
 
+@instrument_db
 def update_user_stats(username):
-    conn = create_connection()
+    conn = get_connection()
     conn.execute('UPDATE users SET login_count = login_count + 1 WHERE username=?', (username,))
-    conn.commit()
-    conn.close()
 
+@instrument_db
 def update_user_profile(username, display_name=None, bio=None):
-    conn = create_connection()
-    if display_name is not None:
-        conn.execute('UPDATE users SET display_name = ? WHERE username = ?', 
-                    (display_name, username))
-    if bio is not None:
-        conn.execute('UPDATE users SET bio = ? WHERE username = ?', 
-                    (bio, username))
-    conn.commit()
-    conn.close()
-
-def update_tabs_table(tab_list):
-    conn = create_connection()
-    cursor = conn.cursor()
-    # For simplicity, clear the old data before inserting the new tab stats.
-    cursor.execute("DELETE FROM tabs")
-    for tab in tab_list:
-        cursor.execute("INSERT INTO tabs (title, url, duration, timestamp) VALUES (?, ?, ?, ?)",
-                       (tab['title'], tab['url'], tab['duration'], int(time.time())))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        if display_name is not None:
+            conn.execute('UPDATE users SET display_name = ? WHERE username = ?', 
+                        (display_name, username))
+        if bio is not None:
+            conn.execute('UPDATE users SET bio = ? WHERE username = ?', 
+                        (bio, username))
 
+@instrument_db
 def get_tabs(username):
-    conn = create_connection()
-    cursor = conn.cursor()
+    conn = user_connection(username)
     username = username.strip()  # Ensure no extra spaces.
-    print(f"Querying tabs for username: {username}")
-    cursor.execute("SELECT title, url, duration, timestamp FROM tabs WHERE username=?", (username,))
+    logger.debug("Querying tabs for username: %s", username)
+    cursor = conn.execute("SELECT title, url, duration, timestamp FROM tabs WHERE username=?", (username,))
     rows = cursor.fetchall()
-    print(f"Found {len(rows)} tab rows.")
-    conn.close()
+    logger.debug("Found %d tab rows.", len(rows))
     return rows
 
-# debugging purpose
+@instrument_db
+def get_tab_usage(username, since=None, until=None, hourly=False):
+    """
+    Return [(domain, seconds)] for the user between the `since` and `until`
+    unix timestamps, most used domain first. Reads the daily rollup, or the
+    hourly one when finer boundaries are needed.
+    """
+    table, column, size = (('tab_usage_hourly', 'hour_start', HOUR) if hourly
+                           else ('tab_usage_daily', 'day_start', DAY))
+    # Include the bucket that `since` falls into.
+    since = (since or 0) // size * size
+    conn = user_connection(username)
+    cursor = conn.execute(
+        f'''SELECT domain, SUM(seconds) AS total FROM {table}
+            WHERE username = ? AND {column} >= ? AND {column} < ?
+            GROUP BY domain ORDER BY total DESC''',
+        (username.strip(), since, until if until is not None else 2 ** 62)
+    )
+    return cursor.fetchall()
+
+@instrument_db
+def get_tab_usage_hourly(username, since=None, until=None):
+    """
+    Return the user's raw hourly rollup rows [(hour_start, domain, seconds)]
+    between the `since` and `until` unix timestamps, oldest first.
+    """
+    since = (since or 0) // HOUR * HOUR
+    conn = user_connection(username)
+    cursor = conn.execute(
+        '''SELECT hour_start, domain, seconds FROM tab_usage_hourly
+           WHERE username = ? AND hour_start >= ? AND hour_start < ?
+           ORDER BY hour_start''',
+        (username.strip(), since, until if until is not None else 2 ** 62)
+    )
+    return cursor.fetchall()
+
+@instrument_db
+def get_tab_events(username, since=None, limit=100):
+    """
+    Return the user's most recent tab events, newest first.
+    """
+    conn = user_connection(username)
+    cursor = conn.execute(
+        '''SELECT event, title, url, domain, duration, timestamp FROM tab_events
+           WHERE username = ? AND timestamp >= ?
+           ORDER BY timestamp DESC, id DESC LIMIT ?''',
+        (username.strip(), since or 0, limit)
+    )
+    return cursor.fetchall()
+
+# debugging purpose only; not called from the app
 def print_all_content():
     """Connects to an SQLite database and prints all content from the specified table."""
     try:
-        conn = create_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(f"SELECT * FROM {'tabs'}")
-        rows = cursor.fetchall()
-        
-        for row in rows:
+        conn = get_connection()
+        cursor = conn.execute(f"SELECT * FROM {'tabs'}")
+        for row in cursor:
             print(row)
-        
-        conn.close()
     except sqlite3.Error as e:
         print(f"Error: {e}")
@@ -0,0 +1,335 @@
+# export_data.py
+# Bulk export of users, habits and tabs for offline analysis, and the
+# matching import for restoring a backup or seeding benchmark data.
+#
+#   python export_data.py export --out backup/                   # every table, Parquet
+#   python export_data.py export --out backup/ --format csv --user alice --since 2025-02-01
+#   python export_data.py import backup/                         # restore
+#   python export_data.py import backup/ --new-ids               # add to a database that has data
+#
+# Rows are read in chunks of EXPORT_CHUNK_ROWS with fetchmany() and each
+# chunk is written out (one Parquet row group, or a slice of a gzip CSV)
+# before the next is read, so memory use doesn't grow with the table.
+# Parquet needs pyarrow; without it, or with --format csv, files are .csv.gz,
+# with NULL written as \N so it stays distinct from an empty string.
+# Password hashes are left out unless --with-passwords is given.
+import argparse
+import csv
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from database import (
+    all_shards, bump_data_version, ensure_schema, get_connection, id_shard,
+    transaction, user_shard
+)
+from habit_functions import STREAKS_FROM_CHECKINS_SQL
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+EXPORT_CHUNK_ROWS = int(os.environ.get('GOOD_HABITS_EXPORT_CHUNK_ROWS', '10000'))
+
+# Exported columns and their types, in file order.
+TABLES = {
+    'users': [('username', 'string'), ('password', 'string'), ('display_name', 'string'),
+              ('bio', 'string'), ('login_count', 'int64')],
+    'habits': [('id', 'int64'), ('username', 'string'), ('habit_name', 'string'),
+               ('target_frequency', 'string'), ('created_date', 'string'), ('last_tracked', 'string'),
+               ('streak', 'int64'), ('next_due', 'string')],
+    'tabs': [('id', 'int64'), ('username', 'string'), ('tab_id', 'int64'), ('title', 'string'),
+             ('url', 'string'), ('duration', 'float64'), ('timestamp', 'int64')],
+}
+# The column the time range applies to, and whether it holds dates or unix times.
+TIME_COLUMNS = {'habits': ('created_date', 'date'), 'tabs': ('timestamp', 'unix')}
+# Username columns compared after stripping, like the extension's usernames.
+STRIPPED_USERNAMES = {'tabs'}
+# How a NULL is written in CSV files.
+CSV_NULL = '\\N'
+
+
+def _arrow_schema(columns):
+    types = {'string': pa.string(), 'int64': pa.int64(), 'float64': pa.float64()}
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+def _query(table, columns, username=None, since=None, until=None):
+    where, params = ['1'], []
+    if username is not None:
+        where.append('username = ?')
+        params.append(username.strip() if table in STRIPPED_USERNAMES else username)
+    time_column = TIME_COLUMNS.get(table)
+    for bound, op in ((since, '>='), (until, '<')):
+        if bound is None or time_column is None:
+            continue
+        column, kind = time_column
+        where.append(f"{column} {op} DATE(?, 'unixepoch')" if kind == 'date' else f'{column} {op} ?')
+        params.append(int(bound))
+    names = ', '.join(name for name, _ in columns)
+    return f"SELECT {names} FROM {table} WHERE {' AND '.join(where)} ORDER BY rowid", params
+
+
+def _chunks(table, columns, username=None, since=None, until=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # Yield lists of rows, reading one chunk at a time from each database that holds the table.
+    if table == 'users':
+        shards = [0]
+    elif username is not None:
+        shards = [user_shard(username)]
+    else:
+        shards = all_shards()
+    sql, params = _query(table, columns, username, since, until)
+    for shard in shards:
+        cursor = get_connection(shard).execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield rows
+
+
+def export_table(table, out_dir, fmt='parquet', username=None, since=None, until=None,
+                 with_passwords=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Stream one table to `out_dir`. Returns (path, rows written).
+    """
+    columns = TABLES[table]
+    if table == 'users' and not with_passwords:
+        columns = [column for column in columns if column[0] != 'password']
+    chunks = _chunks(table, columns, username, since, until, chunk_rows)
+    names = [name for name, _ in columns]
+    written = 0
+    if fmt == 'parquet':
+        path = os.path.join(out_dir, f'{table}.parquet')
+        schema = _arrow_schema(columns)
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            for rows in chunks:
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                written += len(rows)
+    else:
+        path = os.path.join(out_dir, f'{table}.csv.gz')
+        with gzip.open(path, 'wt', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for rows in chunks:
+                writer.writerows([CSV_NULL if value is None else value for value in row] for row in rows)
+                written += len(rows)
+    return path, written
+
+
+def export_data(out_dir, tables=tuple(TABLES), fmt=None, username=None, since=None, until=None,
+                with_passwords=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Export `tables` to files in `out_dir`. Returns {table: (path, rows)}.
+    """
+    ensure_schema()
+    fmt = fmt or ('parquet' if pq is not None else 'csv')
+    if fmt == 'parquet' and pq is None:
+        raise RuntimeError("Parquet export needs pyarrow; install it or use --format csv.")
+    os.makedirs(out_dir, exist_ok=True)
+    return {table: export_table(table, out_dir, fmt, username, since, until, with_passwords, chunk_rows)
+            for table in tables}
+
+
+# --- Import ---
+
+def _read_chunks(path, columns, chunk_rows):
+    # Yield (column names, rows) from a Parquet or gzip CSV export, one chunk at a time.
+    types = dict(columns)
+    if path.endswith('.parquet'):
+        if pq is None:
+            raise RuntimeError("Reading Parquet needs pyarrow.")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            names = [name for name in batch.schema.names if name in types]
+            values = [batch.column(name).to_pylist() for name in names]
+            yield names, list(zip(*values))
+        return
+    convert = {'int64': int, 'float64': float, 'string': str}
+    with gzip.open(path, 'rt', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        keep = [i for i, name in enumerate(header) if name in types]
+        names = [header[i] for i in keep]
+        casts = [convert[types[name]] for name in names]
+        rows = []
+        for record in reader:
+            # An empty string is kept; an empty number can only have been NULL.
+            rows.append(tuple(None if record[i] == CSV_NULL or (record[i] == '' and cast is not str)
+                              else cast(record[i]) for i, cast in zip(keep, casts)))
+            if len(rows) >= chunk_rows:
+                yield names, rows
+                rows = []
+        if rows:
+            yield names, rows
+
+
+def _insert_sql(table, names):
+    # Upserts rather than INSERT OR REPLACE: a replace deletes the old row
+    # without firing delete triggers, which would skew the leaderboard counts.
+    placeholders = ', '.join('?' for _ in names)
+    keys = {'users': ('username',), 'tabs': ('username', 'tab_id')}.get(table, ('id',))
+    conflict = ''
+    if all(key in names for key in keys):
+        updates = ', '.join(f'{name} = excluded.{name}' for name in names if name not in keys)
+        conflict = (f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}" if updates
+                    else 'ON CONFLICT DO NOTHING')
+    return f"INSERT INTO {table} ({', '.join(names)}) VALUES ({placeholders}) {conflict}"
+
+
+def _legacy_tab_sql(names):
+    # Tabs stored before the extension sent tab ids have a NULL tab_id, which
+    # the (username, tab_id) index never matches; skip rows already present.
+    selected = ', '.join(f'? AS {name}' for name in names)
+    match = ' AND '.join(f'old.{name} IS new.{name}' for name in names)
+    return f'''INSERT INTO tabs ({', '.join(names)}) SELECT * FROM (SELECT {selected}) AS new
+               WHERE NOT EXISTS (SELECT 1 FROM tabs AS old WHERE {match})'''
+
+
+def _without(names, rows, column):
+    i = names.index(column)
+    return names[:i] + names[i + 1:], [row[:i] + row[i + 1:] for row in rows]
+
+
+def _row_groups(table, names, rows, shard, new_ids):
+    # Split rows into (insert statement, rows) groups: habits by whether they
+    # keep their id, tabs by whether they have a tab id.
+    if table == 'tabs':
+        if 'id' in names:
+            names, rows = _without(names, rows, 'id')
+        if 'tab_id' not in names:
+            return [(_legacy_tab_sql(names), rows)]
+        j = names.index('tab_id')
+        return [(_insert_sql(table, names), [row for row in rows if row[j] is not None]),
+                (_legacy_tab_sql(names), [row for row in rows if row[j] is None])]
+    if table == 'users' or 'id' not in names:
+        return [(_insert_sql(table, names), rows)]
+    i = names.index('id')
+    # A habit id names its shard, so it is only kept on the same shard.
+    keeps_id = lambda row: not new_ids and row[i] is not None and id_shard(row[i]) == shard
+    kept = [row for row in rows if keeps_id(row)]
+    new_names, new_rows = _without(names, [row for row in rows if not keeps_id(row)], 'id')
+    return [(_insert_sql(table, names), kept), (_insert_sql(table, new_names), new_rows)]
+
+
+def _match_checkins(conn, habit_ids):
+    # Streaks are rebuilt from check-ins (habit_functions.recompute_streaks),
+    # which aren't exported. Give each imported habit whose history disagrees
+    # with its streak a reset and one summary 'done' row, as migration 6 did.
+    history = STREAKS_FROM_CHECKINS_SQL.format(where='habit_id IN (SELECT value FROM json_each(:ids))')
+    rows = conn.execute(
+        f'''SELECT h.id, h.username, coalesce(h.streak, 0), COALESCE(h.last_tracked, h.created_date),
+                   history.habit_id IS NOT NULL
+            FROM habits h LEFT JOIN ({history}) AS history ON history.habit_id = h.id
+            WHERE h.id IN (SELECT value FROM json_each(:ids))
+              AND coalesce(h.streak, 0) IS NOT coalesce(history.streak, 0)''',
+        {'ids': json.dumps(habit_ids)}
+    ).fetchall()
+    conn.executemany("INSERT INTO habit_checkins (habit_id, username, kind) VALUES (?, ?, 'reset')",
+                     [(habit_id, username) for habit_id, username, _, _, has_history in rows if has_history])
+    conn.executemany(
+        "INSERT INTO habit_checkins (habit_id, username, kind, amount, checked_at) VALUES (?, ?, 'done', ?, ?)",
+        [row[:4] for row in rows if row[2] > 0]
+    )
+
+
+def import_table(path, table, new_ids=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Load an exported file into `table`, a chunk at a time, routing each row
+    to its user's shard. Users and tabs are upserted, and tabs without a
+    tab id are skipped if an identical row exists. Habits keep their ids
+    (updating the habit with the same id) unless `new_ids` is set or the id
+    belongs to another shard, and get check-ins that add up to their streak.
+    Tab rollups and history are not rebuilt.
+    Returns the rows imported.
+    """
+    imported = 0
+    touched = {}
+    for names, rows in _read_chunks(path, TABLES[table], chunk_rows):
+        user_index = names.index('username')
+        by_shard = {}
+        for row in rows:
+            shard = 0 if table == 'users' else user_shard(row[user_index])
+            by_shard.setdefault(shard, []).append(row)
+        for shard, shard_rows in by_shard.items():
+            with transaction(shard=shard) as conn:
+                habit_ids = []
+                for sql, group_rows in _row_groups(table, names, shard_rows, shard, new_ids):
+                    if not group_rows:
+                        continue
+                    if table == 'habits':
+                        # One row at a time, to learn the ids of habits given new ones.
+                        habit_ids.extend(conn.execute(f'{sql} RETURNING id', row).fetchone()[0]
+                                         for row in group_rows)
+                    else:
+                        conn.executemany(sql, group_rows)
+                if habit_ids:
+                    _match_checkins(conn, habit_ids)
+            touched.setdefault(shard, set()).update(row[user_index] for row in shard_rows)
+        imported += len(rows)
+    if table != 'users':
+        # Cached reads of these users' data are stale now.
+        for shard, usernames in touched.items():
+            with transaction(shard=shard) as conn:
+                for username in usernames:
+                    bump_data_version(conn, username, table)
+    return imported
+
+
+def import_data(source, new_ids=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Import every table file found in the `source` directory, users first.
+    Returns {table: rows imported}.
+    """
+    ensure_schema()
+    results = {}
+    for table in TABLES:
+        for name in (f'{table}.parquet', f'{table}.csv.gz'):
+            path = os.path.join(source, name)
+            if os.path.exists(path):
+                results[table] = import_table(path, table, new_ids, chunk_rows)
+                break
+    return results
+
+
+def _parse_time(value):
+    # A unix timestamp or a UTC date ('YYYY-MM-DD').
+    if value is None or value.isdigit():
+        return None if value is None else int(value)
+    return int(datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import Good Habits data in bulk.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="write tables to Parquet or gzip CSV files")
+    export_parser.add_argument('--out', required=True, help="directory for the exported files")
+    export_parser.add_argument('--format', choices=['parquet', 'csv'])
+    export_parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=list(TABLES))
+    export_parser.add_argument('--user', help="only this user's rows")
+    export_parser.add_argument('--since', help="start date (YYYY-MM-DD) or unix time, inclusive")
+    export_parser.add_argument('--until', help="end date (YYYY-MM-DD) or unix time, exclusive")
+    export_parser.add_argument('--with-passwords', action='store_true', help="include password hashes")
+    import_parser = commands.add_parser('import', help="load files written by export")
+    import_parser.add_argument('source', help="directory with the exported files")
+    import_parser.add_argument('--new-ids', action='store_true',
+                               help="give imported habits new ids instead of replacing by id")
+    for command in (export_parser, import_parser):
+        command.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS)
+    args = parser.parse_args()
+    started = time.perf_counter()
+    if args.command == 'export':
+        results = export_data(args.out, args.tables, args.format, args.user, _parse_time(args.since),
+                              _parse_time(args.until), args.with_passwords, args.chunk_rows)
+        summary = {table: {'path': path, 'rows': rows} for table, (path, rows) in results.items()}
+    else:
+        summary = import_data(args.source, args.new_ids, args.chunk_rows)
+    print(json.dumps({'tables': summary, 'seconds': round(time.perf_counter() - started, 3)}))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,21 @@
 // Object to store tab information
 let tabsData = {};
 
+// --- Sync state ---
+// Reports use the delta protocol described in ingest.py: after one full
+// snapshot, only opened, changed and closed tabs are sent, numbered by seq.
+const SERVER_URL = "http://127.0.0.1:5000/store_tabs";
+const SYNC_DELAY_MS = 1000;          // events within this window share one report
+const DURATION_REFRESH_MS = 5 * 60 * 1000;  // resend open tabs so their time stays current
+const GZIP_MIN_BYTES = 1024;         // smaller bodies are sent uncompressed
+const clientId = (crypto.randomUUID && crypto.randomUUID()) || `${Date.now()}-${Math.random()}`;
+let seq = 0;
+let needFullSync = true;
+let changedTabs = new Set();
+let closedTabs = [];
+let syncTimer = null;
+let syncing = false;
+
 // Listen for messages from content.js
 chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   console.log("Received message:", message); // Debugging: Check if username is included in message
@@ -15,7 +30,8 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
       } else {
         tabsData[tabId] = { title: message.title, url: message.url, openedAt: Date.now(), username: username };
       }
-      updateDatabase();
+      markChanged(tabId);
+      connectEvents(username);
       sendResponse({ status: "success", data: tabsData[tabId] });
     } else {
       sendResponse({ status: "failed", message: "No tab ID found." });
@@ -32,7 +48,7 @@ chrome.tabs.onCreated.addListener((tab) => {
     tabsData[tabId] = { title: tab.title || "New Tab", url: tab.url, openedAt: Date.now() };
   }
   console.log(`Tab Opened: ${tab.title} (ID: ${tabId})`);
-  updateDatabase();
+  markChanged(tabId);
 });
 
 // When a tab is updated (for example, finishes loading)
@@ -46,13 +62,14 @@ chrome.tabs.onUpdated.addListener((tabId, changeInfo, tab) => {
       tabsData[tabId] = { title: tab.title, url: tab.url, openedAt: Date.now() };
     }
     console.log(`Tab Updated: ${tab.title} (ID: ${tabId})`);
-    updateDatabase();
+    markChanged(tabId);
   } else {
-    // For non-complete updates, update title and URL if we already have an entry.
-    if (tabsData[tabId]) {
-      tabsData[tabId].title = tab.title;
-      tabsData[tabId].url = tab.url;
-      updateDatabase();
+    // For non-complete updates, only report a title or URL that actually changed.
+    const entry = tabsData[tabId];
+    if (entry && (entry.title !== tab.title || entry.url !== tab.url)) {
+      entry.title = tab.title;
+      entry.url = tab.url;
+      markChanged(tabId);
     }
   }
 });
@@ -64,38 +81,135 @@ chrome.tabs.onRemoved.addListener((tabId) => {
     console.log(
       `Tab Closed: ${tabsData[tabId].title} (ID: ${tabId}). Time spent: ${timeSpent.toFixed(2)}s`
     );
+    closedTabs.push({ tab_id: Number(tabId), username: tabsData[tabId].username, duration: timeSpent });
+    changedTabs.delete(Number(tabId));
     delete tabsData[tabId];
-    updateDatabase();
+    scheduleSync();
   }
 });
 
-function updateDatabase() {
-  console.log("Updating database...");
-  const tabDurations = Object.entries(tabsData).map(([id, tab]) => {
-    if (!tab.username) {
-      console.error("Username missing for tab: ", tab);  // Ensure username is present
+function tabReport(id) {
+  const tab = tabsData[id];
+  if (!tab.username) {
+    console.error("Username missing for tab: ", tab);  // Ensure username is present
+  }
+  const duration = (Date.now() - tab.openedAt) / 1000;
+  // The server refuses tabs without a title or url string.
+  return { tab_id: Number(id), username: tab.username, title: tab.title || "", url: tab.url || "", duration };
+}
+
+function markChanged(tabId) {
+  changedTabs.add(Number(tabId));
+  scheduleSync();
+}
+
+function scheduleSync(delay = SYNC_DELAY_MS) {
+  if (!syncTimer) {
+    syncTimer = setTimeout(syncTabs, delay);
+  }
+}
+
+async function syncTabs() {
+  syncTimer = null;
+  if (syncing) {
+    scheduleSync();
+    return;
+  }
+  const full = needFullSync;
+  if (!full && changedTabs.size === 0 && closedTabs.length === 0) {
+    return;
+  }
+  seq += 1;
+  const report = { client_id: clientId, seq, full };
+  if (full) {
+    report.tabs = Object.keys(tabsData).map(tabReport);
+  } else {
+    report.tabs = [...changedTabs].filter((id) => tabsData[id]).map(tabReport);
+    report.closed = closedTabs;
+  }
+  needFullSync = false;
+  changedTabs = new Set();
+  closedTabs = [];
+
+  syncing = true;
+  try {
+    const response = await sendToDatabase(report);
+    const data = await response.json();
+    console.log("Server response:", data);
+    if (response.status === 409) {
+      // The server missed a report; send everything again.
+      needFullSync = true;
+      scheduleSync(0);
+    } else if (!response.ok) {
+      needFullSync = true;
     }
-    const duration = (Date.now() - tab.openedAt) / 1000;
-    return { username: tab.username, title: tab.title, url: tab.url, duration };
-  });
-  console.log("Tab Durations:", tabDurations);
-  sendToDatabase(tabDurations);  // Send data to the server
+  } catch (error) {
+    console.error("Error sending data:", error);
+    needFullSync = true;
+  } finally {
+    syncing = false;
+  }
   updateNotification();  // Update the notification
 }
 
+// Deltas leave unchanged tabs alone, so refresh their durations now and then.
+setInterval(() => {
+  Object.keys(tabsData).forEach((id) => changedTabs.add(Number(id)));
+  scheduleSync();
+}, DURATION_REFRESH_MS);
 
+async function gzip(text) {
+  const stream = new Blob([text]).stream().pipeThrough(new CompressionStream("gzip"));
+  return new Response(stream).arrayBuffer();
+}
 
-function sendToDatabase(tabData) {
-  fetch("http://127.0.0.1:5000/store_tabs", {
-    method: "POST",
-    headers: {
-      "Content-Type": "application/json"
-    },
-    body: JSON.stringify(tabData)
-  })
-  .then(response => response.json())
-  .then(data => console.log("Server response:", data))
-  .catch(error => console.error("Error sending data:", error));
+async function sendToDatabase(report) {
+  let body = JSON.stringify(report);
+  const headers = { "Content-Type": "application/json" };
+  if (body.length >= GZIP_MIN_BYTES && typeof CompressionStream !== "undefined") {
+    body = await gzip(body);
+    headers["Content-Encoding"] = "gzip";
+  }
+  return fetch(SERVER_URL, { method: "POST", headers, body });
+}
+
+// --- Server notifications ---
+// Generated messages and streak milestones arrive over server-sent events
+// and are shown with popNotification. EventSource reconnects by itself and
+// resends the last event id; the id is also saved so a restarted browser
+// picks up what it missed.
+const EVENTS_URL = "http://127.0.0.1:5000/events";
+const NOTIFICATION_KINDS = ["milestone", "encouragement", "tab_analysis"];
+let eventSource = null;
+let eventsUser = null;
+
+function connectEvents(username) {
+  if (!username || username === eventsUser) {
+    return;
+  }
+  if (eventSource) {
+    eventSource.close();
+  }
+  eventsUser = username;
+  const storageKey = `lastEventId:${username}`;
+  chrome.storage.local.get(storageKey, (items) => {
+    let url = `${EVENTS_URL}?username=${encodeURIComponent(username)}`;
+    if (items[storageKey]) {
+      url += `&last_event_id=${encodeURIComponent(items[storageKey])}`;
+    }
+    if (eventsUser !== username) {
+      return;  // the user changed while we were reading storage
+    }
+    eventSource = new EventSource(url);
+    NOTIFICATION_KINDS.forEach((kind) => {
+      eventSource.addEventListener(kind, (event) => {
+        const notification = JSON.parse(event.data);
+        // Own id per event, so the tab stats refresh doesn't replace it.
+        popNotification(notification.message, `server-${event.lastEventId}`);
+        chrome.storage.local.set({ [storageKey]: event.lastEventId });
+      });
+    });
+  });
 }
 
 // Create or update a Chrome notification with current tab statistics.
@@ -124,16 +238,16 @@ function updateNotification() {
   );
 }
 
-function popNotification(input) {
+function popNotification(input, notificationId = "tabStats") {
   const message = input
 
-  // Create/update a notification with a fixed ID.
+  // Create/update the notification with the given ID.
   chrome.notifications.create(
-    "tabStats",
+    notificationId,
     {
       type: "basic",
       iconUrl: "icon.png", // Make sure you include this icon in your extension directory.
-      title: "Tab Statistics",
+      title: notificationId === "tabStats" ? "Tab Statistics" : "GooD-Habits",
       message: message,
       priority: 2,
     },
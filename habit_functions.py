@@ -1,33 +1,60 @@
+import json
 import random
-from database import create_connection  # Ensure this is defined in database.py
+from database import (
+    add_notification, all_shards, bump_data_version, id_shard,
+    transaction, user_connection, user_shard, user_transaction
+)
+from metrics import instrument_db
 
 # --- Habit Tracking Functions ---
 
+# Date the next check-in is due when a habit is checked in today.
+NEXT_DUE_SQL = '''CASE target_frequency
+                    WHEN 'Weekly' THEN DATE('now', '+7 days')
+                    WHEN 'Monthly' THEN DATE('now', '+1 month')
+                    ELSE DATE('now', '+1 day') END'''
+
+@instrument_db
 def add_habit(username, habit_name, target_frequency):
     """
     Add a new habit for the given user.
     """
-    conn = create_connection()
-    conn.execute(
-        '''INSERT INTO habits 
-           (username, habit_name, target_frequency, created_date, streak) 
-           VALUES (?, ?, ?, DATE('now'), 0)''', 
-        (username, habit_name, target_frequency)
-    )
-    conn.commit()
-    conn.close()
+    with user_transaction(username) as conn:
+        conn.execute(
+            '''INSERT INTO habits 
+               (username, habit_name, target_frequency, created_date, streak, next_due) 
+               VALUES (?, ?, ?, DATE('now'), 0, DATE('now'))''', 
+            (username, habit_name, target_frequency)
+        )
+        bump_data_version(conn, username, 'habits')
 
 
+@instrument_db
 def get_user_habits(username):
     """
     Retrieve all habits associated with the given username.
     """
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM habits WHERE username=?', (username,))
-    habits = cursor.fetchall()
-    conn.close()
-    return habits
+    conn = user_connection(username)
+    cursor = conn.execute('SELECT * FROM habits WHERE username=?', (username,))
+    return cursor.fetchall()
+
+
+@instrument_db
+def get_due_habits(username, start=None, end=None):
+    """
+    Return the user's habits whose next check-in falls between the `start`
+    and `end` dates ('YYYY-MM-DD', inclusive), earliest first.
+    By default that is everything due today or overdue.
+    Rows have the same columns as get_user_habits.
+    """
+    conn = user_connection(username)
+    cursor = conn.execute(
+        '''SELECT * FROM habits
+           WHERE username = ? AND next_due BETWEEN ? AND COALESCE(?, DATE('now'))
+           ORDER BY next_due''',
+        (username, start or '0000-00-00', end)
+    )
+    return cursor.fetchall()
 
 
 def get_streak_increment_message(streak):
@@ -61,29 +88,113 @@ def get_streak_increment_message(streak):
     return random.choice(regular_messages)
 
 
+@instrument_db
 def update_habit_streak(habit_id):
     """
     Increment the streak of the habit with the given ID.
     Returns an appropriate congratulatory message.
+    The increment is a single UPDATE ... RETURNING, so concurrent clicks
+    can't read the same old value.
+    """
+    with transaction(shard=id_shard(habit_id)) as conn:
+        row = conn.execute(
+            f'''UPDATE habits 
+               SET streak = streak + 1,
+                   last_tracked = DATE('now'),
+                   next_due = {NEXT_DUE_SQL}
+               WHERE id=?
+               RETURNING streak, username, habit_name''', 
+            (habit_id,)
+        ).fetchone()
+        if row is None:
+            return "Habit not found."
+        streak, username, name = row
+        conn.execute("INSERT INTO habit_checkins (habit_id, username, kind) VALUES (?, ?, 'done')",
+                     (habit_id, username))
+        bump_data_version(conn, username, 'habits')
+        _notify_milestone(conn, username, habit_id, name, streak)
+    return get_streak_increment_message(streak)
+
+
+def _notify_milestone(conn, username, habit_id, name, streak):
+    # Every fifth check-in earns a 🔥, which the extension shows as a pop-up.
+    if streak % 5 == 0:
+        add_notification(conn, username, 'milestone', f"🔥 {streak} in a row for {name}! Keep it going!",
+                         habit_id=habit_id, streak=streak)
+
+
+@instrument_db
+def mark_habits_done(habit_ids):
+    """
+    Check in several habits at once, in one transaction per shard.
+    Returns {habit_id: congratulatory message} for the habits that exist.
+    A habit listed more than once is only checked in once.
     """
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT streak FROM habits WHERE id=?', (habit_id,))
-    result = cursor.fetchone()
-    if result is None:
-        conn.close()
-        return "Habit not found."
-    current_streak = result[0]
-    conn.execute(
-        '''UPDATE habits 
-           SET streak = streak + 1,
-               last_tracked = DATE('now')
-           WHERE id=?''', 
-        (habit_id,)
+    ids_by_shard = {}
+    for habit_id in habit_ids:
+        ids_by_shard.setdefault(id_shard(habit_id), []).append(int(habit_id))
+    messages = {}
+    # A user's habits share a shard, so this is normally a single transaction.
+    for shard, ids in ids_by_shard.items():
+        with transaction(shard=shard) as conn:
+            rows = conn.execute(
+                f'''UPDATE habits
+                   SET streak = streak + 1,
+                       last_tracked = DATE('now'),
+                       next_due = {NEXT_DUE_SQL}
+                   WHERE id IN (SELECT value FROM json_each(?))
+                   RETURNING id, username, streak, habit_name''',
+                (json.dumps(ids),)
+            ).fetchall()
+            conn.executemany("INSERT INTO habit_checkins (habit_id, username, kind) VALUES (?, ?, 'done')",
+                             [(habit_id, username) for habit_id, username, _, _ in rows])
+            for username in {username for _, username, _, _ in rows}:
+                bump_data_version(conn, username, 'habits')
+            for habit_id, username, streak, name in rows:
+                _notify_milestone(conn, username, habit_id, name, streak)
+        messages.update((habit_id, get_streak_increment_message(streak)) for habit_id, _, streak, _ in rows)
+    return messages
+
+
+# Streak per habit from the check-in history: the window counts, for every
+# row, how many resets (manual or expired) come at or after it; the streak
+# is the 'done' amount with no reset after it.
+STREAKS_FROM_CHECKINS_SQL = '''
+    SELECT habit_id, SUM(CASE WHEN kind = 'done' AND resets_after = 0 THEN amount ELSE 0 END) AS streak
+    FROM (
+        SELECT habit_id, kind, amount,
+               SUM(kind IN ('reset', 'expired')) OVER (PARTITION BY habit_id ORDER BY id DESC
+                                         ROWS UNBOUNDED PRECEDING) AS resets_after
+        FROM habit_checkins
+        WHERE {where}
     )
-    conn.commit()
-    conn.close()
-    return get_streak_increment_message(current_streak + 1)
+    GROUP BY habit_id
+'''
+
+
+@instrument_db
+def recompute_streaks(username=None):
+    """
+    Rebuild the stored streak of every habit (or every habit of one user)
+    from the check-in history in a single set-based UPDATE. Run
+    periodically by jobs.py to repair streaks that drifted from the history.
+    Returns the number of habits whose streak was corrected.
+    """
+    where, params = ('username = ?', (username,)) if username else ('1', ())
+    corrected = 0
+    for shard in [user_shard(username)] if username else all_shards():
+        with transaction(shard=shard) as conn:
+            rows = conn.execute(
+                f'''UPDATE habits SET streak = history.streak
+                    FROM ({STREAKS_FROM_CHECKINS_SQL.format(where=where)}) AS history
+                    WHERE habits.id = history.habit_id AND habits.streak IS NOT history.streak
+                    RETURNING habits.username''',
+                params
+            ).fetchall()
+            for changed_user in {row[0] for row in rows}:
+                bump_data_version(conn, changed_user, 'habits')
+        corrected += len(rows)
+    return corrected
 
 
 def get_reset_message():
@@ -107,18 +218,47 @@ def get_reset_message():
     return f"{random.choice(messages)}\n\n{random.choice(tips)}"
 
 
+@instrument_db
 def reset_habit_streak(habit_id):
     """
     Reset the streak for the given habit to zero.
     Returns a reset message.
     """
-    conn = create_connection()
-    conn.execute('UPDATE habits SET streak = 0 WHERE id=?', (habit_id,))
-    conn.commit()
-    conn.close()
+    with transaction(shard=id_shard(habit_id)) as conn:
+        row = conn.execute(
+            "UPDATE habits SET streak = 0, next_due = DATE('now') WHERE id=? RETURNING username",
+            (habit_id,)
+        ).fetchone()
+        if row is not None:
+            conn.execute("INSERT INTO habit_checkins (habit_id, username, kind) VALUES (?, ?, 'reset')",
+                         (habit_id, row[0]))
+            bump_data_version(conn, row[0], 'habits')
     return get_reset_message()
 
 
+@instrument_db
+def expire_overdue_streaks():
+    """
+    Reset every running streak whose next check-in was due before today,
+    for all users in one statement per shard. The partial index on next_due means
+    only overdue habits are visited. Returns the number of streaks expired.
+    """
+    expired = 0
+    for shard in all_shards():
+        with transaction(shard=shard) as conn:
+            rows = conn.execute(
+                '''UPDATE habits SET streak = 0
+                   WHERE streak > 0 AND next_due < DATE('now')
+                   RETURNING id, username'''
+            ).fetchall()
+            conn.executemany("INSERT INTO habit_checkins (habit_id, username, kind) VALUES (?, ?, 'expired')",
+                             rows)
+            for username in {username for _, username in rows}:
+                bump_data_version(conn, username, 'habits')
+        expired += len(rows)
+    return expired
+
+
 def get_streak_display(streak):
     """
     Return a string representation of the streak including fire emojis.
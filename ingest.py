@@ -0,0 +1,313 @@
+# ingest.py
+# Background writer for tab reports coming from the extension. /store_tabs
+# hands payloads to the queue and returns right away; a single writer thread
+# merges the reports waiting for each user and commits a batch of users at once.
+#
+# Reports come in two shapes:
+#   [tab, ...]                                         full snapshot (older extensions)
+#   {"client_id", "seq", "full", "tabs", "closed"}     delta protocol
+# In the delta protocol "tabs" lists only opened or changed tabs and "closed"
+# lists {"tab_id", "username", "duration"} for tabs closed since the last
+# report; with "full": true, "tabs" is a complete snapshot instead. Reports
+# from one client are numbered 1, 2, 3, ...; a delta that does not follow the
+# last report accepted is refused and the client sends a full snapshot.
+# Numbers are claimed in the database (sync_clients) when a report is
+# accepted, so with several worker processes any of them can take the next
+# report. A report still queued in one process when a newer full snapshot
+# from the same client was accepted is stale and skipped by the writer.
+import atexit
+import logging
+import os
+import threading
+import time
+
+from database import (
+    claim_sync_seq, get_full_seqs, group_tabs_by_user, group_users_by_shard, reset_sync_seqs,
+    sync_user_tabs, transaction
+)
+from log_utils import elapsed_ms, log_event
+
+logger = logging.getLogger(__name__)
+
+INGEST_WINDOW = float(os.environ.get('GOOD_HABITS_INGEST_WINDOW', '0.5'))
+INGEST_MAX_PENDING = int(os.environ.get('GOOD_HABITS_INGEST_MAX_PENDING', '1000'))
+
+
+def _full_entry(tabs, client_id=None, seq=0):
+    return {
+        'full': True,
+        'tabs': {(tab['tab_id'] if tab.get('tab_id') is not None else ('legacy', i)): tab
+                 for i, tab in enumerate(tabs)},
+        'closed': {},
+        'client_id': client_id,
+        'seq': seq,
+    }
+
+
+def _report_entries(report):
+    """
+    Split a delta-protocol report into {username: entry}.
+    """
+    client_id, seq = report['client_id'], report['seq']
+    if report.get('full'):
+        return {username: _full_entry(tabs, client_id, seq)
+                for username, tabs in group_tabs_by_user(report.get('tabs')).items()}
+
+    def delta_entry():
+        return {'full': False, 'tabs': {}, 'closed': {}, 'client_id': client_id, 'seq': seq}
+
+    entries = {}
+    for username, tabs in group_tabs_by_user(report.get('tabs')).items():
+        entries[username] = dict(delta_entry(), tabs={tab['tab_id']: tab for tab in tabs})
+    for username, closed in group_tabs_by_user(report.get('closed')).items():
+        entry = entries.setdefault(username, delta_entry())
+        for tab in closed:
+            entry['closed'][tab['tab_id']] = tab.get('duration')
+    return entries
+
+
+def _merge_entry(pending, update):
+    """
+    Fold `update` into the entry already waiting for the same user and client.
+    A full snapshot replaces whatever was pending.
+    """
+    if pending is None or update['full']:
+        return update
+    for tab_id, tab in update['tabs'].items():
+        pending['tabs'][tab_id] = tab
+        pending['closed'].pop(tab_id, None)
+    for tab_id, duration in update['closed'].items():
+        pending['tabs'].pop(tab_id, None)
+        if not pending['full']:
+            pending['closed'][tab_id] = duration
+    pending['seq'] = max(pending['seq'], update['seq'])
+    return pending
+
+
+class TabIngestQueue:
+    """
+    Coalescing queue of tab reports, keyed by username and client.
+
+    A newer full snapshot replaces the pending one (last write wins) and
+    deltas are merged into it. At most `max_pending` users can be waiting;
+    reports for further users are dropped until the writer catches up.
+    """
+
+    def __init__(self, window=INGEST_WINDOW, max_pending=INGEST_MAX_PENDING):
+        self.window = window
+        self.max_pending = max_pending
+        self.stats = {
+            'received': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'resyncs': 0,
+            'stale': 0,
+            'written': 0,
+            'batches': 0,
+            'errors': 0,
+        }
+        # (username, client_id) -> entry; client_id is None for plain tab lists
+        self._pending = {}
+        self._listeners = []
+        self._writing = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add_listener(self, callback):
+        """
+        Call callback(usernames) on the writer thread after each batch is stored.
+        """
+        with self._cond:
+            if callback not in self._listeners:
+                self._listeners.append(callback)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name='tab-ingest-writer', daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, tab_list):
+        """
+        Queue a full-snapshot payload. Returns False if any user's report was dropped.
+        """
+        entries = {username: _full_entry(tabs)
+                   for username, tabs in group_tabs_by_user(tab_list).items()}
+        with self._cond:
+            self.stats['received'] += 1
+            return self._add_entries(entries)
+
+    def submit_report(self, report):
+        """
+        Queue a delta-protocol report. Returns 'ok', 'resync' when the client
+        must send a full snapshot, or 'busy' when the queue is full.
+        """
+        client_id, seq = report['client_id'], report['seq']
+        entries = _report_entries(report)
+        with self._cond:
+            self.stats['received'] += 1
+        if not claim_sync_seq(client_id, seq, bool(report.get('full'))):
+            with self._cond:
+                self.stats['resyncs'] += 1
+            return 'resync'
+        with self._cond:
+            accepted = self._add_entries(entries)
+        if not accepted:
+            # The report is lost, so the client's next delta must be refused.
+            reset_sync_seqs({client_id: seq})
+            return 'busy'
+        return 'ok'
+
+    def _add_entries(self, entries):
+        # Called with self._cond held.
+        accepted = True
+        for username, entry in entries.items():
+            key = (username, entry.get('client_id'))
+            if key in self._pending:
+                self.stats['coalesced'] += 1
+            elif len(self._pending) >= self.max_pending or self._stopped:
+                self.stats['dropped'] += 1
+                accepted = False
+                continue
+            self._pending[key] = _merge_entry(self._pending.get(key), entry)
+        self._cond.notify_all()
+        return accepted
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending and self._stopped:
+                    return
+            # Give a burst of events a moment to collapse into one write.
+            if self.window and not self._stopped:
+                time.sleep(self.window)
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._writing = True
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _drop_stale(self, batch):
+        # Entries older than their client's latest full snapshot, which may
+        # have been accepted by another worker process, would undo it.
+        clients = {client_id for _, client_id in batch if client_id is not None}
+        full_seqs = get_full_seqs(clients) if clients else {}
+        stale = [key for key, entry in batch.items()
+                 if entry['client_id'] is not None and entry['seq'] < full_seqs.get(entry['client_id'], 0)]
+        for key in stale:
+            del batch[key]
+        return len(stale)
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        failed = set()
+        try:
+            stale = self._drop_stale(batch)
+            if stale:
+                with self._cond:
+                    self.stats['stale'] += stale
+            keys_by_user = {}
+            for key in batch:
+                keys_by_user.setdefault(key[0], []).append(key)
+            # One transaction per shard, each report in a savepoint of it so a
+            # bad one only loses that user's tabs.
+            for shard, usernames in group_users_by_shard(keys_by_user).items():
+                with transaction(shard=shard):
+                    for username in usernames:
+                        for key in keys_by_user[username]:
+                            entry = batch[key]
+                            closed = None if entry['full'] else entry['closed']
+                            try:
+                                sync_user_tabs(username, list(entry['tabs'].values()), closed)
+                            except Exception:
+                                logger.exception("Failed to write tabs for %s", username)
+                                failed.add(key)
+        except Exception:
+            logger.exception("Failed to write tab batch for %d users", len(batch))
+            failed = set(batch)
+        if failed:
+            with self._cond:
+                self.stats['errors'] += len(failed)
+            # These reports are lost, so the clients' next deltas must be refused.
+            lost = {}
+            for key in failed:
+                client_id = batch[key]['client_id']
+                if client_id is not None:
+                    lost[client_id] = max(lost.get(client_id, 0), batch[key]['seq'])
+            if lost:
+                try:
+                    reset_sync_seqs(lost)
+                except Exception:
+                    logger.exception("Failed to reset sync state for %d clients", len(lost))
+        written = list(dict.fromkeys(key[0] for key in batch if key not in failed))
+        if not written:
+            return
+        with self._cond:
+            self.stats['written'] += len(written)
+            self.stats['batches'] += 1
+            listeners = list(self._listeners)
+        log_event(logger, logging.INFO, 'tab_batch_written', users=len(written), ms=elapsed_ms(started))
+        for callback in listeners:
+            try:
+                callback(written)
+            except Exception:
+                logger.exception("Ingest listener %r failed", callback)
+
+    def flush(self, timeout=None):
+        """
+        Block until everything queued so far has been written.
+        Returns False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._thread is None:
+                return not self._pending
+            while self._pending or self._writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=10):
+        """
+        Stop accepting reports, write whatever is pending and stop the writer.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_ingest_queue():
+    """
+    Return the process-wide queue, starting its writer on first use.
+    The queue is flushed when the interpreter exits.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = TabIngestQueue().start()
+            atexit.register(_queue.close)
+        return _queue
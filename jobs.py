@@ -0,0 +1,142 @@
+# jobs.py
+# Periodic maintenance jobs, run on background threads by the API server.
+# Every worker process starts them, but each run first takes the job's lease
+# in the database, so with serve.py --workers N a job still runs once per
+# interval rather than N times.
+#
+#   python jobs.py        # run every job once, e.g. from cron
+import logging
+import os
+import threading
+import time
+
+from database import acquire_lease, ensure_schema
+from habit_functions import expire_overdue_streaks, recompute_streaks
+from ingest import get_ingest_queue
+from pregen import (
+    PREGEN_ENABLED, PREGEN_SCAN_INTERVAL, get_pregenerator, queue_stale_users, stop_pregenerator
+)
+from progress import snapshot_progress
+from retention import run_retention
+
+logger = logging.getLogger(__name__)
+
+STREAK_EXPIRY_INTERVAL = float(os.environ.get('GOOD_HABITS_STREAK_EXPIRY_INTERVAL', '3600'))
+STREAK_RECOMPUTE_INTERVAL = float(os.environ.get('GOOD_HABITS_STREAK_RECOMPUTE_INTERVAL', '86400'))
+PROGRESS_SNAPSHOT_INTERVAL = float(os.environ.get('GOOD_HABITS_PROGRESS_SNAPSHOT_INTERVAL', '3600'))
+RETENTION_INTERVAL = float(os.environ.get('GOOD_HABITS_RETENTION_INTERVAL', '86400'))
+
+
+class PeriodicJob:
+    """
+    Call `func` every `interval` seconds on a daemon thread, skipping the
+    run when another process already took it (see run_due).
+    A failing run is logged and retried at the next interval.
+    """
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_result = None
+        self.last_run = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        started = time.monotonic()
+        try:
+            self.last_result = self.func()
+        except Exception:
+            self.errors += 1
+            logger.exception("Job %s failed", self.name)
+        else:
+            logger.info("Job %s finished in %.3fs: %s", self.name,
+                        time.monotonic() - started, self.last_result)
+        self.runs += 1
+        self.last_run = time.time()
+        return self.last_result
+
+    def run_due(self):
+        """
+        Run unless another process has run the job within this interval.
+        The lease lapses a little early so the next tick is never missed.
+        """
+        try:
+            claimed = acquire_lease(f'job:{self.name}', self.interval * 0.9)
+        except Exception:
+            logger.exception("Job %s could not take its lease", self.name)
+            claimed = False
+        if not claimed:
+            self.skipped += 1
+            return None
+        return self.run_once()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.run_due()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name=f"job-{self.name}", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def build_jobs():
+    jobs = [
+        PeriodicJob('streak_expiry', expire_overdue_streaks, STREAK_EXPIRY_INTERVAL),
+        PeriodicJob('streak_recompute', recompute_streaks, STREAK_RECOMPUTE_INTERVAL),
+        PeriodicJob('progress_snapshot', snapshot_progress, PROGRESS_SNAPSHOT_INTERVAL),
+        PeriodicJob('retention', run_retention, RETENTION_INTERVAL),
+    ]
+    if PREGEN_ENABLED:
+        jobs.append(PeriodicJob('message_pregen', queue_stale_users, PREGEN_SCAN_INTERVAL))
+    return jobs
+
+
+_jobs = []
+_jobs_lock = threading.Lock()
+
+
+def start_background_jobs():
+    """
+    Start the periodic jobs for this process (once) and return them.
+    """
+    with _jobs_lock:
+        if not _jobs:
+            if PREGEN_ENABLED:
+                # Regenerate a user's messages as soon as new tabs are stored.
+                get_ingest_queue().add_listener(get_pregenerator().request_many)
+            _jobs.extend(job.start() for job in build_jobs())
+        return list(_jobs)
+
+
+def stop_background_jobs():
+    with _jobs_lock:
+        for job in _jobs:
+            job.stop()
+        _jobs.clear()
+        stop_pregenerator()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    ensure_schema()
+    for job in build_jobs():
+        print(f"{job.name}: {job.run_once()}")
+    if PREGEN_ENABLED:
+        # message_pregen only queued the users; wait for their messages.
+        get_pregenerator().flush()
+        stop_pregenerator()
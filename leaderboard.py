@@ -0,0 +1,98 @@
+# leaderboard.py
+# Streak leaderboards across users. The global board ranks users by their
+# best current streak; a habit board ranks everyone's habits with the same
+# name (case-insensitive). Ranks come from the leaderboard_counts histogram,
+# which triggers on the habits table keep current (see migrations.py), so
+# "where do I rank" never scans other users' habits. With sharding, each
+# shard keeps its own histogram and the per-shard answers are combined.
+# Equal streaks share a rank: 10, 7, 7, 3 rank 1, 2, 2, 4.
+import heapq
+
+from database import all_shards, get_connection, user_connection
+from metrics import instrument_db
+
+GLOBAL_BOARD = ''
+
+
+def _board_sql():
+    # The board key for a habit name, computed the same way as in the triggers.
+    return "'habit:' || lower(trim(coalesce(?, '')))"
+
+
+@instrument_db
+def get_top(k=10, habit_name=None):
+    """
+    Return the top `k` entries as [(rank, username, streak)], best first.
+    Without `habit_name`, ranks users by their best streak.
+    """
+    per_shard = []
+    for shard in all_shards():
+        conn = get_connection(shard)
+        if habit_name is None:
+            rows = conn.execute(
+                'SELECT username, streak FROM leaderboard_users ORDER BY streak DESC, username LIMIT ?',
+                (k,)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                '''SELECT username, coalesce(streak, 0) FROM habits
+                   WHERE lower(trim(habit_name)) = lower(trim(?))
+                   ORDER BY streak DESC, username LIMIT ?''',
+                (habit_name, k)
+            ).fetchall()
+        per_shard.append(rows)
+    rows = heapq.merge(*per_shard, key=lambda row: (-row[1], row[0]))
+    ranked = []
+    for i, (username, streak) in enumerate(rows):
+        if i == k:
+            break
+        rank = ranked[-1][0] if ranked and ranked[-1][2] == streak else i + 1
+        ranked.append((rank, username, streak))
+    return ranked
+
+
+@instrument_db
+def get_rank(username, habit_name=None):
+    """
+    Return (rank, entries on the board, streak) for the user, or None if
+    they have no entry. On a habit board the user's best habit of that name counts.
+    """
+    conn = user_connection(username)
+    if habit_name is None:
+        row = conn.execute('SELECT streak FROM leaderboard_users WHERE username = ?',
+                           (username,)).fetchone()
+        board = GLOBAL_BOARD
+    else:
+        row = conn.execute(
+            '''SELECT MAX(coalesce(streak, 0)) FROM habits
+               WHERE username = ? AND lower(trim(habit_name)) = lower(trim(?))''',
+            (username, habit_name)
+        ).fetchone()
+        board = conn.execute(f'SELECT {_board_sql()}', (habit_name,)).fetchone()[0]
+    if row is None or row[0] is None:
+        return None
+    streak = row[0]
+    above = total = 0
+    for shard in all_shards():
+        shard_above, shard_total = get_connection(shard).execute(
+            '''SELECT coalesce(SUM(CASE WHEN streak > ? THEN n END), 0), coalesce(SUM(n), 0)
+               FROM leaderboard_counts WHERE board = ?''',
+            (streak, board)
+        ).fetchone()
+        above += shard_above
+        total += shard_total
+    return above + 1, total, streak
+
+
+@instrument_db
+def get_user_boards(username):
+    """
+    Return the distinct names of the user's habits, for choosing a habit board.
+    """
+    conn = user_connection(username)
+    rows = conn.execute(
+        '''SELECT MIN(habit_name) FROM habits WHERE username = ?
+           GROUP BY lower(trim(habit_name)) ORDER BY 1''',
+        (username,)
+    )
+    return [row[0] for row in rows if row[0]]
@@ -0,0 +1,51 @@
+# log_utils.py
+# Leveled, structured logging for the server processes.
+#
+#   GOOD_HABITS_LOG_LEVEL=DEBUG|INFO|WARNING (default WARNING)
+#   GOOD_HABITS_LOG_FORMAT=json              one JSON object per line
+import json
+import logging
+import os
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    level = os.environ.get('GOOD_HABITS_LOG_LEVEL', 'WARNING').upper()
+    handler = logging.StreamHandler()
+    if os.environ.get('GOOD_HABITS_LOG_FORMAT', '').lower() == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+
+
+def log_event(logger, level, event, **fields):
+    """
+    Log `event` with key/value fields. Returns immediately when the level
+    is disabled, before any formatting happens.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if fields:
+        text = event + ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+    else:
+        text = event
+    logger.log(level, text, extra={'fields': dict(fields, event=event)})
+
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 3)
@@ -0,0 +1,375 @@
+# metrics.py
+# In-process metrics with Prometheus text output. Database helpers, the
+# /store_tabs handler and chat_with_gpt record latency histograms and
+# counters here; api.py serves them at /metrics.
+#
+# Set GOOD_HABITS_METRICS=0 to turn instrumentation off: the decorators then
+# return the original functions and the helpers below do nothing.
+#
+# With several worker processes, each scrape reaches just one of them. When
+# GOOD_HABITS_METRICS_DIR is set (serve.py does this for --workers > 1), every
+# process writes its values to a file there every few seconds and /metrics
+# adds up all the files, so counters cover the whole server.
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get('GOOD_HABITS_METRICS', '1') != '0'
+METRICS_DIR = os.environ.get('GOOD_HABITS_METRICS_DIR') or None
+# Seconds between writes of this process's values to METRICS_DIR.
+METRICS_SHARE_INTERVAL = float(os.environ.get('GOOD_HABITS_METRICS_SHARE_INTERVAL', '5'))
+
+# Seconds; fine-grained at the low end where SQLite queries live.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    parts = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def dump(self):
+        with self._lock:
+            return [[list(labelvalues), value] for labelvalues, value in self._values.items()]
+
+    @staticmethod
+    def combine(dumps):
+        values = {}
+        for dump in dumps:
+            for labelvalues, value in dump:
+                key = tuple(labelvalues)
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def samples(self, values):
+        for labelvalues, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *labelvalues):
+        entry = self._values.get(labelvalues)
+        return entry[2] if entry else 0
+
+    def dump(self):
+        with self._lock:
+            return [[list(labelvalues), list(counts), total, count]
+                    for labelvalues, (counts, total, count) in self._values.items()]
+
+    @staticmethod
+    def combine(dumps):
+        values = {}
+        for dump in dumps:
+            for labelvalues, counts, total, count in dump:
+                key = tuple(labelvalues)
+                entry = values.get(key)
+                if entry is None:
+                    values[key] = (list(counts), total, count)
+                else:
+                    values[key] = ([a + b for a, b in zip(entry[0], counts)],
+                                   entry[1] + total, entry[2] + count)
+        return values
+
+    def samples(self, values):
+        for labelvalues, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, [('le', repr(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues, [('le', '+Inf')])
+            yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+        # Set by start_sharing(); render() then also reads the other processes' files.
+        self.share_dir = None
+        self._share_stop = threading.Event()
+        self._share_thread = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collect):
+        """
+        Add a callable returning [(name, kind, help, value), ...] that is
+        read at scrape time, for values that live elsewhere (queue depths,
+        cache hit counts).
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def state(self):
+        """
+        Return this process's current values, as written to METRICS_DIR.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        return {
+            'pid': os.getpid(),
+            'metrics': {metric.name: metric.dump() for metric in metrics},
+            'collected': [list(item) for collect in collectors for item in collect()],
+        }
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format, added
+        up over all processes sharing METRICS_DIR.
+        """
+        states = [self.state()] + _read_shared_states(self.share_dir)
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            values = metric.combine(state['metrics'].get(metric.name, []) for state in states)
+            lines.extend(metric.samples(values))
+        collected = {}
+        for state in states:
+            for name, kind, help, value in state['collected']:
+                # A gauge describes a running process; a dead worker's counts still add up.
+                if kind == 'gauge' and not state.get('live', True):
+                    continue
+                entry = collected.setdefault(name, [kind, help, 0])
+                entry[2] += value
+        for name, (kind, help, value) in collected.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def start_sharing(self, directory=None, interval=METRICS_SHARE_INTERVAL):
+        """
+        Write this process's values to `directory` (default METRICS_DIR)
+        every `interval` seconds from a daemon thread, until stop_sharing().
+        """
+        directory = directory or METRICS_DIR
+        if not directory or self._share_thread is not None:
+            return
+        self.share_dir = directory
+        self._share_stop.clear()
+
+        def loop():
+            while True:
+                self.write_state()
+                if self._share_stop.wait(interval):
+                    return
+
+        self._share_thread = threading.Thread(target=loop, name='metrics-share', daemon=True)
+        self._share_thread.start()
+
+    def stop_sharing(self):
+        if self._share_thread is not None:
+            self._share_stop.set()
+            self._share_thread.join(5)
+            self._share_thread = None
+            self.write_state()
+
+    def write_state(self):
+        if not self.share_dir:
+            return
+        path = os.path.join(self.share_dir, f'{os.getpid()}.json')
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.state(), f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            logger.exception("Could not write metrics to %s", path)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _read_shared_states(directory):
+    # Every other process's last written values. Files of exited workers are
+    # kept, so counters never go backwards when a worker is replaced.
+    if not directory:
+        return []
+    states = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if state.get('pid') == os.getpid():
+            continue
+        state['live'] = _process_alive(state['pid'])
+        states.append(state)
+    return states
+
+
+def clear_shared_dir(directory):
+    """
+    Remove the values left in `directory` by an earlier server run.
+    """
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+registry = Registry()
+
+DB_QUERY_SECONDS = registry.register(Histogram(
+    'good_habits_db_query_seconds', "Time spent in database helpers.", ['function']))
+DB_ROWS_READ = registry.register(Counter(
+    'good_habits_db_rows_read_total', "Rows returned by database helpers.", ['function']))
+DB_ROWS_WRITTEN = registry.register(Counter(
+    'good_habits_db_rows_written_total', "Rows inserted, updated or deleted by database helpers.",
+    ['function']))
+DB_ERRORS = registry.register(Counter(
+    'good_habits_db_errors_total', "Database helper calls that raised.", ['function']))
+
+HTTP_REQUEST_SECONDS = registry.register(Histogram(
+    'good_habits_http_request_seconds', "Time spent handling API requests.", ['endpoint']))
+HTTP_REQUESTS = registry.register(Counter(
+    'good_habits_http_requests_total', "API requests by endpoint and status.", ['endpoint', 'status']))
+
+LLM_REQUEST_SECONDS = registry.register(Histogram(
+    'good_habits_llm_request_seconds', "Time for a full chat completion.", ['mode']))
+LLM_FIRST_TOKEN_SECONDS = registry.register(Histogram(
+    'good_habits_llm_first_token_seconds', "Time until the first streamed token."))
+LLM_TOKENS = registry.register(Counter(
+    'good_habits_llm_tokens_total', "Tokens reported by the API.", ['type']))
+LLM_CACHE = registry.register(Counter(
+    'good_habits_llm_cache_total', "Chat response cache lookups.", ['result']))
+
+
+# --- Database instrumentation ---
+
+# Returns the calling thread's running count of changed rows; set by database.py.
+_changes_source = None
+
+
+def set_changes_source(source):
+    global _changes_source
+    _changes_source = source
+
+
+def _rows_in(result):
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple):
+        return 1
+    return 0
+
+
+def instrument_db(func):
+    """
+    Decorator for database helpers: records call latency, rows returned and
+    rows changed (from the connection's total_changes) under the function name.
+    """
+    if not METRICS_ENABLED:
+        return func
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        changes_before = _changes_source() if _changes_source else 0
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(1, name)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name)
+        DB_ROWS_READ.inc(_rows_in(result), name)
+        if _changes_source:
+            DB_ROWS_WRITTEN.inc(_changes_source() - changes_before, name)
+        return result
+    return wrapper
+
+
+def observe_request(endpoint, status, seconds):
+    if METRICS_ENABLED:
+        HTTP_REQUEST_SECONDS.observe(seconds, endpoint)
+        HTTP_REQUESTS.inc(1, endpoint, str(status))
+
+
+def observe_llm(mode, seconds, usage=None):
+    if not METRICS_ENABLED:
+        return
+    LLM_REQUEST_SECONDS.observe(seconds, mode)
+    if usage is not None:
+        LLM_TOKENS.inc(getattr(usage, 'prompt_tokens', 0) or 0, 'prompt')
+        LLM_TOKENS.inc(getattr(usage, 'completion_tokens', 0) or 0, 'completion')
+
+
+def observe_first_token(seconds):
+    if METRICS_ENABLED:
+        LLM_FIRST_TOKEN_SECONDS.observe(seconds)
+
+
+def count_llm_cache(hit):
+    if METRICS_ENABLED:
+        LLM_CACHE.inc(1, 'hit' if hit else 'miss')
@@ -0,0 +1,414 @@
+# migrations.py
+# Versioned schema changes. Each step runs once per database, in order, and
+# is recorded in the schema_version table. Add new steps to the end of
+# MIGRATIONS; never edit or reorder a step that has shipped.
+import time
+
+# --- Migration Steps ---
+
+def _baseline_user_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (username TEXT PRIMARY KEY, 
+                     password TEXT,
+                     display_name TEXT,
+                     bio TEXT,
+                     login_count INTEGER)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS habits
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     username TEXT,
+                     habit_name TEXT,
+                     target_frequency TEXT,
+                     created_date DATE,
+                     last_tracked DATE,
+                     streak INTEGER,
+                     FOREIGN KEY (username) REFERENCES users(username))''')
+    # Databases created before profiles existed lack these columns.
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(users)')]
+    if 'display_name' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN display_name TEXT')
+        conn.execute('UPDATE users SET display_name = username')
+    if 'bio' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN bio TEXT')
+        conn.execute('UPDATE users SET bio = ?', ("No bio yet.",))
+
+
+def _baseline_tab_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS tabs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT,
+                        tab_id INTEGER,
+                        title TEXT,
+                        url TEXT,
+                        duration REAL,
+                        timestamp INTEGER,
+                        FOREIGN KEY (username) REFERENCES users(username)
+                    )''')
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(tabs)')]
+    if 'tab_id' not in columns:
+        conn.execute('ALTER TABLE tabs ADD COLUMN tab_id INTEGER')
+    # A browser tab is identified by the extension's tab id plus the user.
+    conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_tabs_user_tab
+                    ON tabs (username, tab_id)''')
+    # Append-only history of what happened to each tab.
+    conn.execute('''CREATE TABLE IF NOT EXISTS tab_events (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT,
+                        tab_id INTEGER,
+                        event TEXT,
+                        title TEXT,
+                        url TEXT,
+                        domain TEXT,
+                        duration REAL,
+                        timestamp INTEGER
+                    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_tab_events_user_time
+                    ON tab_events (username, timestamp)''')
+    # Seconds spent per user and domain, bucketed by UTC hour and day.
+    conn.execute('''CREATE TABLE IF NOT EXISTS tab_usage_hourly (
+                        username TEXT,
+                        hour_start INTEGER,
+                        domain TEXT,
+                        seconds REAL,
+                        PRIMARY KEY (username, hour_start, domain)
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS tab_usage_daily (
+                        username TEXT,
+                        day_start INTEGER,
+                        domain TEXT,
+                        seconds REAL,
+                        PRIMARY KEY (username, day_start, domain)
+                    ) WITHOUT ROWID''')
+
+
+def _hot_path_indexes(conn):
+    # get_user_habits runs on every Streamlit rerun.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_habits_username ON habits (username)')
+    # get_tabs filters by user and the dashboard reads rows in time order.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tabs_user_time ON tabs (username, timestamp)')
+    conn.execute('ANALYZE')
+
+
+def _llm_cache_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS llm_cache
+                    (key TEXT PRIMARY KEY,
+                     model TEXT,
+                     response TEXT,
+                     created_at INTEGER,
+                     last_used INTEGER)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)')
+
+
+def _data_versions_table(conn):
+    # Per-user change counters, bumped in the same transaction as the write.
+    conn.execute('''CREATE TABLE IF NOT EXISTS data_versions
+                    (username TEXT PRIMARY KEY,
+                     habits_version INTEGER NOT NULL DEFAULT 0,
+                     tabs_version INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+
+
+def _habit_checkins_table(conn):
+    # One row per "Done!" click ('done') or streak reset ('reset', or
+    # 'expired' when the sweep resets it). A habit's streak is the sum of
+    # `amount` over its 'done' rows since the last reset.
+    conn.execute('''CREATE TABLE IF NOT EXISTS habit_checkins
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     habit_id INTEGER,
+                     username TEXT,
+                     kind TEXT,
+                     amount INTEGER NOT NULL DEFAULT 1,
+                     checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     FOREIGN KEY (habit_id) REFERENCES habits(id))''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_habit_checkins_habit
+                    ON habit_checkins (habit_id, id)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_habit_checkins_user_time
+                    ON habit_checkins (username, checked_at)''')
+    # Existing streaks have no history; carry each over as one summary row.
+    conn.execute('''INSERT INTO habit_checkins (habit_id, username, kind, amount, checked_at)
+                    SELECT id, username, 'done', streak, COALESCE(last_tracked, created_date)
+                    FROM habits WHERE streak > 0''')
+
+
+def _habit_next_due(conn):
+    # The date by which the next check-in is due. Streaks whose due date has
+    # passed are expired by the sweep in habit_functions.
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(habits)')]
+    if 'next_due' not in columns:
+        conn.execute('ALTER TABLE habits ADD COLUMN next_due DATE')
+    conn.execute('''UPDATE habits SET next_due = CASE
+                        WHEN last_tracked IS NULL THEN created_date
+                        WHEN target_frequency = 'Weekly' THEN DATE(last_tracked, '+7 days')
+                        WHEN target_frequency = 'Monthly' THEN DATE(last_tracked, '+1 month')
+                        ELSE DATE(last_tracked, '+1 day') END''')
+    # Only habits with a running streak can expire, so only they are indexed.
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_habits_expiry
+                    ON habits (next_due) WHERE streak > 0''')
+
+
+def _habit_due_indexes(conn):
+    # "What is due for this user" and "what is due for everyone by a date".
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_habits_user_due ON habits (username, next_due)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_habits_due ON habits (next_due)')
+
+
+def _sync_clients_table(conn):
+    # Last delta sequence number applied for each extension instance.
+    conn.execute('''CREATE TABLE IF NOT EXISTS sync_clients (
+                        client_id TEXT PRIMARY KEY,
+                        last_seq INTEGER NOT NULL,
+                        updated_at INTEGER NOT NULL
+                    ) WITHOUT ROWID''')
+
+
+def _generated_messages_table(conn):
+    # Latest pre-generated message of each kind per user, tagged with the
+    # data version it was generated from.
+    conn.execute('''CREATE TABLE IF NOT EXISTS generated_messages (
+                        username TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        data_version INTEGER NOT NULL,
+                        created_at INTEGER NOT NULL,
+                        PRIMARY KEY (username, kind)
+                    ) WITHOUT ROWID''')
+
+
+def _notifications_table(conn):
+    # Per-user notifications pushed to the extension over /events. The id is
+    # the SSE event id, so AUTOINCREMENT keeps ids from ever being reused.
+    conn.execute('''CREATE TABLE IF NOT EXISTS notifications (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        payload TEXT NOT NULL,
+                        created_at INTEGER NOT NULL
+                    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_notifications_user
+                    ON notifications (username, id)''')
+
+
+def _leaderboard_tables(conn):
+    # Order-statistic structure for streak ranks. leaderboard_counts holds,
+    # per board, how many entries have each streak value, so a rank is one
+    # SUM over the (few) distinct streak values above it. Board '' ranks
+    # users by their best streak (kept in leaderboard_users); board
+    # 'habit:<name>' ranks the habits with that name, case-insensitively.
+    # The triggers keep both tables in step with every write to habits.
+    conn.execute('''CREATE TABLE IF NOT EXISTS leaderboard_counts (
+                        board TEXT NOT NULL,
+                        streak INTEGER NOT NULL,
+                        n INTEGER NOT NULL,
+                        PRIMARY KEY (board, streak)
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS leaderboard_users (
+                        username TEXT PRIMARY KEY,
+                        streak INTEGER NOT NULL
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_leaderboard_users_streak
+                    ON leaderboard_users (streak DESC, username)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_habits_board
+                    ON habits (lower(trim(habit_name)), streak DESC)''')
+
+    add_entry = '''
+        INSERT INTO leaderboard_counts (board, streak, n)
+        VALUES ('habit:' || lower(trim(coalesce({row}.habit_name, ''))), coalesce({row}.streak, 0), 1)
+        ON CONFLICT (board, streak) DO UPDATE SET n = n + 1;'''
+    remove_entry = '''
+        UPDATE leaderboard_counts SET n = n - 1
+        WHERE board = 'habit:' || lower(trim(coalesce({row}.habit_name, ''))) AND streak = coalesce({row}.streak, 0);'''
+    # Move the user's entry on the global board to their current best streak.
+    refresh_user = '''
+        UPDATE leaderboard_counts SET n = n - 1
+        WHERE board = '' AND streak = (SELECT streak FROM leaderboard_users WHERE username = {row}.username);
+        DELETE FROM leaderboard_users WHERE username = {row}.username;
+        INSERT INTO leaderboard_users (username, streak)
+        SELECT username, MAX(coalesce(streak, 0)) FROM habits
+        WHERE username = {row}.username GROUP BY username;
+        INSERT INTO leaderboard_counts (board, streak, n)
+        SELECT '', streak, 1 FROM leaderboard_users WHERE username = {row}.username
+        ON CONFLICT (board, streak) DO UPDATE SET n = n + 1;'''
+    prune = "DELETE FROM leaderboard_counts WHERE n <= 0;"
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_leaderboard_insert AFTER INSERT ON habits
+                     BEGIN {add_entry.format(row='NEW')} {refresh_user.format(row='NEW')} {prune} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_leaderboard_delete AFTER DELETE ON habits
+                     BEGIN {remove_entry.format(row='OLD')} {refresh_user.format(row='OLD')} {prune} END''')
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_leaderboard_update
+                     AFTER UPDATE OF streak, habit_name, username ON habits
+                     WHEN OLD.streak IS NOT NEW.streak OR OLD.habit_name IS NOT NEW.habit_name
+                       OR OLD.username IS NOT NEW.username
+                     BEGIN {remove_entry.format(row='OLD')} {add_entry.format(row='NEW')}
+                           {refresh_user.format(row='OLD')} {refresh_user.format(row='NEW')} {prune} END''')
+
+    rebuild_leaderboard(conn)
+
+
+def rebuild_leaderboard(conn):
+    # Recount the leaderboard tables from the habits table, e.g. after a bulk copy.
+    conn.execute("DELETE FROM leaderboard_counts")
+    conn.execute("DELETE FROM leaderboard_users")
+    conn.execute('''INSERT INTO leaderboard_counts (board, streak, n)
+                    SELECT 'habit:' || lower(trim(coalesce(habit_name, ''))), coalesce(streak, 0), COUNT(*)
+                    FROM habits GROUP BY 1, 2''')
+    conn.execute('''INSERT INTO leaderboard_users (username, streak)
+                    SELECT username, MAX(coalesce(streak, 0)) FROM habits
+                    WHERE username IS NOT NULL GROUP BY username''')
+    conn.execute('''INSERT INTO leaderboard_counts (board, streak, n)
+                    SELECT '', streak, COUNT(*) FROM leaderboard_users GROUP BY streak''')
+
+
+
+def _progress_snapshot_tables(conn):
+    # Daily time series for progress charts: each habit's streak and each
+    # user's total tab time at the end of every UTC day, keyed so that a
+    # user's range is one contiguous index read.
+    conn.execute('''CREATE TABLE IF NOT EXISTS habit_snapshots (
+                        username TEXT NOT NULL,
+                        day_start INTEGER NOT NULL,
+                        habit_id INTEGER NOT NULL,
+                        streak INTEGER NOT NULL,
+                        PRIMARY KEY (username, day_start, habit_id)
+                    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS tab_time_snapshots (
+                        username TEXT NOT NULL,
+                        day_start INTEGER NOT NULL,
+                        seconds REAL NOT NULL,
+                        PRIMARY KEY (username, day_start)
+                    ) WITHOUT ROWID''')
+    # Past tab time is already in the daily rollup; streak history starts now.
+    conn.execute('''INSERT OR IGNORE INTO tab_time_snapshots (username, day_start, seconds)
+                    SELECT username, day_start, SUM(seconds) FROM tab_usage_daily
+                    WHERE username IS NOT NULL GROUP BY username, day_start''')
+
+
+def _shard_catalog_tables(conn):
+    # Only used in the main database, which doubles as the shard catalog;
+    # see the Sharding section of database.py. No row means sharding is off.
+    conn.execute('''CREATE TABLE IF NOT EXISTS shard_settings (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        mode TEXT NOT NULL,
+                        shards INTEGER NOT NULL
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_shards (
+                        username TEXT PRIMARY KEY,
+                        shard INTEGER NOT NULL
+                    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_shards_shard ON user_shards (shard)')
+
+
+def _tab_visits_table(conn):
+    # Tab events past their retention period are folded into per-day visit
+    # counts before they are deleted (see retention.py); the time spent is
+    # already in the usage rollups.
+    conn.execute('''CREATE TABLE IF NOT EXISTS tab_visits_daily (
+                        username TEXT,
+                        day_start INTEGER,
+                        domain TEXT,
+                        visits INTEGER NOT NULL,
+                        PRIMARY KEY (username, day_start, domain)
+                    ) WITHOUT ROWID''')
+
+
+def _sync_clients_full_seq(conn):
+    # Sequence number of each client's latest full snapshot, so a delta that
+    # was queued before it can be recognised as stale (see ingest.py).
+    columns = [column[1] for column in conn.execute('PRAGMA table_info(sync_clients)')]
+    if 'full_seq' not in columns:
+        conn.execute('ALTER TABLE sync_clients ADD COLUMN full_seq INTEGER NOT NULL DEFAULT 0')
+
+
+def _leases_table(conn):
+    # Short-lived claims that keep worker processes from doing the same work
+    # twice: a periodic job run, or one user's message generation.
+    conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+                        name TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    )''')
+
+
+def _tabs_timestamp_index(conn):
+    # Retention deletes stale tabs by age across all users; without this
+    # every batch scans the whole table.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tabs_timestamp ON tabs (timestamp)')
+
+
+def _drop_unused_due_index(conn):
+    # Only the cross-user due query used this index, and it is gone: expiry
+    # has idx_habits_expiry and per-user lookups idx_habits_user_due.
+    conn.execute('DROP INDEX IF EXISTS idx_habits_due')
+
+# (version, description, step). Versions must be consecutive.
+MIGRATIONS = [
+    (1, 'users and habits tables', _baseline_user_tables),
+    (2, 'tabs, tab events and usage rollups', _baseline_tab_tables),
+    (3, 'indexes for habit and tab lookups', _hot_path_indexes),
+    (4, 'llm response cache', _llm_cache_table),
+    (5, 'per-user data versions', _data_versions_table),
+    (6, 'habit check-in history', _habit_checkins_table),
+    (7, 'habit due dates for streak expiry', _habit_next_due),
+    (8, 'indexes for due-habit queries', _habit_due_indexes),
+    (9, 'extension sync sequence numbers', _sync_clients_table),
+    (10, 'pre-generated messages', _generated_messages_table),
+    (11, 'notifications for the extension', _notifications_table),
+    (12, 'streak leaderboard', _leaderboard_tables),
+    (13, 'daily progress snapshots', _progress_snapshot_tables),
+    (14, 'shard catalog', _shard_catalog_tables),
+    (15, 'daily tab visit counts', _tab_visits_table),
+    (16, 'full snapshot sequence numbers', _sync_clients_full_seq),
+    (17, 'job and pre-generation leases', _leases_table),
+    (18, 'index for pruning stale tabs', _tabs_timestamp_index),
+    (19, 'drop unused due-date index', _drop_unused_due_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# --- Runner ---
+
+def _create_version_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_at INTEGER)''')
+
+
+def get_schema_version(conn):
+    """
+    Return the highest migration applied to the database, or 0 for a fresh one.
+    """
+    _create_version_table(conn)
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn):
+    """
+    Apply every pending migration inside one write transaction.
+    `conn` must be in autocommit mode (isolation_level=None). Another process
+    migrating at the same time blocks on the write lock, then finds nothing
+    left to do. Returns the list of versions applied.
+    """
+    if get_schema_version(conn) >= LATEST_VERSION:
+        return []
+    applied = []
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = get_schema_version(conn)
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            step(conn)
+            conn.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                         (version, description, int(time.time())))
+            applied.append(version)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return applied
+
+
+if __name__ == '__main__':
+    import database
+    conn = database.get_connection()
+    print(f"Schema version before: {get_schema_version(conn)}")
+    print(f"Applied migrations: {migrate(conn) or 'none'}")
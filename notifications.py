@@ -0,0 +1,142 @@
+# notifications.py
+# Pushes per-user notifications to the extension as server-sent events.
+#
+# The notifications table is the source of truth, so a notification written
+# by any process (the Streamlit app, another API worker, the pregen threads)
+# reaches every connected client. Each process runs one NotificationHub that
+# polls the table for new rows with a single query, however many clients are
+# connected, and hands each row to that user's subscribers. Clients resume
+# after a reconnect by sending the last event id they saw.
+import logging
+import os
+import threading
+
+from database import get_all_notifications_since, get_last_notification_id, get_notifications
+
+logger = logging.getLogger(__name__)
+
+EVENTS_POLL_INTERVAL = float(os.environ.get('GOOD_HABITS_EVENTS_POLL_INTERVAL', '1.0'))
+EVENTS_HEARTBEAT = float(os.environ.get('GOOD_HABITS_EVENTS_HEARTBEAT', '15'))
+# How long the browser waits before reconnecting, in milliseconds.
+EVENTS_RETRY_MS = 5000
+# Most notifications replayed to a client that reconnects.
+EVENTS_BACKLOG = 100
+
+
+def format_event(row):
+    """
+    Encode an (id, kind, payload_json, created_at) row as one SSE message.
+    """
+    return f"id: {row[0]}\nevent: {row[1]}\ndata: {row[2]}\n\n".encode()
+
+
+def format_comment(text):
+    # Comment lines keep idle connections (and proxies) from timing out.
+    return f": {text}\n\n".encode()
+
+
+def stream_preamble():
+    return f"retry: {EVENTS_RETRY_MS}\n\n".encode()
+
+
+def parse_last_event_id(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backlog(username, last_event_id):
+    """
+    Notifications the client missed since `last_event_id`, or none for a new client.
+    """
+    if last_event_id is None:
+        return []
+    return get_notifications(username, last_event_id, EVENTS_BACKLOG)
+
+
+class NotificationHub:
+    """
+    Fans new notification rows out to subscribers in this process.
+    Subscribers are callables taking a (id, kind, payload_json, created_at)
+    row; they are called on the hub's polling thread and must not block.
+    """
+
+    def __init__(self, interval=EVENTS_POLL_INTERVAL):
+        self.interval = interval
+        self.stats = {'polls': 0, 'delivered': 0, 'errors': 0}
+        self._subscribers = {}
+        self._last_id = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def subscribe(self, username, callback):
+        """
+        Start sending the user's new notifications to `callback`.
+        Returns a function that cancels the subscription.
+        """
+        with self._lock:
+            self._subscribers.setdefault(username, set()).add(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='notification-hub', daemon=True)
+                self._thread.start()
+            self._wakeup.set()
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self._subscribers.get(username)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self._subscribers[username]
+        return unsubscribe
+
+    def connections(self):
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._subscribers.values())
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._subscribers
+            if idle:
+                # Sleep until someone subscribes; nothing needs polling meanwhile.
+                self._wakeup.wait()
+                self._wakeup.clear()
+                self._last_id = None
+            try:
+                self.poll()
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("Polling notifications failed")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def poll(self):
+        if self._last_id is None:
+            # Subscribers catch up on older rows through their backlog.
+            self._last_id = get_last_notification_id()
+            return
+        self.stats['polls'] += 1
+        rows = get_all_notifications_since(self._last_id)
+        for notification_id, username, kind, payload, created_at in rows:
+            with self._lock:
+                callbacks = list(self._subscribers.get(username, ()))
+            for callback in callbacks:
+                try:
+                    callback((notification_id, kind, payload, created_at))
+                    self.stats['delivered'] += 1
+                except Exception:
+                    logger.exception("Notification subscriber failed")
+            self._last_id = notification_id
+
+
+hub = NotificationHub()
+
+
+def collect_events_stats():
+    stats = [('good_habits_events_connections', 'gauge', "Open /events connections.", hub.connections())]
+    for name, value in hub.stats.items():
+        stats.append((f'good_habits_events_{name}_total', 'counter', f"Notification hub: {name}.", value))
+    return stats
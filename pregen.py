@@ -0,0 +1,297 @@
+# pregen.py
+# Pre-generates each active user's AI messages (the tab analysis and an
+# encouragement for the day) in the background, so the dashboard and the extension can
+# show them without waiting for OpenAI. A user is regenerated when their data
+# changes: right after the ingest writer stores their tabs, and from a
+# periodic scan that also picks up habit changes made in the Streamlit app.
+#
+# Requests for a user are coalesced, no user is regenerated more often than
+# GOOD_HABITS_PREGEN_MIN_INTERVAL seconds, and at most
+# GOOD_HABITS_PREGEN_CONCURRENCY OpenAI calls run at once. With several
+# worker processes, a user is generated by whichever takes their lease in
+# the database first; the others skip them.
+import logging
+import os
+import threading
+import time
+
+from analytics import get_tab_stats
+from chat_functions import ENCOURAGEMENT_QUERY, TAB_ANALYSIS_QUERY, chat_with_gpt, get_tab_stat_context
+from database import (
+    acquire_lease, add_notification, all_shards, get_connection, get_data_version, release_lease,
+    user_connection, user_shard, user_transaction
+)
+from metrics import instrument_db
+
+logger = logging.getLogger(__name__)
+
+PREGEN_ENABLED = os.environ.get('GOOD_HABITS_PREGEN', '1') != '0'
+PREGEN_CONCURRENCY = int(os.environ.get('GOOD_HABITS_PREGEN_CONCURRENCY', '2'))
+PREGEN_MIN_INTERVAL = float(os.environ.get('GOOD_HABITS_PREGEN_MIN_INTERVAL', '900'))
+PREGEN_SCAN_INTERVAL = float(os.environ.get('GOOD_HABITS_PREGEN_SCAN_INTERVAL', '600'))
+PREGEN_SCAN_LIMIT = 500
+# How long a process may hold a user's lease, long enough for both OpenAI calls.
+PREGEN_LEASE_SECONDS = 300
+# Finish times kept for the min-interval check.
+MAX_TRACKED_USERS = 10000
+
+MESSAGE_KINDS = ('encouragement', 'tab_analysis')
+
+
+# --- Storage ---
+
+@instrument_db
+def get_generated_messages(username):
+    """
+    Return {kind: (content, data_version, created_at)} for the user's stored messages.
+    """
+    conn = user_connection(username)
+    rows = conn.execute('''SELECT kind, content, data_version, created_at
+                           FROM generated_messages WHERE username = ?''', (username.strip(),))
+    return {row[0]: row[1:] for row in rows}
+
+@instrument_db
+def store_generated_message(username, kind, content, data_version, notify=True):
+    """
+    Save the message and, with `notify`, push it to the user's extension.
+    """
+    now = int(time.time())
+    with user_transaction(username) as conn:
+        if notify:
+            add_notification(conn, username, kind, content)
+        conn.execute(
+            '''INSERT INTO generated_messages (username, kind, content, data_version, created_at)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (username, kind) DO UPDATE SET
+                   content = excluded.content,
+                   data_version = excluded.data_version,
+                   created_at = excluded.created_at''',
+            (username, kind, content, data_version, now)
+        )
+
+@instrument_db
+def find_stale_users(limit=PREGEN_SCAN_LIMIT):
+    """
+    Return users with a message older than the data it is based on: the
+    encouragement follows the habits version, the tab analysis the tabs version.
+    """
+    usernames = []
+    for shard in all_shards():
+        if len(usernames) >= limit:
+            break
+        rows = get_connection(shard).execute(
+            '''SELECT d.username FROM data_versions d
+               LEFT JOIN generated_messages e
+                   ON e.username = d.username AND e.kind = 'encouragement'
+               LEFT JOIN generated_messages t
+                   ON t.username = d.username AND t.kind = 'tab_analysis'
+               WHERE e.data_version IS NOT d.habits_version
+                  OR (d.tabs_version > 0 AND t.data_version IS NOT d.tabs_version)
+               LIMIT ?''',
+            (limit - len(usernames),)
+        )
+        usernames.extend(row[0] for row in rows)
+    return usernames
+
+def generate_messages(username):
+    """
+    Generate and store the user's messages that are out of date.
+    Returns the kinds that were generated, or None when another process
+    holds the user's lease; that process, or the next scan, brings them up to date.
+    """
+    lease, shard = f'pregen:{username}', user_shard(username)
+    if not acquire_lease(lease, PREGEN_LEASE_SECONDS, shard=shard):
+        return None
+    try:
+        # Read after taking the lease: another process may have just stored them.
+        return _generate_stale_messages(username)
+    finally:
+        release_lease(lease, shard=shard)
+
+def _generate_stale_messages(username):
+    stored = get_generated_messages(username)
+    generated = []
+    habits_version = get_data_version(username, 'habits')
+    if stored.get('encouragement', (None, None))[1] != habits_version:
+        content = chat_with_gpt(ENCOURAGEMENT_QUERY, username)
+        store_generated_message(username, 'encouragement', content, habits_version)
+        generated.append('encouragement')
+    tabs_version = get_data_version(username, 'tabs')
+    if stored.get('tab_analysis', (None, None))[1] != tabs_version:
+        if get_tab_stats(username)['total_seconds']:
+            query = TAB_ANALYSIS_QUERY.format(tab_context=get_tab_stat_context(username))
+            store_generated_message(username, 'tab_analysis', chat_with_gpt(query, username), tabs_version)
+        else:
+            store_generated_message(username, 'tab_analysis', "No browsing reported in the last week.",
+                                    tabs_version, notify=False)
+        generated.append('tab_analysis')
+    return generated
+
+
+# --- Worker ---
+
+class MessagePregenerator:
+    """
+    Pool of `concurrency` threads that regenerate requested users' messages.
+    A user is held back until `min_interval` seconds after their last run,
+    and requests that arrive meanwhile are merged into one.
+    """
+
+    def __init__(self, concurrency=PREGEN_CONCURRENCY, min_interval=PREGEN_MIN_INTERVAL):
+        self.concurrency = concurrency
+        self.min_interval = min_interval
+        self.stats = {
+            'requested': 0,
+            'coalesced': 0,
+            'generated': 0,
+            'skipped': 0,
+            'errors': 0,
+        }
+        # username -> earliest time it may run
+        self._pending = {}
+        self._running = set()
+        self._finished = {}
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if not self._threads:
+                self._stopped = False
+                for i in range(self.concurrency):
+                    thread = threading.Thread(target=self._run, name=f'pregen-{i}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        return self
+
+    def request(self, username):
+        with self._cond:
+            self.stats['requested'] += 1
+            if username in self._pending:
+                self.stats['coalesced'] += 1
+                return
+            self._pending[username] = self._finished.get(username, 0) + self.min_interval
+            self._cond.notify()
+
+    def request_many(self, usernames):
+        for username in usernames:
+            self.request(username)
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _next(self):
+        # Wait for a pending user that is due and not being generated.
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                ready = [(not_before, username) for username, not_before in self._pending.items()
+                         if username not in self._running]
+                if ready:
+                    not_before, username = min(ready)
+                    if not_before <= now:
+                        del self._pending[username]
+                        self._running.add(username)
+                        return username
+                    self._cond.wait(not_before - now)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _run(self):
+        while True:
+            username = self._next()
+            if username is None:
+                return
+            try:
+                generated = generate_messages(username)
+            except Exception:
+                logger.exception("Generating messages for %s failed", username)
+                with self._cond:
+                    self.stats['errors'] += 1
+            else:
+                with self._cond:
+                    if generated is None:
+                        self.stats['skipped'] += 1
+                    else:
+                        self.stats['generated'] += len(generated)
+            finally:
+                with self._cond:
+                    self._running.discard(username)
+                    now = time.time()
+                    if len(self._finished) >= MAX_TRACKED_USERS:
+                        self._finished.clear()
+                    self._finished[username] = now
+                    if username in self._pending:
+                        self._pending[username] = max(self._pending[username], now + self.min_interval)
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Block until no user is being generated or due to be. Users held
+        back by the minimum interval are not waited for.
+        Returns False if the timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._running or any(not_before <= time.time() for not_before in self._pending.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+
+_pregenerator = None
+_pregenerator_lock = threading.Lock()
+
+
+def get_pregenerator():
+    """
+    Return the process-wide pregenerator, starting its threads if they aren't running.
+    """
+    global _pregenerator
+    with _pregenerator_lock:
+        if _pregenerator is None:
+            _pregenerator = MessagePregenerator()
+        return _pregenerator.start()
+
+
+def collect_pregen_stats():
+    """
+    Metrics collector; reports nothing until the pregenerator has been started.
+    """
+    pregenerator = _pregenerator
+    if pregenerator is None:
+        return []
+    stats = [('good_habits_pregen_queue_depth', 'gauge', "Users waiting for messages.",
+              pregenerator.depth())]
+    for name, value in pregenerator.stats.items():
+        stats.append((f'good_habits_pregen_{name}_total', 'counter',
+                      f"Message pre-generation: {name}.", value))
+    return stats
+
+
+def stop_pregenerator():
+    with _pregenerator_lock:
+        if _pregenerator is not None:
+            _pregenerator.stop()
+
+
+def queue_stale_users():
+    """
+    Periodic job: request regeneration for every user whose data changed.
+    """
+    usernames = find_stale_users()
+    get_pregenerator().request_many(usernames)
+    return len(usernames)
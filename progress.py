@@ -0,0 +1,108 @@
+# progress.py
+# Time series for the dashboard's progress charts. A periodic job copies
+# every habit's streak and every user's tab time into daily snapshot tables
+# (see migrations.py); the charts then read a date range back with one
+# query per series instead of rebuilding history from check-ins and tab
+# events. Long ranges are downsampled in SQL to at most `max_points` buckets.
+import math
+import time
+
+from database import DAY, all_shards, transaction, user_connection
+from metrics import instrument_db
+
+DEFAULT_RANGE_DAYS = 90
+MAX_POINTS = 120
+
+
+@instrument_db
+def snapshot_progress(now=None):
+    """
+    Record today's streak for every habit and the tab time of yesterday and
+    today for every user. Safe to run any number of times a day: the last
+    run of a day leaves that day's final values. Returns the habits recorded.
+    """
+    now = int(now if now is not None else time.time())
+    today = now // DAY * DAY
+    recorded = 0
+    for shard in all_shards():
+        recorded += _snapshot_shard(shard, today)
+    return recorded
+
+
+def _snapshot_shard(shard, today):
+    with transaction(shard=shard) as conn:
+        cursor = conn.execute(
+            '''INSERT INTO habit_snapshots (username, day_start, habit_id, streak)
+               SELECT username, ?, id, coalesce(streak, 0) FROM habits
+               WHERE username IS NOT NULL
+               ON CONFLICT (username, day_start, habit_id) DO UPDATE SET streak = excluded.streak''',
+            (today,)
+        )
+        recorded = cursor.rowcount
+        # Yesterday is included so time tracked after its last snapshot still counts.
+        conn.execute(
+            '''INSERT INTO tab_time_snapshots (username, day_start, seconds)
+               SELECT username, day_start, SUM(seconds) FROM tab_usage_daily
+               WHERE day_start IN (?, ?) AND username IS NOT NULL
+               GROUP BY username, day_start
+               ON CONFLICT (username, day_start) DO UPDATE SET seconds = excluded.seconds''',
+            (today - DAY, today)
+        )
+    return recorded
+
+
+def _buckets(days, until, max_points):
+    # Buckets of whole days ending with the day `until` falls in, so none is partial.
+    end = until // DAY * DAY + DAY
+    bucket_days = max(1, math.ceil(days / max_points))
+    count = math.ceil(days / bucket_days)
+    size = bucket_days * DAY
+    return end - count * size, size, count
+
+
+@instrument_db
+def get_progress_series(username, days=DEFAULT_RANGE_DAYS, until=None, max_points=MAX_POINTS):
+    """
+    Return the user's progress over the `days` days up to `until` as aligned lists:
+    {'day': bucket start timestamps, 'bucket_days': days per point,
+     'streaks': {habit name: best streak in each bucket, None before it was tracked},
+     'tab_seconds': average tab time per day in each bucket}.
+    """
+    until = int(until if until is not None else time.time())
+    start, size, count = _buckets(days, until, max_points)
+    end = start + count * size
+    conn = user_connection(username)
+
+    streaks = {}
+    names = {}
+    rows = conn.execute(
+        '''SELECT (s.day_start - ?) / ?, s.habit_id, h.habit_name, MAX(s.streak)
+           FROM habit_snapshots s JOIN habits h ON h.id = s.habit_id
+           WHERE s.username = ? AND s.day_start >= ? AND s.day_start < ?
+           GROUP BY 1, 2''',
+        (start, size, username, start, end)
+    )
+    for bucket, habit_id, name, streak in rows:
+        if habit_id not in streaks:
+            streaks[habit_id] = [None] * count
+            # Habits sharing a name get their id appended so neither series is lost.
+            label = name if name not in names.values() else f"{name} (#{habit_id})"
+            names[habit_id] = label
+        streaks[habit_id][bucket] = streak
+
+    tab_seconds = [0.0] * count
+    rows = conn.execute(
+        '''SELECT (day_start - ?) / ?, SUM(seconds) FROM tab_time_snapshots
+           WHERE username = ? AND day_start >= ? AND day_start < ?
+           GROUP BY 1''',
+        (start, size, username.strip(), start, end)
+    )
+    for bucket, seconds in rows:
+        tab_seconds[bucket] = seconds / (size // DAY)
+
+    return {
+        'day': [start + i * size for i in range(count)],
+        'bucket_days': size // DAY,
+        'streaks': {names[habit_id]: values for habit_id, values in streaks.items()},
+        'tab_seconds': tab_seconds,
+    }
@@ -0,0 +1,88 @@
+# prompt_builder.py
+# Keeps the context sent to the model within a token budget. Callers rank
+# their lines most relevant first; fit_lines keeps as many as fit and sums up
+# the rest in one line. URLs in generated context (habit names, tab stats)
+# are collapsed to their domain; the user's own question is left as written.
+#
+# Token counts come from tiktoken when it is installed, otherwise from an
+# estimate of four characters per token, which is close for English text.
+import math
+import os
+import re
+
+from database import get_domain
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token budgets for each part of a request.
+HABIT_CONTEXT_TOKENS = int(os.environ.get('GOOD_HABITS_PROMPT_HABIT_TOKENS', '400'))
+TAB_CONTEXT_TOKENS = int(os.environ.get('GOOD_HABITS_PROMPT_TAB_TOKENS', '250'))
+QUERY_TOKENS = int(os.environ.get('GOOD_HABITS_PROMPT_QUERY_TOKENS', '1000'))
+
+CHARS_PER_TOKEN = 4
+URL_PATTERN = re.compile(r"https?://[^\s'\"<>()]+")
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding('o200k_base')
+        except Exception:
+            # The encoding file may not be downloadable; fall back to the estimate.
+            return None
+    return _encoding
+
+
+def estimate_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_budget(text, budget):
+    """
+    Cut `text` to at most `budget` tokens, marking the cut with "…".
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[:max(budget - 1, 0)]) + "…"
+    return text[:max(budget - 1, 0) * CHARS_PER_TOKEN] + "…"
+
+
+def collapse_urls(text):
+    """
+    Replace every URL in `text` with its domain, e.g. a long Google redirect
+    link becomes "youtube.com".
+    """
+    return URL_PATTERN.sub(lambda match: get_domain(match.group(0)), text)
+
+
+def fit_lines(lines, budget, summarize=None, header=None):
+    """
+    Join as many of `lines` (most relevant first) as fit in `budget` tokens.
+    If some are left out, summarize(dropped_lines) supplies a closing line
+    (by default "...and N more.") that is counted against the budget too.
+    """
+    summarize = summarize or (lambda dropped: f"...and {len(dropped)} more.")
+    kept = [header] if header else []
+    used = sum(estimate_tokens(line) + 1 for line in kept)
+    # Room kept free for the summary line; summing up every line gives the longest one.
+    reserve = estimate_tokens(summarize(lines)) + 1 if lines else 0
+    for i, line in enumerate(lines):
+        cost = estimate_tokens(line) + 1
+        last = i == len(lines) - 1
+        if used + cost + (0 if last else reserve) > budget:
+            kept.append(summarize(lines[i:]))
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept)
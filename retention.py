@@ -0,0 +1,276 @@
+# retention.py
+# Keeps the database from growing without bound. Tab history past its
+# retention period is downsampled and deleted, and the freed pages are
+# returned to the filesystem with an incremental vacuum.
+#
+#   python retention.py --dry-run    # report what would be deleted and reclaimed
+#   python retention.py              # apply the retention rules
+#   python retention.py --vacuum     # also run a full VACUUM (needed once for older files)
+#
+# Rules, each in days (0 keeps everything):
+#   tab_events          folded into per-day visit counts, then deleted
+#   tab_usage_hourly    deleted; the same time is kept in tab_usage_daily
+#   tabs                rows no extension has reported for this long are dropped
+#   notifications, sync_clients (in the main database)
+# Deletes run in short transactions of at most RETENTION_BATCH_ROWS rows with
+# a pause in between, so extension writes are never held up for long.
+# In the API server this runs as a periodic job, which only one worker
+# process takes per interval (see jobs.py).
+import argparse
+import json
+import logging
+import os
+import time
+
+from database import DAY, HOUR, all_shards, bump_data_version, ensure_schema, get_connection, transaction
+from log_utils import elapsed_ms, log_event
+
+logger = logging.getLogger(__name__)
+
+RETAIN_TAB_EVENTS_DAYS = int(os.environ.get('GOOD_HABITS_RETAIN_TAB_EVENTS_DAYS', '30'))
+RETAIN_HOURLY_DAYS = int(os.environ.get('GOOD_HABITS_RETAIN_HOURLY_DAYS', '90'))
+RETAIN_STALE_TABS_DAYS = int(os.environ.get('GOOD_HABITS_RETAIN_STALE_TABS_DAYS', '30'))
+RETAIN_NOTIFICATIONS_DAYS = int(os.environ.get('GOOD_HABITS_RETAIN_NOTIFICATIONS_DAYS', '30'))
+RETAIN_SYNC_CLIENTS_DAYS = int(os.environ.get('GOOD_HABITS_RETAIN_SYNC_CLIENTS_DAYS', '90'))
+RETENTION_BATCH_ROWS = int(os.environ.get('GOOD_HABITS_RETENTION_BATCH_ROWS', '5000'))
+RETENTION_BATCH_PAUSE = float(os.environ.get('GOOD_HABITS_RETENTION_BATCH_PAUSE', '0.05'))
+# Pages freed per incremental_vacuum step; each step holds the write lock briefly.
+VACUUM_STEP_PAGES = 2000
+
+
+def _cutoff(now, days):
+    return now - days * DAY if days > 0 else None
+
+
+def _pause():
+    if RETENTION_BATCH_PAUSE:
+        time.sleep(RETENTION_BATCH_PAUSE)
+
+
+# --- Rules ---
+# Each rule takes (shard, cutoff, dry_run) and returns the rows it deleted,
+# or would delete.
+
+def _first_id_after(conn, table, time_column, cutoff):
+    # Ids grow with time in these append-only tables, so everything below the
+    # first id at or after the cutoff is old. Only the old rows are scanned.
+    row = conn.execute(f'SELECT MIN(id), MAX(id) FROM {table}').fetchone()
+    if row[0] is None:
+        return None
+    first = conn.execute(f'SELECT id FROM {table} WHERE {time_column} >= ? ORDER BY id LIMIT 1',
+                         (cutoff,)).fetchone()
+    return first[0] if first else row[1] + 1
+
+
+def _delete_id_range(shard, table, end_id, before_delete=None):
+    # Delete rows with id < end_id from the oldest, one batch per transaction.
+    deleted = 0
+    while True:
+        with transaction(shard=shard) as conn:
+            row = conn.execute(
+                f'''SELECT MIN(id), MAX(id), COUNT(*) FROM (
+                        SELECT id FROM {table} WHERE id < ? ORDER BY id LIMIT ?)''',
+                (end_id, RETENTION_BATCH_ROWS)
+            ).fetchone()
+            if not row[2]:
+                return deleted
+            if before_delete:
+                before_delete(conn, row[0], row[1])
+            conn.execute(f'DELETE FROM {table} WHERE id BETWEEN ? AND ?', (row[0], row[1]))
+        deleted += row[2]
+        _pause()
+
+
+def _fold_tab_events(conn, first_id, last_id):
+    # Keep how often each domain was visited per day.
+    conn.execute(
+        f'''INSERT INTO tab_visits_daily (username, day_start, domain, visits)
+            SELECT username, timestamp / {DAY} * {DAY}, domain, COUNT(*) FROM tab_events
+            WHERE id BETWEEN ? AND ? AND event IN ('opened', 'updated') AND username IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (username, day_start, domain) DO UPDATE SET visits = visits + excluded.visits''',
+        (first_id, last_id)
+    )
+
+
+def prune_tab_events(shard, cutoff, dry_run=False):
+    conn = get_connection(shard)
+    end_id = _first_id_after(conn, 'tab_events', 'timestamp', cutoff)
+    if end_id is None:
+        return 0
+    if dry_run:
+        return conn.execute('SELECT COUNT(*) FROM tab_events WHERE id < ?', (end_id,)).fetchone()[0]
+    return _delete_id_range(shard, 'tab_events', end_id, _fold_tab_events)
+
+
+def prune_hourly_usage(shard, cutoff, dry_run=False):
+    # One user at a time: each delete is a range of the primary key.
+    cutoff = cutoff // HOUR * HOUR
+    conn = get_connection(shard)
+    usernames = [row[0] for row in conn.execute('SELECT DISTINCT username FROM tab_usage_hourly')]
+    deleted = 0
+    for username in usernames:
+        if dry_run:
+            deleted += conn.execute(
+                'SELECT COUNT(*) FROM tab_usage_hourly WHERE username IS ? AND hour_start < ?',
+                (username, cutoff)).fetchone()[0]
+            continue
+        with transaction(shard=shard) as conn:
+            deleted += conn.execute('DELETE FROM tab_usage_hourly WHERE username IS ? AND hour_start < ?',
+                                    (username, cutoff)).rowcount
+        _pause()
+    return deleted
+
+
+def prune_stale_tabs(shard, cutoff, dry_run=False):
+    # Tabs left open when an extension stopped reporting. Their time is
+    # already counted, so only the row goes.
+    conn = get_connection(shard)
+    if dry_run:
+        return conn.execute('SELECT COUNT(*) FROM tabs WHERE timestamp < ?', (cutoff,)).fetchone()[0]
+    deleted = 0
+    while True:
+        with transaction(shard=shard) as conn:
+            rows = conn.execute(
+                '''DELETE FROM tabs WHERE id IN (SELECT id FROM tabs WHERE timestamp < ? LIMIT ?)
+                   RETURNING username''',
+                (cutoff, RETENTION_BATCH_ROWS)
+            ).fetchall()
+            for username in {row[0] for row in rows if row[0] is not None}:
+                bump_data_version(conn, username, 'tabs')
+        deleted += len(rows)
+        if len(rows) < RETENTION_BATCH_ROWS:
+            return deleted
+        _pause()
+
+
+def prune_notifications(shard, cutoff, dry_run=False):
+    conn = get_connection(shard)
+    end_id = _first_id_after(conn, 'notifications', 'created_at', cutoff)
+    if end_id is None:
+        return 0
+    if dry_run:
+        return conn.execute('SELECT COUNT(*) FROM notifications WHERE id < ?', (end_id,)).fetchone()[0]
+    return _delete_id_range(shard, 'notifications', end_id)
+
+
+def prune_sync_clients(shard, cutoff, dry_run=False):
+    # Clients that come back after this get a resync, which is harmless.
+    conn = get_connection(shard)
+    if dry_run:
+        return conn.execute('SELECT COUNT(*) FROM sync_clients WHERE updated_at < ?', (cutoff,)).fetchone()[0]
+    with transaction(shard=shard) as conn:
+        return conn.execute('DELETE FROM sync_clients WHERE updated_at < ?', (cutoff,)).rowcount
+
+
+# (table, rule, days, where) -- 'shards' rules run on every shard, 'main' on the main database.
+RULES = [
+    ('tab_events', prune_tab_events, RETAIN_TAB_EVENTS_DAYS, 'shards'),
+    ('tab_usage_hourly', prune_hourly_usage, RETAIN_HOURLY_DAYS, 'shards'),
+    ('tabs', prune_stale_tabs, RETAIN_STALE_TABS_DAYS, 'shards'),
+    ('notifications', prune_notifications, RETAIN_NOTIFICATIONS_DAYS, 'main'),
+    ('sync_clients', prune_sync_clients, RETAIN_SYNC_CLIENTS_DAYS, 'main'),
+]
+
+
+# --- Space ---
+
+def _table_bytes(conn, table):
+    # Size on disk from the dbstat table, or None where SQLite was built without it.
+    try:
+        row = conn.execute('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (table,)).fetchone()
+    except Exception:
+        return None
+    return row[0] or 0
+
+
+def _space(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return {
+        'file_bytes': conn.execute('PRAGMA page_count').fetchone()[0] * page_size,
+        'free_bytes': conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size,
+        'incremental_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2,
+    }
+
+
+def incremental_vacuum(shard):
+    """
+    Return free pages to the filesystem a step at a time. Does nothing for
+    files not yet converted to auto_vacuum=INCREMENTAL (see --vacuum).
+    Returns the bytes released.
+    """
+    conn = get_connection(shard)
+    before = _space(conn)
+    if not before['incremental_vacuum']:
+        return 0
+    while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+        _pause()
+    return before['file_bytes'] - _space(conn)['file_bytes']
+
+
+def full_vacuum(shard):
+    # Rewrites the whole file, and switches it to auto_vacuum=INCREMENTAL.
+    conn = get_connection(shard)
+    before = _space(conn)['file_bytes']
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+    return before - _space(conn)['file_bytes']
+
+
+# --- Runner ---
+
+def run_retention(now=None, dry_run=False, vacuum=False):
+    """
+    Apply every retention rule to every database file, then vacuum.
+    With `dry_run`, nothing changes and the report says what would be
+    deleted and roughly how much space that frees.
+    Returns {database shard: report}.
+    """
+    ensure_schema()
+    started = time.perf_counter()
+    now = int(now if now is not None else time.time())
+    reports = {}
+    # The main database is included when sharded: it holds notifications and sync_clients.
+    for shard in sorted(set(all_shards()) | {0}):
+        conn = get_connection(shard)
+        report = reports[shard] = {'deleted': {}, 'estimated_bytes': 0}
+        for table, rule, days, where in RULES:
+            cutoff = _cutoff(now, days)
+            if cutoff is None or (where == 'main' and shard != 0):
+                continue
+            rows = rule(shard, cutoff, dry_run)
+            report['deleted'][table] = rows
+            if dry_run and rows:
+                total = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                size = _table_bytes(conn, table)
+                if size is None:
+                    report['estimated_bytes'] = None
+                elif report['estimated_bytes'] is not None:
+                    report['estimated_bytes'] += size * rows // max(total, 1)
+        if dry_run:
+            report.update(_space(conn))
+            if report['estimated_bytes'] is not None:
+                # Free pages that are already there are reclaimed too.
+                report['estimated_bytes'] += report['free_bytes']
+            continue
+        del report['estimated_bytes']
+        report['reclaimed_bytes'] = full_vacuum(shard) if vacuum else incremental_vacuum(shard)
+        report.update(_space(conn))
+    log_event(logger, logging.INFO, 'retention_finished', dry_run=dry_run,
+              deleted=sum(sum(report['deleted'].values()) for report in reports.values()),
+              ms=elapsed_ms(started))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the tab data retention rules.")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be deleted")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="run a full VACUUM afterwards (blocks writers; converts older files)")
+    args = parser.parse_args()
+    print(json.dumps(run_retention(dry_run=args.dry_run, vacuum=args.vacuum), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+# serve.py
+# Production entry point for the extension API. The Flask app from api.py is
+# served over ASGI by uvicorn; each request runs on a bounded thread pool so
+# database work never blocks the event loop. The long-lived /events streams
+# are handled on the event loop itself.
+#
+#   python serve.py --workers 4 --threads 8 --port 5000
+import argparse
+import asyncio
+import io
+import logging
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from api import MAX_BODY_BYTES, app as flask_app
+from ingest import get_ingest_queue
+from jobs import start_background_jobs, stop_background_jobs
+from log_utils import configure_logging
+from metrics import clear_shared_dir, registry
+from notifications import (
+    EVENTS_HEARTBEAT, format_comment, format_event, get_backlog, hub, parse_last_event_id, stream_preamble
+)
+
+logger = logging.getLogger(__name__)
+
+THREADS = int(os.environ.get('GOOD_HABITS_THREADS', '8'))
+
+
+class WSGIBridge:
+    """
+    Minimal ASGI adapter for a WSGI app. The WSGI call, including anything it
+    does with the database, runs in `executor`; the event loop only moves
+    bytes. Responses are buffered, which suits the small JSON replies of
+    this API.
+    """
+
+    def __init__(self, wsgi_app, threads=THREADS):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Runs in every worker process; with --workers > 1 they don't
+                # inherit the logging set up in main().
+                configure_logging()
+                self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='api-worker')
+                get_ingest_queue()
+                start_background_jobs()
+                registry.start_sharing()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Finish in-flight requests, then write out queued tab reports.
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _shutdown(self):
+        stop_background_jobs()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        get_ingest_queue().close()
+        registry.stop_sharing()
+
+    async def _http(self, scope, receive, send):
+        if scope['path'] == '/events' and scope['method'] == 'GET':
+            await self._events(scope, receive, send)
+            return
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_BYTES:
+                await _send_simple(send, 413, b'Request body too large')
+                return
+            if not message.get('more_body'):
+                break
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='api-worker')
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(
+            self.executor, self._call_wsgi, scope, bytes(body))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    async def _events(self, scope, receive, send):
+        """
+        Serve /events on the event loop: an idle connection costs a queue and
+        a subscription, not a thread. Same behaviour as api.events.
+        """
+        params = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        username = (params.get('username') or [''])[0].strip()
+        if not username:
+            await _send_simple(send, 400, b'username is required')
+            return
+        headers = {name.decode('latin1'): value.decode('latin1') for name, value in scope.get('headers', [])}
+        last_event_id = parse_last_event_id(
+            headers.get('last-event-id') or (params.get('last_event_id') or [None])[0])
+
+        loop = asyncio.get_running_loop()
+        rows = asyncio.Queue()
+        unsubscribe = hub.subscribe(username, lambda row: loop.call_soon_threadsafe(rows.put_nowait, row))
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            backlog = await loop.run_in_executor(self.executor, get_backlog, username, last_event_id)
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'access-control-allow-origin', b'*'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            chunk = stream_preamble() + b''.join(format_event(row) for row in backlog)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent = backlog[-1][0] if backlog else (last_event_id or 0)
+            while not disconnected.done():
+                getter = asyncio.ensure_future(rows.get())
+                done, _ = await asyncio.wait({getter, disconnected}, timeout=EVENTS_HEARTBEAT,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if getter in done:
+                    row = getter.result()
+                    if row[0] <= sent:
+                        continue
+                    chunk, sent = format_event(row), row[0]
+                else:
+                    getter.cancel()
+                    if disconnected.done():
+                        break
+                    chunk = format_comment('ping')
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            unsubscribe()
+            disconnected.cancel()
+
+    def _call_wsgi(self, scope, body):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                   for name, value in headers]
+
+        result = self.wsgi_app(_build_environ(scope, body), start_response)
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+
+def _build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'content-length':
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_simple(send, status, text):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': text})
+
+
+asgi_app = WSGIBridge(flask_app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Good Habits extension API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('GOOD_HABITS_WORKERS', '1')),
+                        help="number of worker processes")
+    parser.add_argument('--threads', type=int, default=THREADS,
+                        help="database threads per worker process")
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help="seconds to wait for in-flight requests on shutdown")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    # Worker processes import this module again, so pass settings through the environment.
+    os.environ['GOOD_HABITS_THREADS'] = str(args.threads)
+    if args.workers > 1:
+        # Workers share their metrics through files, so any one of them can answer /metrics.
+        metrics_dir = os.environ.get('GOOD_HABITS_METRICS_DIR')
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+            clear_shared_dir(metrics_dir)
+        else:
+            os.environ['GOOD_HABITS_METRICS_DIR'] = tempfile.mkdtemp(prefix='good-habits-metrics-')
+    configure_logging()
+    uvicorn.run(
+        'serve:asgi_app',
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        lifespan='on',
+        access_log=False,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+
+
+if __name__ == '__main__':
+    main()
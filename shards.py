@@ -0,0 +1,134 @@
+# shards.py
+# Splits the single database into per-user shards (see the Sharding section
+# of database.py) and reports how data is spread across them.
+#
+#   python shards.py split --shards 8     # hash users over 8 shard files
+#   python shards.py split --per-user     # one file per user
+#   python shards.py status
+#
+# Stop the Streamlit app and the API before splitting: running processes
+# read the shard settings once and would keep writing to the main database.
+# Each user's rows are copied to their shard first and only removed from the
+# main database at the end, in one transaction, so an interrupted split can
+# simply be run again.
+import argparse
+import json
+import os
+
+import database
+from database import (
+    PER_USER_MAX_FILES, SHARD_ID_BITS, all_shards, ensure_schema, get_connection, get_shard_settings,
+    shard_path, transaction, user_shard
+)
+from migrations import rebuild_leaderboard
+
+# Tables holding per-user rows, moved to the user's shard. Columns listed
+# here are rewritten on the way: habit ids get the shard in their high bits.
+USER_TABLES = {
+    'habits': {'id': 'id + :offset'},
+    'habit_checkins': {'habit_id': 'habit_id + :offset'},
+    'habit_snapshots': {'habit_id': 'habit_id + :offset'},
+    'tabs': {},
+    'tab_events': {},
+    'tab_usage_hourly': {},
+    'tab_usage_daily': {},
+    'tab_visits_daily': {},
+    'tab_time_snapshots': {},
+    'data_versions': {},
+    'generated_messages': {},
+}
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA main.table_info({table})')]
+
+
+def _copy_users(shard, usernames):
+    # Copy the users' rows from the main database into the shard, in one transaction.
+    conn = get_connection(shard)
+    conn.execute('ATTACH DATABASE ? AS catalog', (database.DB_PATH,))
+    try:
+        with transaction(shard=shard):
+            params = {'offset': shard << SHARD_ID_BITS, 'users': json.dumps(usernames)}
+            for table, rewrites in USER_TABLES.items():
+                # Name the columns: ALTER TABLE may have left them in another order.
+                columns = _columns(conn, table)
+                selected = ', '.join(rewrites.get(column, column) for column in columns)
+                conn.execute(
+                    f'''INSERT OR REPLACE INTO main.{table} ({', '.join(columns)})
+                        SELECT {selected} FROM catalog.{table}
+                        WHERE username IN (SELECT value FROM json_each(:users))''',
+                    params
+                )
+            rebuild_leaderboard(conn)
+    finally:
+        conn.execute('DETACH DATABASE catalog')
+
+
+def split(mode, count=0):
+    """
+    Move every user's data out of the main database into shards.
+    Returns {shard: number of users moved}.
+    """
+    ensure_schema()
+    if get_shard_settings()[0] != 'off':
+        raise SystemExit("The database is already sharded.")
+    # Route users as the new mode will, before the mode is saved.
+    database._shard_settings[database.DB_PATH] = (mode, count)
+    conn = get_connection()
+    usernames = set()
+    for table in USER_TABLES:
+        usernames.update(row[0] for row in conn.execute(
+            f'SELECT DISTINCT username FROM {table} WHERE username IS NOT NULL'))
+    if mode == 'per-user' and len(usernames) > PER_USER_MAX_FILES:
+        raise SystemExit(f"{len(usernames)} users would need more than GOOD_HABITS_PER_USER_MAX_FILES="
+                         f"{PER_USER_MAX_FILES} files; use --shards instead.")
+    by_shard = {}
+    for username in sorted(usernames):
+        by_shard.setdefault(user_shard(username), []).append(username)
+    for shard, shard_users in sorted(by_shard.items()):
+        _copy_users(shard, shard_users)
+        print(f"Shard {shard}: {len(shard_users)} users -> {shard_path(shard)}")
+    with transaction() as conn:
+        for table in USER_TABLES:
+            conn.execute(f'DELETE FROM {table} WHERE username IS NOT NULL')
+        rebuild_leaderboard(conn)
+        conn.execute('INSERT INTO shard_settings (id, mode, shards) VALUES (1, ?, ?)', (mode, count))
+    conn.execute('VACUUM')
+    return {shard: len(shard_users) for shard, shard_users in by_shard.items()}
+
+
+def status():
+    mode, count = get_shard_settings()
+    print(f"Mode: {mode}" + (f" ({count} shards)" if mode == 'hash' else ""))
+    for shard in all_shards():
+        path = shard_path(shard)
+        if not os.path.exists(path):
+            continue
+        users, habits = get_connection(shard).execute(
+            'SELECT (SELECT COUNT(*) FROM data_versions), (SELECT COUNT(*) FROM habits)').fetchone()
+        print(f"{path}: {users} users, {habits} habits, {os.path.getsize(path) // 1024} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shard the Good Habits database by user.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    split_parser = commands.add_parser('split', help="move users' data into shard files")
+    target = split_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--shards', type=int, help="number of shard files to hash users over")
+    target.add_argument('--per-user', action='store_true', help="give every user their own file")
+    commands.add_parser('status', help="show the shard settings and sizes")
+    args = parser.parse_args()
+    if args.command == 'split':
+        if args.per_user:
+            split('per-user')
+        elif args.shards < 1:
+            parser.error("--shards must be at least 1")
+        else:
+            split('hash', args.shards)
+    else:
+        status()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# stub_openai.py
+# A tiny OpenAI-compatible server for working offline. It answers
+# POST /v1/chat/completions with a canned reply, either as one JSON body or
+# as a server-sent-event stream, one word per chunk.
+#
+#   python stub_openai.py --port 8089 --delay 0.05
+#   OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:8089/v1 streamlit run app.py
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = ("Nice work keeping your habits on track! Try blocking out a short, "
+                 "distraction-free window today for the habit you find hardest.")
+
+
+def _usage(messages, reply):
+    # Rough token counts, about four characters per token.
+    prompt_tokens = sum(len(m.get('content') or '') for m in messages) // 4
+    completion_tokens = len(reply) // 4
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    reply = DEFAULT_REPLY
+    delay = 0.0
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found'}})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.latency)
+        if request.get('stream'):
+            self._stream(request)
+        else:
+            self._complete(request)
+
+    def _base(self, request, kind):
+        return {
+            'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            'object': kind,
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+        }
+
+    def _complete(self, request):
+        body = self._base(request, 'chat.completion')
+        body['choices'] = [{'index': 0, 'finish_reason': 'stop',
+                            'message': {'role': 'assistant', 'content': self.reply}}]
+        body['usage'] = _usage(request.get('messages', []), self.reply)
+        self._send_json(200, body)
+
+    def _stream(self, request):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            chunk = self._base(request, 'chat.completion.chunk')
+            delta = {'content': word if i == 0 else ' ' + word}
+            if i == 0:
+                delta['role'] = 'assistant'
+            chunk['choices'] = [{'index': 0, 'delta': delta, 'finish_reason': None}]
+            self._send_event(chunk)
+            time.sleep(self.delay)
+        chunk = self._base(request, 'chat.completion.chunk')
+        chunk['choices'] = [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]
+        self._send_event(chunk)
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk = self._base(request, 'chat.completion.chunk')
+            chunk['choices'] = []
+            chunk['usage'] = _usage(request.get('messages', []), self.reply)
+            self._send_event(chunk)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _send_event(self, payload):
+        self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode())
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_stub_server(port=0, reply=DEFAULT_REPLY, delay=0.0, latency=0.0):
+    handler = type('ConfiguredStubHandler', (StubHandler,),
+                   {'reply': reply, 'delay': delay, 'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_stub_server(port=0, reply=DEFAULT_REPLY, delay=0.0, latency=0.0):
+    """
+    Start the stub in a background thread and return the server.
+    Its base url is f"http://127.0.0.1:{server.server_port}/v1".
+    """
+    server = make_stub_server(port, reply, delay, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stub OpenAI chat completions server.")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--reply', default=DEFAULT_REPLY)
+    parser.add_argument('--delay', type=float, default=0.05, help="seconds between streamed words")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before the first byte")
+    args = parser.parse_args()
+    server = make_stub_server(args.port, args.reply, args.delay, args.latency)
+    print(f"Stub OpenAI server on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
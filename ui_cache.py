@@ -0,0 +1,72 @@
+# ui_cache.py
+# Cached reads for the Streamlit pages. Streamlit reruns the whole script on
+# every widget interaction, so the pages read through here instead of
+# querying the database each time. Entries are shared by all sessions in the
+# process and are dropped when the user's data version changes (writes from
+# the API process included) or when the page reports an action. Reads that
+# also depend on other users' data or on background jobs are keyed by a
+# GOOD_HABITS_UI_CACHE_SECONDS period as well, so they are at most that old.
+import os
+import time
+
+from context_cache import context_cache
+from database import get_tabs
+from habit_functions import get_due_habits, get_user_habits
+from leaderboard import get_rank, get_top, get_user_boards
+from pregen import get_generated_messages
+from progress import get_progress_series
+
+UI_CACHE_SECONDS = float(os.environ.get('GOOD_HABITS_UI_CACHE_SECONDS', '30'))
+
+
+def _period():
+    return int(time.time() // UI_CACHE_SECONDS)
+
+
+def get_cached_habits(username):
+    return context_cache.get('habits', username, get_user_habits, kind='habits')
+
+
+def get_cached_due_habits(username):
+    # Keyed by day as well, since "due today" moves at midnight (UTC).
+    name = f"due_habits:{int(time.time()) // 86400}"
+    return context_cache.get(name, username, get_due_habits, kind='habits')
+
+
+def get_cached_tabs(username):
+    return context_cache.get('tabs', username.strip(), get_tabs, kind='tabs')
+
+
+def get_cached_user_boards(username):
+    return context_cache.get('user_boards', username, get_user_boards, kind='habits')
+
+
+def get_cached_top(username, k=10, habit_name=None):
+    # Per viewer, so their own changes show at once; others' within the period.
+    name = f"leaderboard_top:{k}:{habit_name}:{_period()}"
+    return context_cache.get(name, username, lambda _: get_top(k, habit_name), kind='habits')
+
+
+def get_cached_rank(username, habit_name=None):
+    name = f"leaderboard_rank:{habit_name}:{_period()}"
+    return context_cache.get(name, username, lambda user: get_rank(user, habit_name), kind='habits')
+
+
+def get_cached_progress_series(username, days):
+    # Snapshots come from a background job, which doesn't bump data versions.
+    name = f"progress:{days}:{_period()}"
+    return context_cache.get(name, username, lambda user: get_progress_series(user, days))
+
+
+def get_cached_generated_messages(username):
+    # Stored by pregen.py some time after the change they describe.
+    name = f"generated_messages:{_period()}"
+    return context_cache.get(name, username, get_generated_messages)
+
+
+def invalidate_user_cache(username):
+    """
+    Forget cached reads for the user. Call after the user changes their data.
+    """
+    context_cache.invalidate(username)
+    context_cache.invalidate(username.strip())